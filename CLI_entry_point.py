@@ -1,8 +1,11 @@
+import os
 import sys
 import argparse
+import json
 import logging 
 
 from client import SaiClient 
+from config import CONFIG
 
 
 def main(argv=None):
@@ -10,11 +13,21 @@ def main(argv=None):
 	if argv is None:
 		argv = sys.argv[1:]
 
+	if argv and argv[0] in COMMANDS: # sub-commands, e.g. "ctl stats"
+		return COMMANDS[argv[0]](argv[1:])
+
 	parser = argparse.ArgumentParser(description = __doc__)	
 
-	parser.add_argument('torrent', help='.torrent metainfo file')
+	parser.add_argument('torrent', nargs='?', help='.torrent metainfo file')
 	parser.add_argument('-t', '--torrent2', help='other .torrent metainfo file') #optional argument 
 	parser.add_argument('--outdir', type=str, help='Output Directory')
+	parser.add_argument('--daemon', '-d', default = False, action = 'store_true', help='keep running and accept commands on the control socket')
+	parser.add_argument('--socket', type=str, help='control socket path (daemon mode)')
+	parser.add_argument('--max-download-rate', type=int, default=0, help='KiB/s for the whole session, 0 = unlimited')
+	parser.add_argument('--max-upload-rate', type=int, default=0, help='KiB/s for the whole session, 0 = unlimited')
+	parser.add_argument('--trace-dir', type=str, help='record every peer session there, for replay')
+	parser.add_argument('--seed', type=str, help='seed the torrent from the data at this path instead of downloading it')
+	parser.add_argument('--superseed', default=False, action='store_true', help='with --seed: hand out each piece once (BEP 16)')
 	parser.add_argument('--hello', default = False, action = 'store_true') # defaults to false
 	parser.add_argument('--verbose','-v',default = True, action='store_false') # defaults to true
 
@@ -24,21 +37,110 @@ def main(argv=None):
 		print('hello')
 		return 
 
+	if not args.torrent and not args.daemon:
+		parser.error('a torrent is required unless running with --daemon')
+
 	if (args.verbose):
 		logging.basicConfig(level=logging.DEBUG)
 
 	else:
 		logging.basicConfig(level=logging.INFO)
 
-	client = SaiClient(outdir=args.outdir)
-	client.add_torrent(args.torrent)
+	if args.trace_dir:
+		CONFIG['trace_dir'] = args.trace_dir
+
+	if args.superseed:
+		CONFIG['superseed'] = True
+
+	client = SaiClient(outdir=args.outdir, keep_running=args.daemon)
+	client.set_rate_limit('download', args.max_download_rate * 1024)
+	client.set_rate_limit('upload', args.max_upload_rate * 1024)
+
+	if args.torrent and args.seed:
+		client.seed_torrent(args.torrent, args.seed)
+	elif args.torrent:
+		client.add_torrent(args.torrent)
 
 	if args.torrent2:
 		client.add_torrent(args.torrent2)
 
-	client.start_torrents()
+	if args.daemon:
+		from daemon import SaiDaemon
+		SaiDaemon(client, args.socket).start()
+	else:
+		client.start_torrents()
+
 
+def ctl_main(argv):
+
+	""" Thin client for a running daemon """
+
+	from daemon import ControlClient, DaemonControlError
+
+	parser = argparse.ArgumentParser(prog='ctl', description='control a running daemon')
+	parser.add_argument('--socket', type=str, help='control socket path')
+	parser.add_argument('command', choices=['add', 'remove', 'pause', 'resume', 'stats', 'session', 'limit', 'shutdown'])
+	parser.add_argument('target', nargs='?', help='.torrent file for add, info hash otherwise')
+	parser.add_argument('--down', type=int, help='limit: download KiB/s, 0 = unlimited')
+	parser.add_argument('--up', type=int, help='limit: upload KiB/s, 0 = unlimited')
+
+	args = parser.parse_args(argv)
+	control = ControlClient(args.socket)
+
+	try:
+		result = _run_ctl_command(control, args)
+	except (DaemonControlError, OSError) as e:
+		print('error: %s' % e)
+		return 1
+
+	print(json.dumps(result, indent=2))
+
+
+def _run_ctl_command(control, args):
+
+	if args.command == 'add':
+		# the daemon runs in a directory of its own - send a path that means the same there
+		result = control.call('add_torrent', path=os.path.abspath(os.path.expanduser(args.target)))
+	elif args.command == 'remove':
+		result = control.call('remove_torrent', info_hash=args.target)
+	elif args.command == 'pause':
+		result = control.call('pause_torrent', info_hash=args.target)
+	elif args.command == 'resume':
+		result = control.call('resume_torrent', info_hash=args.target)
+	elif args.command == 'stats':
+		result = control.call('get_stats', info_hash=args.target) if args.target else control.call('get_stats')
+	elif args.command == 'session':
+		result = control.call('get_session_stats')
+	elif args.command == 'limit':
+		target = {'info_hash': args.target} if args.target else {}
+		for (direction, rate) in (('download', args.down), ('upload', args.up)):
+			if rate is not None:
+				control.call('set_rate_limit', direction=direction, rate=rate * 1024, **target)
+		result = control.call('get_stats', **target) if args.target else control.call('get_session_stats')
+	else:
+		result = control.call('shutdown')
+
+	return result
+
+
+def create_main(argv):
+
+	from torrent_creator import create_main
+	return create_main(argv)
 
-if __name__=='__main__':
-	main()
 
+def replay_main(argv):
+
+	from peer_trace import replay_main
+	return replay_main(argv)
+
+
+COMMANDS = {
+	'ctl': ctl_main,
+	'create': create_main,
+	'replay': replay_main
+}
+
+
+if __name__=='__main__':
+	sys.exit(main())
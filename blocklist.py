@@ -0,0 +1,257 @@
+"""
+IP blocklist - addresses we never connect to or accept, from the usual published list formats
+
+The lists in CONFIG['blocklists'] can be any mix of (optionally gzipped):
+
+	P2P		description:1.2.3.0-1.2.3.255
+	DAT		001.002.003.000 - 001.002.003.255 , 100 , description		(eMule ipfilter.dat; access level
+				128 and up means allowed, so those lines are skipped)
+	CIDR	1.2.3.0/24, or a single address
+
+with '#' comments. Ranges are compiled into two parallel arrays of start and end addresses, sorted, with
+overlapping and adjacent ranges merged - so a lookup is one bisect over a few MB of ints for lists of
+hundreds of thousands of ranges. Parsing those takes seconds, so the compiled arrays are cached in
+CONFIG['blocklist_cache'], keyed by the paths, sizes and modification times of the lists, and reloaded
+as they are on the next start.
+
+Peer lists are filtered as a whole before they reach a torrent (Torrent.filter_peers: tracker replies,
+PEX, the peer cache), and incoming connections are dropped by the listener before their handshake. IPv4
+only: hostnames and IPv6 addresses are not on the lists and pass.
+
+"""
+
+import array
+import bisect
+import gzip
+import hashlib
+import logging
+import os
+import re
+import socket
+import struct
+import sys
+
+from config import CONFIG
+
+log = logging.getLogger(__name__)
+
+CACHE_MAGIC = b'BTBLOCK1'
+DAT_ALLOWED_LEVEL = 128
+DAT_LINE = re.compile(r'([\d.]+)\s*-\s*([\d.]+)\s*(,.*)?$')
+
+
+def ip_to_int(ip):
+	""" None for anything that is not a dotted IPv4 address """
+
+	try:
+		return struct.unpack('!I', socket.inet_aton(ip))[0]
+	except (OSError, TypeError, ValueError, UnicodeError): # ValueError: embedded NUL
+		return None
+
+
+def parse_address(ip):
+	""" a list's dotted address - by hand, as inet_aton would read the zero padded octets of DAT lists as octal """
+
+	octets = ip.strip().split('.')
+	try:
+		octets = [int(o, 10) for o in octets]
+	except ValueError:
+		octets = []
+	if len(octets) != 4 or max(octets) > 255:
+		raise BlocklistError('bad address %r' % ip)
+
+	return (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3]
+
+
+def parse_range(start, end):
+
+	(start, end) = (parse_address(start), parse_address(end))
+	return (min(start, end), max(start, end))
+
+
+def parse_line(line):
+	""" (first, last) address of the range on a line of any of the formats, None for blank lines and comments """
+
+	line = line.strip()
+	if not line or line.startswith('#'):
+		return None
+
+	m = DAT_LINE.match(line) # a range first, maybe with level and description
+	if m:
+		try:
+			if m.group(3) and int(m.group(3).split(',')[1]) >= DAT_ALLOWED_LEVEL:
+				return None
+		except (IndexError, ValueError):
+			raise BlocklistError('bad access level')
+		return parse_range(m.group(1), m.group(2))
+
+	if ':' in line: # P2P - the description may have colons of its own
+		addresses = line.rpartition(':')[2]
+		if '-' not in addresses:
+			raise BlocklistError('no range')
+		return parse_range(*addresses.split('-', 1))
+
+	(ip, _, bits) = line.partition('/') # CIDR
+	start = parse_address(ip)
+	try:
+		bits = int(bits) if bits else 32
+	except ValueError:
+		bits = -1
+	if not 0 <= bits <= 32:
+		raise BlocklistError('bad prefix length')
+
+	mask = (0xffffffff << (32 - bits)) & 0xffffffff
+	return (start & mask, (start & mask) | (~mask & 0xffffffff))
+
+
+def read_ranges(path):
+	""" the ranges of one list file; lines that don't parse are skipped """
+
+	opener = gzip.open if path.endswith('.gz') else open
+	ranges = []
+	num_bad = 0
+
+	with opener(path, 'rt', encoding='latin-1') as f:
+		for line in f:
+			try:
+				r = parse_line(line)
+			except BlocklistError:
+				num_bad += 1
+				continue
+			if r:
+				ranges.append(r)
+
+	if num_bad:
+		log.warning('blocklist %s: skipped %d lines that did not parse (e.g. IPv6)' % (path, num_bad))
+
+	return ranges
+
+
+class IPBlocklist():
+
+	def __init__(self, ranges=()):
+
+		self.starts = array.array('I')
+		self.ends = array.array('I')
+		self.num_blocked = 0 # peers filtered out, for the logs
+
+		self.compile(ranges)
+
+	def __len__(self):
+		return len(self.starts)
+
+	def compile(self, ranges):
+		""" sort and merge the (first, last) ranges into the lookup arrays """
+
+		starts = array.array('I')
+		ends = array.array('I')
+
+		for (start, end) in sorted(ranges):
+			if ends and start <= ends[-1] + 1: # overlaps or touches the previous one
+				if end > ends[-1]:
+					ends[-1] = end
+			else:
+				starts.append(start)
+				ends.append(end)
+
+		(self.starts, self.ends) = (starts, ends)
+
+	def is_blocked(self, ip):
+
+		n = ip_to_int(ip)
+		if n is None:
+			return False
+
+		i = bisect.bisect_right(self.starts, n) - 1
+		return i >= 0 and n <= self.ends[i]
+
+	def filter_peers(self, peer_dicts):
+		""" the peers of the list whose ip is not blocked """
+
+		(starts, ends, bisect_right) = (self.starts, self.ends, bisect.bisect_right)
+
+		allowed = []
+		for peer_dict in peer_dicts:
+			n = ip_to_int(peer_dict['ip'])
+			if n is not None:
+				i = bisect_right(starts, n) - 1
+				if i >= 0 and n <= ends[i]:
+					continue
+			allowed.append(peer_dict)
+
+		if len(allowed) < len(peer_dicts):
+			self.num_blocked += len(peer_dicts) - len(allowed)
+			log.debug('blocklist: dropped %d of %d peers' % (len(peer_dicts) - len(allowed), len(peer_dicts)))
+
+		return allowed
+
+	# ========= Loading and the compiled cache ========= #
+
+	@classmethod
+	def load(cls, paths, cache_path=None):
+		""" a blocklist of all the lists, from the compiled cache when none of them has changed since """
+
+		paths = [os.path.expanduser(p) for p in paths]
+		cache_path = os.path.expanduser(cache_path or CONFIG['blocklist_cache'])
+		key = cls.get_cache_key(paths)
+
+		blocklist = cls()
+		if blocklist.read_cache(cache_path, key):
+			log.info('blocklist: %d ranges from %s' % (len(blocklist), cache_path))
+			return blocklist
+
+		ranges = []
+		for path in paths:
+			ranges += read_ranges(path)
+		blocklist.compile(ranges)
+		log.info('blocklist: compiled %d ranges into %d from %d lists' % (len(ranges), len(blocklist), len(paths)))
+
+		blocklist.write_cache(cache_path, key)
+		return blocklist
+
+	@staticmethod
+	def get_cache_key(paths):
+		""" changes whenever a list is edited, added or removed - or the arrays' layout would differ """
+
+		h = hashlib.sha1(('%s %d' % (sys.byteorder, array.array('I').itemsize)).encode())
+		for path in paths:
+			try:
+				st = os.stat(path)
+			except OSError as e:
+				raise BlocklistError('cannot read blocklist %s: %s' % (path, e))
+			h.update(('%s %d %d\n' % (os.path.abspath(path), st.st_size, st.st_mtime_ns)).encode())
+
+		return h.digest()
+
+	def read_cache(self, cache_path, key):
+
+		try:
+			with open(cache_path, 'rb') as f:
+				if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC or f.read(len(key)) != key:
+					return False
+				(count,) = struct.unpack('!L', f.read(4))
+				(starts, ends) = (array.array('I'), array.array('I'))
+				starts.fromfile(f, count)
+				ends.fromfile(f, count)
+		except (OSError, EOFError, struct.error) as e:
+			log.debug('blocklist: no usable cache at %s: %s' % (cache_path, e))
+			return False
+
+		(self.starts, self.ends) = (starts, ends)
+		return True
+
+	def write_cache(self, cache_path, key):
+
+		try:
+			os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+			with open(cache_path + '.tmp', 'wb') as f:
+				f.write(CACHE_MAGIC + key + struct.pack('!L', len(self.starts)))
+				self.starts.tofile(f)
+				self.ends.tofile(f)
+			os.replace(cache_path + '.tmp', cache_path)
+		except OSError as e: # only costs the next start some time
+			log.warning('blocklist: could not write the cache %s: %s' % (cache_path, e))
+
+
+class BlocklistError(Exception):
+	pass
@@ -6,6 +6,14 @@ log = logging.getLogger(__name__)
 from torrent_metainfo import TorrentMetainfo
 from torrent import Torrent
 from conn_manager import ConnectionManagerTwisted
+from peer_cache import PeerCache
+from peer_listener import PeerListener
+from lsd import LocalServiceDiscovery, LSDProtocol
+from rate_limiter import TokenBucket
+from torrent_queue import TorrentQueue
+from peer_trace import TraceRecorder
+from blocklist import IPBlocklist
+from config import CONFIG
 
 class SaiClient():
 
@@ -17,12 +25,32 @@ class SaiClient():
 
 	""" 
 
-	def __init__(self, outdir = None):
+	def __init__(self, outdir = None, keep_running = False):
+		"""
+		Args:
+			outdir - directory the completed torrents are saved in
+			keep_running - daemon mode; keep the event loop (and the session) alive when all torrents are done
+		"""
 
 		self.active_torrents = []
 		self.finished_torrents = []
 		self.outdir = outdir
+		self.keep_running = keep_running
+		self.is_running = False
 		self.conn_man = ConnectionManagerTwisted()
+		if CONFIG['trace_dir']:
+			ConnectionManagerTwisted.recorder = TraceRecorder(CONFIG['trace_dir'], self.conn_man.now)
+		self.peer_cache = PeerCache()
+		# addresses we never dial or accept - compiled once, then loaded from its cache on the next start
+		self.blocklist = IPBlocklist.load(CONFIG['blocklists']) if CONFIG['blocklists'] else None
+		self.listener = PeerListener(self.conn_man, self.blocklist) # routes incoming peers to our torrents by info hash
+		self.lsd = LocalServiceDiscovery(self.conn_man, self.listener) if CONFIG['local_peer_discovery'] else None
+		# runs the torrents with the healthiest swarms, the rest wait their turn
+		self.queue = TorrentQueue(self.conn_man) if CONFIG['queue_max_active'] else None
+
+		# session wide limits - every torrent's buckets hang off these
+		self.download_limiter = TokenBucket(CONFIG['download_rate_limit'], clock=self.conn_man.now)
+		self.upload_limiter = TokenBucket(CONFIG['upload_rate_limit'], clock=self.conn_man.now)
 
 
 	def add_torrent(self, filename):
@@ -31,16 +59,119 @@ class SaiClient():
 			contents = f.read()
 
 		metainfo = TorrentMetainfo(contents)
-		torrent = Torrent(self.conn_man, metainfo, self.on_completed_torrent, self.on_completed_piece)
+
+		existing = self.get_torrent(metainfo.info_hash.hex())
+		if existing:
+			return existing
+
+		torrent = Torrent(self.conn_man, metainfo, self.on_completed_torrent, self.on_completed_piece,
+			peer_cache=self.peer_cache, download_limiter=self.download_limiter, upload_limiter=self.upload_limiter,
+			blocklist=self.blocklist)
 		self.active_torrents.append(torrent)
+		self.listener.add_torrent(torrent)
+
+		if self.queue: # starts it when it ranks high enough
+			self.queue.add(torrent)
+		elif self.is_running: # session is already up, so start right away
+			torrent.start_torrent()
+
+		if self.is_running and self.lsd and torrent.tracker:
+			self.lsd.announce([metainfo.info_hash])
+
+		return torrent
+
+	def seed_torrent(self, filename, path):
+		""" upload a torrent we have all the data of - e.g. one just made with 'create' - from the file(s) at path """
+
+		with open(filename, 'rb') as f:
+			metainfo = TorrentMetainfo(f.read())
+
+		torrent = Torrent(self.conn_man, metainfo, peer_cache=self.peer_cache, download_limiter=self.download_limiter,
+			upload_limiter=self.upload_limiter, blocklist=self.blocklist)
+		torrent.seed(self._load_data(metainfo, path))
+
+		self.finished_torrents.append(torrent)
+		self.listener.add_torrent(torrent)
+		if self.is_running:
+			torrent.start_torrent()
+
+		return torrent
 
 
 	def start_torrents(self):
 
-		for torrent in self.active_torrents:
+		self.is_running = True
+		self.conn_man.listen(self.listener)
+		if self.lsd:
+			self.conn_man.listen_multicast(self.lsd.group, LSDProtocol(self.lsd))
+			self.lsd.start()
+		if self.queue:
+			self.queue.start()
+		else:
+			for torrent in self.active_torrents:
+				torrent.start_torrent()
+		for torrent in self.get_seeding_torrents():
 			torrent.start_torrent()
 		self.conn_man.start_event_loop()
 
+	def get_seeding_torrents(self):
+		return [t for t in self.finished_torrents if t.is_seeding]
+
+	def get_torrent(self, info_hash_hex):
+
+		for torrent in self.active_torrents + self.finished_torrents:
+			if torrent.metainfo.info_hash.hex() == info_hash_hex:
+				return torrent
+
+		return None
+
+	def remove_torrent(self, torrent):
+
+		torrent.pause()
+		self.listener.remove_torrent(torrent)
+		if self.queue:
+			self.queue.remove(torrent)
+
+		if torrent in self.active_torrents:
+			self.active_torrents.remove(torrent)
+		else:
+			self.finished_torrents.remove(torrent)
+
+	def get_stats(self):
+
+		stats = {}
+		for torrent in self.active_torrents + self.finished_torrents:
+			stats[torrent.metainfo.info_hash.hex()] = dict(torrent.get_stats(), name=torrent.metainfo.name)
+
+		return stats
+
+	def set_rate_limit(self, direction, rate, torrent=None):
+		""" direction is 'download' or 'upload'; rate in bytes/sec, 0 = unlimited. Session wide unless a torrent is given """
+
+		owner = torrent if torrent else self
+		limiter = owner.download_limiter if direction == 'download' else owner.upload_limiter
+		limiter.set_rate(rate)
+
+	def get_session_stats(self):
+
+		return {
+			'active_torrents': len(self.active_torrents),
+			'finished_torrents': len(self.finished_torrents),
+			'queued_torrents': len(self.queue.queued) if self.queue else 0,
+			'blocked_peers': self.blocklist.num_blocked if self.blocklist else 0,
+			'download': self.download_limiter.get_stats(),
+			'upload': self.upload_limiter.get_stats()
+		}
+
+	def stop(self):
+
+		if self.queue:
+			self.queue.stop()
+		for torrent in self.active_torrents + self.get_seeding_torrents():
+			torrent.pause()
+		self.is_running = False
+		self.conn_man.stop_event_loop()
+
 	def on_completed_piece(self, torrent):
 		print('%s: %s' % (torrent, torrent.get_progress_string()))
 
@@ -57,13 +188,19 @@ class SaiClient():
 		self.active_torrents.remove(torrent)
 		self.finished_torrents.append(torrent)
 
+		if self.queue: # its slot goes to the next in line
+			self.queue.update()
+
 		if not self.active_torrents:
 			self.on_all_torrents_completed()
 
 
-	def on_all_torrents_completed():
+	def on_all_torrents_completed(self):
 
-		self.conn_man.stop_event_loop()
+		if self.keep_running or self.get_seeding_torrents(): # daemon mode - wait for the next torrent; or keep seeding
+			return
+
+		self.stop()
 
 	def _save_single_file(self, torrent, data):
 
@@ -75,6 +212,25 @@ class SaiClient():
 
 		log.info('save_single_file: %s ' % filepath)
 
+	def _load_data(self, metainfo, path):
+		""" the torrent's data as one string, from the layout the _save functions write """
+
+		path = os.path.expanduser(path)
+
+		if metainfo.info['format']=='SINGLE_FILE':
+			with open(path, 'rb') as f:
+				return f.read()
+
+		chunks = []
+		for file_dict in metainfo.info['files']:
+			if file_dict.get('padding'):
+				chunks.append(bytes(file_dict['length']))
+				continue
+			with open(os.path.join(path, file_dict['path']), 'rb') as f:
+				chunks.append(f.read())
+
+		return b''.join(chunks)
+
 	def _save_multiple_file(self, torrent, data):
 
 		begin = 0  
@@ -83,6 +239,10 @@ class SaiClient():
 		base_dir = (os.path.join(os.path.expanduser(self.outdir),base_dir) if self.outdir else base_dir)
 
 		for file_dict in torrent.metainfo.info['files']:
+			if file_dict.get('padding'): # alignment zeros of a hybrid torrent, not a real file
+				begin += file_dict['length']
+				continue
+
 			filepath = os.path.join(base_dir, file_dict['path'])
 
 			os.makedirs(os.path.dirname(filepath),exist_ok = True)
@@ -1,7 +1,58 @@
 """ Global Config"""
 
+import os
+
 CONFIG = {
-	'peer_id': b'SR-0000-000000000000',
-	'block-length': 2**14,
-	'max_peers': 8
+	'peer_id': b'-SR0001-' + os.urandom(6).hex().encode(), # per session, so our own machines can tell each other apart
+	'block_length': 2**14,
+	'max_peers': 8, # starting target - adjusted per torrent while it runs when adaptive_max_peers is on
+	'adaptive_max_peers': True,
+	'min_peers': 4,
+	'max_peers_ceiling': 200,
+	'conn_controller_interval': 10.0, # seconds between adjustments
+	'conn_controller_min_gain': 0.05, # relative rate gain that justifies more peers
+	'conn_controller_max_lag': 0.5, # seconds the event loop may run late before we shed peers
+	# daemon mode JSON-RPC socket - in a directory of the user's own, and only they may connect to it
+	'control_socket': os.path.join(os.environ.get('XDG_RUNTIME_DIR') or '~/.sai_client', 'sai_client.sock'),
+	'peer_cache_dir': '~/.sai_client/peers',
+	'peer_cache_size': 200, # peers kept per torrent
+	'peer_cache_max_age': 7*24*3600, # seconds
+	'peer_cache_max_failures': 3,
+	'request_timeout_initial': 20.0, # seconds, until we have round trip samples for the peer
+	'request_timeout_min': 2.0,
+	'request_timeout_max': 60.0,
+	'max_request_stalls': 3, # timed out requests before we give up on a peer
+	# rate limits in bytes/sec, 0 = unlimited; all can be changed at runtime
+	'download_rate_limit': 0, # whole session
+	'upload_rate_limit': 0,
+	'torrent_download_rate_limit': 0,
+	'torrent_upload_rate_limit': 0,
+	'peer_download_rate_limit': 0,
+	'peer_upload_rate_limit': 0,
+	'listen_port': 6881, # incoming peers, TCP and uTP, for all torrents
+	'handshake_timeout': 10.0, # seconds an incoming connection gets to send its handshake
+	'local_peer_discovery': True, # BEP 14 multicast announces on the LAN
+	'lsd_interval': 300.0, # seconds between announces
+	'lsd_min_interval': 60.0, # never announce a torrent more often than this
+	'peer_transport': 'tcp', # 'tcp', 'utp' (BEP 29), or 'auto' - uTP first, TCP if that fails
+	'web_seed_connections': 4, # parallel range requests per web seed (BEP 19)
+	'web_seed_timeout': 30.0, # seconds
+	'web_seed_max_failures': 5, # failed requests in a row before we drop the server
+	'web_seed_retry_delay': 5.0, # seconds after the first failure, doubling after each one
+	'pex': True, # peer exchange (BEP 11) with peers that support it, never for private torrents
+	'pex_interval': 60.0, # seconds between the updates we send each peer
+	'pex_min_interval': 45.0, # updates from a peer that come faster than this are ignored
+	'queue_max_active': 5, # torrents downloading at once, best swarms first; 0 runs them all
+	'queue_interval': 60.0, # seconds between re-rankings of the queue
+	'queue_stall_time': 600.0, # seconds without progress before a running torrent is rotated out
+	'queue_bench_time': 1800.0, # seconds a rotated out torrent waits before it can compete again
+	'scrape_interval': 1800.0, # seconds between scrapes of the trackers
+	'scrape_timeout': 30.0, # seconds
+	'trace_dir': None, # when set, every peer connection is recorded there for replay (peer_trace.py)
+	'blocklists': [], # P2P, DAT or CIDR lists (may be gzipped) of addresses we never connect to or accept
+	'blocklist_cache': '~/.sai_client/blocklist.cache', # the compiled lists, rebuilt when one of them changes
+	'max_request_length': 2**17, # bytes - longer block requests from peers are ignored
+	'superseed': False, # BEP 16 when seeding: reveal pieces one at a time, so each goes out once
+	'superseed_interval': 10.0, # seconds between checks for pieces that did not spread
+	'superseed_timeout': 60.0 # seconds a peer waits for its last piece to spread before it gets the next one
 }
\ No newline at end of file
@@ -0,0 +1,117 @@
+"""
+Feedback controller for the number of peers a torrent keeps connected
+
+A fixed peer count is too few for a big healthy swarm and too many for a constrained uplink. Every
+interval the controller looks at the torrent's download rate and hill-climbs its max_peers target:
+	- while adding peers keeps raising the rate, add more
+	- when the last step added nothing, back off and drop the slowest peers
+	- when the event loop is running late (CPU bound), shrink
+always within [CONFIG['min_peers'], CONFIG['max_peers_ceiling']]
+
+"""
+
+import logging
+
+from config import CONFIG
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionController():
+
+	def __init__(self, torrent, floor=None, ceiling=None, interval=None):
+
+		self.torrent = torrent
+		self.floor = floor or CONFIG['min_peers']
+		self.ceiling = ceiling or CONFIG['max_peers_ceiling']
+		self.interval = interval or CONFIG['conn_controller_interval']
+
+		self.timer = None
+		self.expected_at = None
+		self.last_time = None
+		self.last_bytes = 0
+
+		self.rate = None # smoothed download rate, bytes/sec
+		self.last_rate = None # rate at the previous decision
+		self.direction = 1 # +1 while probing upwards, -1 while backing off
+
+	def start(self):
+
+		if self.timer:
+			return
+
+		self.last_time = self.torrent.conn_man.now()
+		self.last_bytes = self.torrent.bytes_downloaded
+		self._schedule()
+
+	def stop(self):
+
+		if self.timer:
+			self.timer.cancel()
+			self.timer = None
+
+	def _schedule(self):
+
+		self.expected_at = self.torrent.conn_man.now() + self.interval
+		self.timer = self.torrent.conn_man.call_later(self.interval, self.tick)
+
+	def tick(self):
+
+		self.timer = None
+
+		if self.torrent.is_complete or self.torrent.is_paused:
+			return
+
+		now = self.torrent.conn_man.now()
+		lag = now - self.expected_at # how late the timer fired - a busy loop fires late
+
+		sample = (self.torrent.bytes_downloaded - self.last_bytes) / max(now - self.last_time, 1e-6)
+		self.rate = sample if self.rate is None else 0.5*self.rate + 0.5*sample
+		self.last_time = now
+		self.last_bytes = self.torrent.bytes_downloaded
+
+		target = self.update(self.rate, lag, self.torrent.num_active_peers())
+		self.torrent.set_max_peers(target)
+
+		self._schedule()
+
+	def update(self, rate, lag, num_active):
+		""" the next max_peers target, given the current rate, loop lag and number of connected peers """
+
+		target = self.torrent.max_peers
+		step = max(1, target // 4)
+
+		if lag > CONFIG['conn_controller_max_lag']:
+			log.info('%s: loop lag %.2fs, reducing peers' % (self.torrent, lag))
+			self.direction = -1
+			self.last_rate = rate
+			return max(self.floor, target - step)
+
+		if self.last_rate is None:
+			gain = 1.0
+		else:
+			gain = (rate - self.last_rate) / max(self.last_rate, 1.0)
+
+		if self.direction > 0:
+			if num_active < target:
+				pass # can't fill the slots we have, growing won't help
+			elif gain > CONFIG['conn_controller_min_gain']:
+				target += step
+			else: # the last peers we added did nothing
+				self.direction = -1
+				target -= step
+		else:
+			if gain < -CONFIG['conn_controller_min_gain']: # shrinking cost us, go back up
+				self.direction = 1
+				target += step
+			else: # fewer peers are doing just as well
+				target -= step
+
+		self.last_rate = rate
+		target = min(self.ceiling, max(self.floor, target))
+
+		if target != self.torrent.max_peers:
+			log.debug('%s: max_peers %d -> %d (rate %.0f B/s, gain %.2f)' % (self.torrent, self.torrent.max_peers,
+				target, rate, gain))
+
+		return target
@@ -7,27 +7,81 @@ TODO: This process needs to be better understood
 
 """
 
+import collections
 import logging 
-from twisted.internet import protocol, reactor
+from twisted.internet import protocol, reactor, threads
+from twisted.internet.error import CannotListenError
+
+from config import CONFIG
+from utp import UTPProtocol
+
+log = logging.getLogger(__name__)
 
 #========== TWISTED Approach ===========#
 
 class PeerConnectionProtocol(protocol.Protocol):
 
+	""" 
+	Rate limits (the peer's TokenBuckets) are enforced here: over the download limit we stop reading
+	from the socket until the bucket recovers, over the upload limit writes are queued until it does
+
+	self.peer can be swapped while the connection is up - an incoming connection starts out with the
+	listener's stand-in and is handed to a TorrentPeer after the handshake
+	"""
+
 	def connectionMade(self):
-		self.factory.peer.handle_connection_made(self)
+		self.read_timer = None
+		self.write_timer = None
+		self.write_queue = collections.deque()
+		self.peer = self.factory.build_peer(self)
+		self.peer.handle_connection_made(self)
 
 	def dataReceived(self, data):
-		self.factory.peer.handle_data_received(data)
+		peer = self.peer
+		delay = peer.download_limiter.consume(len(data)) if peer.download_limiter else 0
+
+		peer.handle_data_received(data)
+
+		if delay > 0 and not self.read_timer and self.transport.connected:
+			self.transport.pauseProducing()
+			self.read_timer = reactor.callLater(delay, self._resume_reading)
+
+	def _resume_reading(self):
+		self.read_timer = None
+		self.transport.resumeProducing()
 
 	def connectionLost(self, reason):
-		pass
+		for timer in (self.read_timer, self.write_timer):
+			if timer:
+				timer.cancel()
+		self.read_timer = self.write_timer = None
 
 	def write(self, data):
-		self.transport.write(data)
+		self.write_queue.append(data)
+		if not self.write_timer:
+			self._flush_writes()
+
+	def _flush_writes(self):
+		self.write_timer = None
+		limiter = self.peer.upload_limiter
+
+		while self.write_queue:
+			delay = limiter.get_delay() if limiter else 0
+			if delay > 0:
+				self.write_timer = reactor.callLater(delay, self._flush_writes)
+				return
+
+			data = self.write_queue.popleft()
+			if limiter:
+				limiter.consume(len(data))
+			self.transport.write(data)
 
 	def disconnect(self):
-		self.transport.lostConnection()
+		self.transport.loseConnection()
+
+	def get_address(self):
+		address = self.transport.getPeer()
+		return (address.host, address.port)
 
 
 class PeerConnectionFactory(protocol.ClientFactory):
@@ -37,6 +91,9 @@ class PeerConnectionFactory(protocol.ClientFactory):
 	def __init__(self, peer):
 		self.peer = peer
 
+	def build_peer(self, conn):
+		return self.peer
+
 	def clientConnectionFailed(self, connector, reason):
 		self.peer.handle_connection_failed()
 
@@ -44,13 +101,108 @@ class PeerConnectionFactory(protocol.ClientFactory):
 		self.peer.handle_connection_lost()
 
 
+class IncomingConnectionProtocol(PeerConnectionProtocol):
+
+	def connectionLost(self, reason):
+		PeerConnectionProtocol.connectionLost(self, reason)
+		self.peer.handle_connection_lost()
+
+
+class IncomingConnectionFactory(protocol.ServerFactory):
+
+	protocol = IncomingConnectionProtocol
+
+	def __init__(self, listener):
+		self.listener = listener
+
+	def build_peer(self, conn):
+		return self.listener.accept(conn)
+
+
 class ConnectionManagerTwisted():
+
+	utp = None # the session's UTPProtocol, bound on first use
+	listener = None
+	recorder = None # a peer_trace.TraceRecorder while peer sessions are being recorded
 	
 	@staticmethod
 	def connect_peer(peer):
+		""" over CONFIG['peer_transport'] - 'tcp', 'utp', or 'auto' (uTP, falling back to TCP) """
+
+		transport = CONFIG['peer_transport']
+
+		if ConnectionManagerTwisted.recorder:
+			peer = ConnectionManagerTwisted.recorder.wrap(peer)
+
+		if transport == 'tcp':
+			ConnectionManagerTwisted.connect_peer_tcp(peer)
+			return
+
+		fallback = None
+		if transport == 'auto':
+			fallback = lambda: ConnectionManagerTwisted.connect_peer_tcp(peer)
+
+		ConnectionManagerTwisted.get_utp().mux.connect(peer, (peer.ip, peer.port), fallback)
+
+	@staticmethod
+	def connect_peer_tcp(peer):
 		f = PeerConnectionFactory(peer)
 		reactor.connectTCP(peer.ip, peer.port, f)
 
+	@staticmethod
+	def get_utp():
+		""" on the listening port once we listen, otherwise any port will do for outgoing connections """
+
+		if ConnectionManagerTwisted.utp is None:
+			listener = ConnectionManagerTwisted.listener
+			utp = UTPProtocol(ConnectionManagerTwisted, listener.accept if listener else None)
+			reactor.listenUDP(CONFIG['listen_port'] if listener else 0, utp)
+			ConnectionManagerTwisted.utp = utp
+
+		return ConnectionManagerTwisted.utp
+
+	@staticmethod
+	def listen(listener):
+		""" accept incoming peers on CONFIG['listen_port'], over TCP and uTP; listener is a PeerListener """
+
+		ConnectionManagerTwisted.listener = listener
+
+		try:
+			reactor.listenTCP(CONFIG['listen_port'], IncomingConnectionFactory(listener))
+			if ConnectionManagerTwisted.utp:
+				ConnectionManagerTwisted.utp.mux.accept_peer = listener.accept
+			else:
+				ConnectionManagerTwisted.get_utp()
+		except CannotListenError as e: # we can still dial out
+			log.warning('cannot listen on port %d: %s' % (CONFIG['listen_port'], e))
+			ConnectionManagerTwisted.listener = None
+
+	@staticmethod
+	def listen_multicast(group, datagram_protocol):
+		""" join a multicast group (host, port) - shared with any other client on this machine """
+
+		try:
+			port = reactor.listenMulticast(group[1], datagram_protocol, listenMultiple=True)
+			port.joinGroup(group[0])
+		except (CannotListenError, OSError) as e:
+			log.warning('cannot join multicast group %s:%d: %s' % (group[0], group[1], e))
+
+	@staticmethod
+	def run_in_thread(func, callback, errback):
+		""" run a blocking call (e.g. a tracker request) on the thread pool; the callbacks run back on the reactor """
+		d = threads.deferToThread(func)
+		d.addCallback(callback)
+		d.addErrback(lambda failure: errback(failure.value))
+
+	@staticmethod
+	def call_later(delay, func, *args):
+		""" returns a handle with cancel() """
+		return reactor.callLater(delay, func, *args)
+
+	@staticmethod
+	def now():
+		return reactor.seconds()
+
 	@staticmethod
 	def start_event_loop():
 		reactor.run()
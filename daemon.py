@@ -0,0 +1,240 @@
+"""
+Daemon mode - a single long running SaiClient session controlled over a local JSON-RPC API
+
+The API is JSON-RPC 2.0 over a Unix socket, one request / response per line.
+Methods: add_torrent, remove_torrent, pause_torrent, resume_torrent, get_stats, get_session_stats,
+	set_rate_limit, shutdown
+
+Keeping one session alive means peer connections and the event loop are reused across jobs
+instead of every torrent paying for a fresh process
+
+"""
+
+import json
+import logging
+import os
+import socket
+
+from twisted.internet import protocol, reactor
+from twisted.protocols.basic import LineOnlyReceiver
+
+from config import CONFIG
+
+log = logging.getLogger(__name__)
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+
+class ControlProtocol(LineOnlyReceiver):
+
+	delimiter = b'\n'
+
+	def lineReceived(self, line):
+		response = self.factory.daemon.handle_request_line(line)
+		self.sendLine(json.dumps(response).encode('utf-8'))
+
+		if self.factory.daemon.shutdown_requested:
+			self.transport.loseConnection() # flushes the reply, then connectionLost stops the daemon
+
+	def connectionLost(self, reason):
+		if self.factory.daemon.shutdown_requested:
+			self.factory.daemon.stop()
+
+
+class ControlFactory(protocol.ServerFactory):
+
+	protocol = ControlProtocol
+
+	def __init__(self, daemon):
+		self.daemon = daemon
+
+
+class SaiDaemon():
+
+	""" Exposes a SaiClient session on a Unix socket """
+
+	def __init__(self, client, socket_path=None):
+
+		self.client = client
+		self.socket_path = os.path.expanduser(socket_path or CONFIG['control_socket'])
+		self.port = None
+		self.shutdown_requested = False
+
+		self.methods = {
+			'add_torrent': self.add_torrent,
+			'remove_torrent': self.remove_torrent,
+			'pause_torrent': self.pause_torrent,
+			'resume_torrent': self.resume_torrent,
+			'get_stats': self.get_stats,
+			'get_session_stats': self.get_session_stats,
+			'set_rate_limit': self.set_rate_limit,
+			'shutdown': self.shutdown
+		}
+
+	def start(self):
+
+		os.makedirs(os.path.dirname(self.socket_path), mode=0o700, exist_ok=True)
+		if os.path.exists(self.socket_path): # left over from a previous run
+			os.remove(self.socket_path)
+
+		# the API adds any file we can read and shuts the session down - nobody else gets to call it
+		self.port = reactor.listenUNIX(self.socket_path, ControlFactory(self), mode=0o600)
+		log.info('daemon listening on %s' % self.socket_path)
+
+		self.client.start_torrents() # runs the event loop until shutdown
+
+	def handle_request_line(self, line):
+
+		try:
+			request = json.loads(line.decode('utf-8'))
+		except ValueError:
+			return self._error(None, PARSE_ERROR, 'Parse error')
+
+		return self.handle_request(request)
+
+	def handle_request(self, request):
+
+		if not isinstance(request, dict) or 'method' not in request:
+			return self._error(None, INVALID_REQUEST, 'Invalid request')
+
+		request_id = request.get('id')
+		method = self.methods.get(request['method'])
+
+		if method is None:
+			return self._error(request_id, METHOD_NOT_FOUND, 'Method not found: %s' % request['method'])
+
+		params = request.get('params', {})
+
+		try:
+			result = method(**params)
+		except (TypeError, DaemonUnknownTorrentError, DaemonInvalidParamsError) as e:
+			return self._error(request_id, INVALID_PARAMS, str(e))
+		except Exception as e:
+			log.exception('daemon: %s failed' % request['method'])
+			return self._error(request_id, SERVER_ERROR, str(e))
+
+		return {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+
+	@staticmethod
+	def _error(request_id, code, message):
+		return {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': code, 'message': message}}
+
+	# ========= API methods below ========= #
+
+	def add_torrent(self, path):
+
+		torrent = self.client.add_torrent(os.path.expanduser(path))
+		return torrent.metainfo.info_hash.hex()
+
+	def remove_torrent(self, info_hash):
+
+		self.client.remove_torrent(self._get_torrent(info_hash))
+		return True
+
+	def pause_torrent(self, info_hash):
+
+		torrent = self._get_torrent(info_hash)
+		if self.client.queue: # keeps its slot count right
+			self.client.queue.pause(torrent)
+		else:
+			torrent.pause()
+		return True
+
+	def resume_torrent(self, info_hash):
+
+		torrent = self._get_torrent(info_hash)
+		if self.client.queue: # runs only if it ranks high enough, or the max_active cap would not hold
+			self.client.queue.resume(torrent)
+		else:
+			torrent.resume()
+		return True
+
+	def get_stats(self, info_hash=None):
+
+		stats = self.client.get_stats()
+
+		if info_hash is None:
+			return stats
+
+		self._get_torrent(info_hash)
+		return stats[info_hash]
+
+	def get_session_stats(self):
+
+		return self.client.get_session_stats()
+
+	def set_rate_limit(self, direction, rate, info_hash=None):
+
+		if direction not in ('download', 'upload'):
+			raise DaemonInvalidParamsError('direction must be download or upload')
+
+		torrent = self._get_torrent(info_hash) if info_hash else None
+		self.client.set_rate_limit(direction, int(rate), torrent)
+		return True
+
+	def shutdown(self):
+
+		# the reply is sent first, the control connection then stops the daemon
+		self.shutdown_requested = True
+		return True
+
+	def stop(self):
+
+		if self.port:
+			self.port.stopListening()
+			self.port = None
+			self.client.stop()
+
+	def _get_torrent(self, info_hash):
+
+		torrent = self.client.get_torrent(info_hash)
+		if torrent is None:
+			raise DaemonUnknownTorrentError('Unknown torrent: %s' % info_hash)
+		return torrent
+
+
+class ControlClient():
+
+	""" Thin blocking client for the daemon's control socket """
+
+	def __init__(self, socket_path=None):
+		self.socket_path = os.path.expanduser(socket_path or CONFIG['control_socket'])
+		self.next_id = 1
+
+	def call(self, method, **params):
+
+		request = {'jsonrpc': '2.0', 'id': self.next_id, 'method': method, 'params': params}
+		self.next_id += 1
+
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+			sock.connect(self.socket_path)
+			sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+			data = b''
+			while not data.endswith(b'\n'):
+				chunk = sock.recv(65536)
+				if not chunk:
+					break
+				data += chunk
+
+		response = json.loads(data.decode('utf-8'))
+
+		if 'error' in response:
+			raise DaemonControlError(response['error']['message'])
+
+		return response['result']
+
+
+class DaemonControlError(Exception):
+	pass
+
+class DaemonUnknownTorrentError(Exception):
+	pass
+
+class DaemonInvalidParamsError(Exception):
+	pass
@@ -0,0 +1,173 @@
+"""
+Local Service Discovery (BEP 14) - finding peers for our torrents on the local network
+
+Every CONFIG['lsd_interval'] seconds the session multicasts the info hashes of its active torrents,
+with the port it listens on, to 239.192.152.143:6771, and listens on the group for other clients doing
+the same. A client that announces one of our info hashes is handed to that torrent as a local peer,
+which is dialled ahead of the tracker's peers - a LAN transfer beats anything from the WAN.
+
+	BT-SEARCH * HTTP/1.1
+	Host: 239.192.152.143:6771
+	Port: <port>
+	Infohash: <40 hex digits>		(one line per torrent)
+	cookie: <ours, so we can ignore our own announces>
+
+with CRLF line endings, like an HTTP request
+
+"""
+
+import binascii
+import logging
+import os
+
+from twisted.internet import protocol
+
+from config import CONFIG
+
+log = logging.getLogger(__name__)
+
+LSD_GROUP = ('239.192.152.143', 6771)
+MAX_HASHES_PER_ANNOUNCE = 20 # keeps an announce well inside one datagram
+
+
+def build_announce(port, info_hashes, cookie, group=LSD_GROUP):
+
+	lines = ['BT-SEARCH * HTTP/1.1', 'Host: %s:%d' % group, 'Port: %d' % port]
+	lines += ['Infohash: %s' % info_hash.hex() for info_hash in info_hashes]
+	lines.append('cookie: %s' % cookie)
+
+	return ('\r\n'.join(lines) + '\r\n\r\n\r\n').encode('ascii')
+
+
+def parse_announce(data):
+	""" (port, [info_hash], cookie) """
+
+	try:
+		lines = data.decode('ascii').split('\r\n')
+	except UnicodeDecodeError:
+		raise LSDAnnounceError('not ascii')
+
+	if not lines[0].startswith('BT-SEARCH * HTTP/'):
+		raise LSDAnnounceError('not an announce: %r' % lines[0][:40])
+
+	port = None
+	info_hashes = []
+	cookie = None
+
+	for line in lines[1:]:
+		(name, _, value) = line.partition(':')
+		name = name.strip().lower()
+		value = value.strip()
+
+		try:
+			if name == 'port':
+				port = int(value)
+			elif name == 'infohash':
+				info_hashes.append(binascii.unhexlify(value))
+			elif name == 'cookie':
+				cookie = value
+		except (ValueError, binascii.Error):
+			raise LSDAnnounceError('bad %s: %r' % (name, value))
+
+	if port is None or not 0 < port < 65536 or not info_hashes:
+		raise LSDAnnounceError('no port or info hash')
+
+	return (port, [h for h in info_hashes if len(h) == 20], cookie)
+
+
+class LocalServiceDiscovery():
+
+	""" session wide - announces every torrent in the PeerListener's index and feeds local peers back to them """
+
+	def __init__(self, conn_man, listener, send_datagram=None, port=None, group=LSD_GROUP):
+		"""
+		Args:
+			listener - the session's PeerListener; its info hash index says which torrents we have
+			send_datagram - send_datagram(data) to the multicast group; set by LSDProtocol when not given
+			port - the port we take peers on, defaults to CONFIG['listen_port']
+		"""
+
+		self.conn_man = conn_man
+		self.listener = listener
+		self.send_datagram = send_datagram
+		self.port = port or CONFIG['listen_port']
+		self.group = group
+		self.cookie = os.urandom(8).hex()
+		self.last_announced = {} # info_hash -> time of our last announce of it
+		self.timer = None
+
+	def start(self):
+
+		self.announce()
+		self.timer = self.conn_man.call_later(CONFIG['lsd_interval'], self.handle_timer)
+
+	def stop(self):
+
+		if self.timer:
+			self.timer.cancel()
+			self.timer = None
+
+	def handle_timer(self):
+
+		self.timer = None
+		self.start()
+
+	def announce(self, info_hashes=None):
+		""" our active torrents (or just the ones given), no more than once a minute each as BEP 14 asks """
+
+		now = self.conn_man.now()
+		if info_hashes is None:
+			info_hashes = list(self.listener.torrents)
+
+		due = []
+		for info_hash in info_hashes:
+			torrent = self.listener.torrents.get(info_hash)
+			if torrent is None or torrent.is_paused or (torrent.is_complete and not torrent.is_seeding):
+				continue
+			last = self.last_announced.get(info_hash)
+			if last is not None and now - last < CONFIG['lsd_min_interval']:
+				continue
+			self.last_announced[info_hash] = now
+			due.append(info_hash)
+
+		for i in range(0, len(due), MAX_HASHES_PER_ANNOUNCE):
+			self.send_datagram(build_announce(self.port, due[i:i + MAX_HASHES_PER_ANNOUNCE], self.cookie, self.group))
+
+	def handle_datagram(self, data, addr):
+
+		try:
+			(port, info_hashes, cookie) = parse_announce(data)
+		except LSDAnnounceError as e:
+			log.debug('lsd: bad announce from %s: %s' % (addr[0], e))
+			return
+
+		if cookie == self.cookie: # multicast loops our own announces back to us
+			return
+
+		for info_hash in info_hashes:
+			torrent = self.listener.torrents.get(info_hash)
+			if torrent:
+				log.info('%s: local peer %s:%d' % (torrent, addr[0], port))
+				torrent.add_local_peer({'ip': addr[0], 'port': port})
+
+
+class LSDProtocol(protocol.DatagramProtocol):
+
+	""" Twisted end of LocalServiceDiscovery - a socket in the multicast group """
+
+	def __init__(self, lsd):
+		self.lsd = lsd
+		lsd.send_datagram = self.send_datagram
+
+	def datagramReceived(self, data, addr):
+		self.lsd.handle_datagram(data, addr)
+
+	def send_datagram(self, data):
+		try:
+			self.transport.write(data, self.lsd.group)
+		except OSError as e: # e.g. no multicast route - not worth more than a log line
+			log.debug('lsd: announce failed: %s' % e)
+
+
+class LSDAnnounceError(Exception):
+	pass
@@ -0,0 +1,193 @@
+"""
+Memory footprint of the per-piece and per-peer state, against recorded budgets
+
+Several structures grow with the size of the torrent or the number of peers: the metainfo's piece hashes,
+the torrent's piece maps (piece_blocks, piece_requests, complete_pieces and the bitmaps), every peer's
+peer_pieces, and the blocks of in-progress pieces. The benchmark builds torrents from synthetic metainfo
+(random piece hashes, parsed by TorrentMetainfo like a real .torrent), adds the peers, and then puts the
+piece maps in the state a download holds them in - an in-progress piece per peer, then every piece
+complete - rather than driving the protocol. Each step is measured with tracemalloc:
+
+	steady - bytes still allocated once the step is done
+	peak - the most allocated at any point during it, over what was allocated before
+
+RSS is sampled along the way for comparison, but only tracemalloc is checked: a component fails when its
+peak goes over its budget in BUDGETS, a fixed slack plus so many bytes per piece, per peer, and per piece
+of each peer. Block and piece payloads are one shared bytes object, so only the bookkeeping is counted.
+
+	python memory_benchmark.py --pieces 1000 100000 1000000 --peers 10 1000 10000
+
+"""
+
+import argparse
+import gc
+import logging
+import os
+import sys
+import tracemalloc
+
+import bencodepy
+
+from config import CONFIG
+from torrent import Torrent
+from torrent_metainfo import TorrentMetainfo
+
+PIECE_LENGTH = 2**18
+
+# component -> (bytes per piece, bytes per peer, bytes per piece per peer), on top of BUDGET_SLACK
+BUDGETS = {
+	'metainfo': (100, 0, 0), # 20 byte hash objects in a list, and the decoded string while parsing
+	'torrent': (32, 0, 0), # three list slots per piece and two bits
+	'peers': (0, 768, 0.15), # a TorrentPeer with its index entry, and a bit per piece
+	'piece_blocks': (0, 2560, 0), # one in-progress piece per peer: a dict of (block, peer) and its requesters
+	'complete_pieces': (1, 0, 0), # the slots are already there - completing a piece must not cost more
+}
+BUDGET_SLACK = 64 * 1024 # allocator and interpreter noise, which dominates the smallest runs
+
+
+def get_rss():
+	""" resident set size in bytes, None where /proc is not available """
+
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError):
+		return None
+
+
+def build_metainfo(num_pieces, piece_length=PIECE_LENGTH):
+	""" bencoded single file metainfo with random piece hashes """
+
+	return bencodepy.encode({
+		b'announce': b'http://tracker.invalid/announce',
+		b'encoding': b'UTF-8',
+		b'info': {
+			b'name': b'synthetic',
+			b'piece length': piece_length,
+			b'length': num_pieces * piece_length,
+			b'pieces': os.urandom(20 * num_pieces),
+		}
+	})
+
+
+class Measurement():
+
+	""" allocations made from the start to the end of a step, see measure() """
+
+	def __init__(self, results, component, num_pieces, num_peers):
+
+		self.results = results
+		self.result = {'component': component, 'pieces': num_pieces, 'peers': num_peers}
+
+	def __enter__(self):
+
+		gc.collect()
+		tracemalloc.reset_peak()
+		(self.traced, _) = tracemalloc.get_traced_memory()
+		self.rss = get_rss()
+		return self
+
+	def __exit__(self, *exc_info):
+
+		gc.collect()
+		(traced, peak) = tracemalloc.get_traced_memory()
+		rss = get_rss()
+
+		self.result['steady'] = traced - self.traced
+		self.result['peak'] = peak - self.traced
+		self.result['rss'] = rss - self.rss if rss is not None and self.rss is not None else None
+		self.results.append(self.result)
+
+
+def measure(num_pieces, num_peers):
+	""" [{'component', 'pieces', 'peers', 'steady', 'peak', 'rss'}] of one torrent size and peer count """
+
+	results = []
+	content = build_metainfo(num_pieces)
+	started = not tracemalloc.is_tracing()
+	if started:
+		tracemalloc.start()
+
+	try:
+		with Measurement(results, 'metainfo', num_pieces, num_peers):
+			metainfo = TorrentMetainfo(content)
+
+		with Measurement(results, 'torrent', num_pieces, num_peers):
+			torrent = Torrent(None, metainfo)
+
+		with Measurement(results, 'peers', num_pieces, num_peers):
+			peers = [torrent.add_peer({'ip': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), 'port': 6881})
+				for i in range(num_peers)]
+
+		block = bytes(CONFIG['block_length'])
+		num_blocks = torrent.get_num_blocks(0)
+
+		with Measurement(results, 'piece_blocks', num_pieces, num_peers):
+			for (piece_index, peer) in zip(range(num_pieces), peers): # all but the last block of a piece each
+				peer.requested_piece = piece_index
+				torrent.piece_requests[piece_index] = [peer]
+				torrent.piece_blocks[piece_index] = dict((i * len(block), (block, peer)) for i in range(num_blocks - 1))
+				torrent.requested_pieces[piece_index] = 1
+
+		piece = bytes(PIECE_LENGTH)
+
+		with Measurement(results, 'complete_pieces', num_pieces, num_peers):
+			for piece_index in range(num_pieces):
+				torrent.piece_blocks[piece_index] = None
+				torrent.piece_requests[piece_index] = None
+				torrent.complete_pieces[piece_index] = piece
+			torrent.requested_pieces.setall(0)
+			torrent.have_pieces.setall(1)
+			torrent.num_complete = num_pieces
+
+	finally:
+		if started:
+			tracemalloc.stop()
+
+	return results
+
+
+def get_budget(result, budgets=BUDGETS):
+
+	(per_piece, per_peer, per_peer_piece) = budgets[result['component']]
+	(pieces, peers) = (result['pieces'], result['peers'])
+
+	return BUDGET_SLACK + per_piece * pieces + per_peer * peers + per_peer_piece * pieces * peers
+
+
+def check_budgets(results, budgets=BUDGETS):
+	""" a line for every component whose peak went over its budget """
+
+	return ['%s at %d pieces, %d peers: peak %d bytes, budget %d' % (r['component'], r['pieces'], r['peers'],
+		r['peak'], get_budget(r, budgets)) for r in results if r['peak'] > get_budget(r, budgets)]
+
+
+def main(argv=None):
+
+	parser = argparse.ArgumentParser(description='memory footprint of piece and peer state against budgets')
+	parser.add_argument('--pieces', type=int, nargs='+', default=[1000, 100000, 1000000])
+	parser.add_argument('--peers', type=int, nargs='+', default=[10, 1000, 10000])
+
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.WARNING)
+
+	print('%-16s %9s %7s %14s %14s %14s %10s %10s' % ('component', 'pieces', 'peers', 'steady', 'peak', 'rss',
+		'B/piece', 'B/peer'))
+
+	failures = []
+	for num_pieces in args.pieces:
+		for num_peers in args.peers:
+			results = measure(num_pieces, num_peers)
+			for r in results:
+				print('%-16s %9d %7d %14d %14d %14s %10.2f %10.1f' % (r['component'], num_pieces, num_peers,
+					r['steady'], r['peak'], r['rss'], r['steady'] / num_pieces, r['steady'] / num_peers))
+			failures += check_budgets(results)
+
+	for line in failures:
+		print('OVER BUDGET: ' + line)
+
+	return 1 if failures else 0
+
+
+if __name__=='__main__':
+	sys.exit(main())
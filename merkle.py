@@ -0,0 +1,79 @@
+"""
+SHA-256 merkle trees as used by BitTorrent v2 (BEP 52)
+
+Each file is hashed on its own: the leaves are the SHA-256 of its 16 KiB blocks (the last one may be short),
+padded with zero hashes to a power of two. A file's 'pieces root' is the root of that tree, and the 'piece
+layer' is the layer where each node covers one piece - what the metainfo lists, so a piece can be checked
+on its own, and with the leaf hashes each 16 KiB block can be checked as soon as it arrives.
+
+"""
+
+import hashlib
+
+BLOCK_SIZE = 2**14 # leaf size, fixed by the spec
+HASH_SIZE = 32
+
+_pad_hashes = [bytes(HASH_SIZE)] # _pad_hashes[d] is the root of a subtree of 2**d zero leaves
+
+
+def sha256(data):
+	return hashlib.sha256(data).digest()
+
+
+def pad_hash(depth):
+
+	while len(_pad_hashes) <= depth:
+		_pad_hashes.append(sha256(_pad_hashes[-1] * 2))
+
+	return _pad_hashes[depth]
+
+
+def next_power_of_two(n):
+	return 1 << max(0, n - 1).bit_length()
+
+
+def merkle_root(hashes, width=None, depth=0):
+	"""
+	Root of a tree whose bottom layer is `hashes`, padded out to `width` nodes (a power of two, defaults to
+	the smallest that fits) with the root of an all zero subtree `depth` levels high
+	"""
+
+	width = width or next_power_of_two(len(hashes))
+	layer = list(hashes)
+
+	while width > 1:
+		if len(layer) % 2:
+			layer.append(pad_hash(depth))
+		layer = [sha256(layer[i] + layer[i + 1]) for i in range(0, len(layer), 2)]
+		width //= 2
+		depth += 1
+
+	return layer[0] if layer else pad_hash(depth)
+
+
+def split_hashes(data):
+	return [data[i:i + HASH_SIZE] for i in range(0, len(data), HASH_SIZE)]
+
+
+def hash_blocks(data):
+	""" leaf hashes of a run of whole blocks (the last one may be short) """
+
+	return [sha256(data[i:i + BLOCK_SIZE]) for i in range(0, len(data), BLOCK_SIZE)]
+
+
+def get_file_tree(leaves, piece_length):
+	""" (pieces root, piece layer) of a file from its leaf hashes; the layer is empty for single piece files """
+
+	if not leaves:
+		return (None, b'')
+
+	leaves_per_piece = piece_length // BLOCK_SIZE
+
+	if len(leaves) <= leaves_per_piece:
+		return (merkle_root(leaves), b'')
+
+	layer = [merkle_root(leaves[i:i + leaves_per_piece], leaves_per_piece)
+		for i in range(0, len(leaves), leaves_per_piece)]
+	depth = leaves_per_piece.bit_length() - 1
+
+	return (merkle_root(layer, depth=depth), b''.join(layer))
@@ -1,20 +1,34 @@
 import logging
 import struct
 import bitarray
-import random
+
+import bencodepy
 
 from config import CONFIG
+from pex import EXTENDED_HANDSHAKE_ID, UT_PEX_ID
+from rate_limiter import TokenBucket
 
 
 log = logging.getLogger(__name__)
 
+PEER_STATES = ('new', 'connecting', 'active', 'stopped')
+
 class TorrentPeer():
 
 	""" This is a class that manages the operation relating to the interactions with a specific peer 
 		The actions will relate to the upload and download of a torrent 
+
+		__slots__ keeps the per-peer footprint fixed - a torrent can hold thousands of candidate peers
 	"""
 
-	def __init__(self, torrent, ip, port, peer_id=None):
+	__slots__ = ('torrent', 'ip', 'peer_id', 'port', 'conn', 'recv_buffer',
+				'is_started', 'conn_failed', 'am_choking', 'am_interested', 'peer_choking', 'peer_interested',
+				'peer_pieces', 'requested_piece', 'state', 'connected_at', 'bytes_received',
+				'requested_block', 'request_sent_at', 'timer', 'srtt', 'rttvar', 'stalls',
+				'download_limiter', 'upload_limiter', 'is_incoming', 'info_hash', 'supports_v2',
+				'pex_id', 'pex_sent', 'pex_received_at', 'has_bitfield')
+
+	def __init__(self, torrent, ip, port, peer_id=None, is_incoming=False):
 
 		self.torrent = torrent 
 		self.ip = ip
@@ -31,27 +45,108 @@ class TorrentPeer():
 		self.peer_choking = True 
 		self.peer_interested = False 
 
-		self.peer_pieces = [False for _ in range(len(self.torrent.metainfo.info['pieces']))]
+		# one bit per piece, which pieces the peer has (from the bitfield / have messages)
+		self.peer_pieces = bitarray.bitarray(len(self.torrent.metainfo.info['pieces']), endian='big')
+		self.peer_pieces.setall(0)
+		self.has_bitfield = False # peers without one tell us what they have with have messages, e.g. super-seeds
 		self.requested_piece = None 
 
+		# one of PEER_STATES - the torrent keeps a running count of peers in each state
+		self.state = 'new'
+
+		self.connected_at = None 
+		self.bytes_received = 0 # block payload bytes, for the throughput recorded in the peer cache
+
+		# the one outstanding block request, and its timeout
+		self.requested_block = None 
+		self.request_sent_at = None
+		self.timer = None
+
+		# smoothed round trip time of block requests (as in TCP's RTO calculation) - sets the request timeout
+		self.srtt = None
+		self.rttvar = None
+		self.stalls = 0 # requests that timed out
+
+		# per-peer TokenBuckets under the torrent's; only made once connected, the connection layer enforces them
+		self.download_limiter = None
+		self.upload_limiter = None
+
+		# it connected to us - the port is the remote end's ephemeral one, not worth dialling or caching
+		self.is_incoming = is_incoming
+
+		# set when the remote came in on a hybrid torrent's v2 info hash - the connection keeps using that one
+		self.info_hash = None
+		self.supports_v2 = False # the remote set the BEP 52 bit in its handshake, so it answers hash requests
+
+		# peer exchange: the remote's id for ut_pex messages (from its extended handshake, None if it has none),
+		# the addresses we have told it about, and when its last update came
+		self.pex_id = None
+		self.pex_sent = None
+		self.pex_received_at = None
+
 	def __repr__(self):
-		return ('TorrentPeer(ip={ip}, port={port})'.format(**self.__dict__))
+		return ('TorrentPeer(ip=%s, port=%s)' % (self.ip, self.port))
 
 	def connect(self):
+		self.set_state('connecting')
 		self.torrent.conn_man.connect_peer(self)
 
+	def get_throughput(self):
+		""" average download rate over the connection in bytes/sec """
+
+		if self.connected_at is None:
+			return 0.0
+
+		elapsed = self.torrent.conn_man.now() - self.connected_at
+		return self.bytes_received / elapsed if elapsed > 0 else 0.0
+
+	def reset(self):
+		""" forget the previous connection so the peer can be dialled again """
+
+		self.conn = None
+		self.recv_buffer = b''
+		self.is_started = False
+		self.conn_failed = False
+		self.am_choking = True
+		self.am_interested = False
+		self.peer_choking = True
+		self.peer_interested = False
+		self.requested_piece = None
+		self.connected_at = None
+		self.bytes_received = 0
+		self.requested_block = None
+		self.has_bitfield = False
+		self.supports_v2 = False
+		self.pex_id = None
+		self.pex_sent = None
+		self.pex_received_at = None
+		self.cancel_timer()
+		self.set_state('new')
+
+	def set_state(self, state):
+
+		old_state = self.state
+		self.state = state
+		self.torrent.handle_peer_state_change(self, old_state, state)
+
 	def run_download(self):
 
 		""" For a given peer, manage the flow of the downloading process - handshake, interest, request / disconnect, obtain """
 
+		if self.torrent.is_paused or self.is_backing_off():
+			return
+
 		if not self.is_started : # initiate contact 
 			self.send_handshake()
 
-		elif self.peer_choking: # show interest
-			self.send_message('interested')
+		elif self.torrent.is_seeding: # nothing to download - we only answer requests
+			return
+
+		elif self.peer_choking: # show interest (if the peer has something we need)
+			self.update_interest()
 
 		elif self.requested_piece is not None:  # meaning we already requested a piece 
-			pass # then patiently wait for it 
+			self.request_next_block(self.requested_piece) # no-op while a block request is outstanding
 
 		else: # ask for a piece 
 
@@ -59,41 +154,61 @@ class TorrentPeer():
 				piece = self._choose_next_piece()
 
 			except PeerNoUnrequestedPiecesError: # if  there are no pieces that we have not requested from this peer, then peer has been fully utilized. Move on
+				if not self.has_bitfield: # it may well announce more soon - a super-seed hands out one piece at a time
+					self.update_interest()
+					return
 				self.conn.disconnect()
 				self.torrent.handle_peer_stopped(self)
 				return 
 
 			self.requested_piece = piece 
-			self.torrent.piece_requests[piece].append(self) # add the peer to the list of peers from which that piece has been requested
-			self.request_next_block(piece,None)
+			self.torrent.handle_piece_requested(self, piece) # add the peer to the list of peers from which that piece has been requested
+			self.request_piece_hashes(piece)
+			self.request_next_block(piece)
 
 
 	def _choose_next_piece(self):
 
 		""" For a given peer, which piece to request from that peer """
 
-		num_pieces = len(self.torrent.metainfo.info['pieces'])
-
-		for i in range(num_pieces):
-			 # Pick a piece that 1. is not completed 2. is not already requested and 3. is available with that peer
-			if (not self.torrent.complete_pieces[i] and not self.torrent.piece_requests[i] and self.peer_pieces[i]):
-				return i
+		# pieces that are 1. not completed and 2. available with that peer
+		candidates = self.wanted_pieces()
 
-		candidates = []
-		for i in range(num_pieces):
-			if (not self.torrent.complete_pieces[i] and self.peer_pieces[i]):
-				candidates.append(i)
+		i = (candidates & ~self.torrent.requested_pieces).find(1) # 3. not already requested
+		if i >= 0:
+			return i
 
-		if not candidates:
+		if not candidates.any():
 			raise PeerNoUnrequestedPiecesError
 
-		return random.choice(candidates)
+		return self.torrent.rng.choice(list(candidates.search(1)))
+
+	def wanted_pieces(self):
+
+		""" Bitmap of the pieces this peer has that we still need """
+
+		return self.peer_pieces & ~self.torrent.have_pieces
+
+	def update_interest(self):
+
+		""" Send interested / not_interested when our interest in the peer changes """
+
+		interested = self.wanted_pieces().any()
+
+		if interested != self.am_interested:
+			self.am_interested = interested
+			self.send_message('interested' if interested else 'not_interested')
 
 	# ========= Workflow management functions below - Handle functions ========= #
 
 	def handle_connection_made(self,conn):
 		
 		self.conn = conn
+		self.connected_at = self.torrent.conn_man.now()
+
+		if self.download_limiter is None:
+			self.download_limiter = TokenBucket(CONFIG['peer_download_rate_limit'], parent=self.torrent.download_limiter)
+			self.upload_limiter = TokenBucket(CONFIG['peer_upload_rate_limit'], parent=self.torrent.upload_limiter)
 		log.info('%s: handle_connection_made ' % self) # log the information that a conn was made with this peer 
 		self.run_download()
 
@@ -102,6 +217,8 @@ class TorrentPeer():
 		log.info('%s: handle_connection_failed ' % self) # log the information that a conn with this peer has failed
 		self.conn_failed = True
 		self.conn = None
+		self.cancel_timer()
+		self.set_state('stopped')
 		self.torrent.handle_peer_stopped(self)
 
 	def handle_connection_lost(self):
@@ -109,6 +226,8 @@ class TorrentPeer():
 		log.info('%s: handle_connection_lost ' % self) # log the information that a conn with this peer is lost
 		self.conn_failed = True
 		self.conn = None
+		self.cancel_timer()
+		self.set_state('stopped')
 		self.torrent.handle_peer_stopped(self)
 
 
@@ -142,16 +261,138 @@ class TorrentPeer():
 		if self.conn:
 			self.conn.disconnect()
 		self.requested_piece = None
+		self.requested_block = None
+		self.cancel_timer()
 
 
 	def handle_handshake_ok(self):
 
+		if self.torrent.is_seeding:
+			self.start_seeding()
 		self.run_download()
 
+	def start_seeding(self):
+		""" tell the peer what we have - everything, or as a super-seed, one piece at a time """
+
+		if self.torrent.superseeder:
+			self.torrent.superseeder.handle_peer_started(self)
+			return
+
+		bits = self.torrent.have_pieces.copy()
+		bits.fill() # pad to a whole byte
+		self.send_message('bitfield', bitfield=bits.tobytes())
+
+	def handle_interested(self):
+
+		if self.torrent.is_seeding and self.am_choking: # a seed has no use for tit-for-tat
+			self.am_choking = False
+			self.send_message('unchoke')
+
+	def handle_request(self, piece_index, begin, length):
+
+		if self.am_choking:
+			return
+
+		superseeder = self.torrent.superseeder
+		if superseeder and not superseeder.may_serve(self, piece_index):
+			log.debug('%s: request for piece %d, which we have not revealed to it' % (self, piece_index))
+			return
+
+		block = self.torrent.get_block(piece_index, begin, length)
+		if block is None:
+			log.debug('%s: bad request piece=%d begin=%d length=%d' % (self, piece_index, begin, length))
+			return
+
+		self.send_message('piece', index=piece_index, begin=begin, block=block)
+		self.torrent.bytes_uploaded += len(block)
+
 	def handle_unchoke(self):
 
 		self.run_download()
 
+	def handle_choke(self):
+
+		# a choked peer drops our outstanding requests - give the piece back so someone else can fetch it
+		self.requested_block = None
+		self.cancel_timer()
+		self.torrent.release_piece(self)
+
+	def handle_block_received(self, piece_index, begin, length):
+
+		if piece_index != self.requested_piece or begin != self.requested_block:
+			return # late or unsolicited block
+
+		if length != self.torrent.get_block_length(piece_index, begin):
+			return # malformed - Torrent.handle_block drops it, and the request stays out until it times out
+
+		self.update_rtt(self.torrent.conn_man.now() - self.request_sent_at)
+		self.requested_block = None
+		self.cancel_timer()
+
+	def handle_request_timeout(self):
+
+		self.timer = None
+		self.stalls += 1
+		log.info('%s: request timed out: piece=%s begin=%s stalls=%d' % (self, self.requested_piece, self.requested_block, self.stalls))
+
+		self.requested_block = None
+		self.torrent.release_piece(self) # back to the picker, another peer can have it
+
+		if self.stalls >= CONFIG['max_request_stalls']:
+			log.info('%s: too many stalled requests, disconnecting' % self)
+			if self.conn:
+				self.conn.disconnect()
+			return
+
+		# sit out for a while before asking for anything else
+		self.timer = self.torrent.conn_man.call_later(self.get_request_timeout(), self.handle_stall_backoff_over)
+
+	def is_backing_off(self):
+		""" sitting out a stalled request - the timer is the backoff, not a request timeout, when no block is out """
+
+		return self.timer is not None and self.requested_block is None
+
+	def handle_stall_backoff_over(self):
+
+		self.timer = None
+		self.run_download()
+
+	# ========= Request timeout management ========= #
+
+	def update_rtt(self, rtt):
+
+		if self.srtt is None:
+			self.srtt = rtt
+			self.rttvar = rtt / 2
+		else:
+			self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - rtt)
+			self.srtt = 0.875*self.srtt + 0.125*rtt
+
+	def get_request_timeout(self):
+
+		if self.srtt is None:
+			return CONFIG['request_timeout_initial']
+
+		timeout = self.srtt + 4*self.rttvar
+		return min(max(timeout, CONFIG['request_timeout_min']), CONFIG['request_timeout_max'])
+
+	def cancel_timer(self):
+
+		if self.timer:
+			self.timer.cancel()
+			self.timer = None
+
+	def cancel_request(self):
+		""" another peer completed the piece - drop the request we have out for it """
+
+		if self.requested_block is not None and self.is_started and self.conn:
+			self.send_message('cancel', index=self.requested_piece, begin=self.requested_block,
+				length=self.torrent.get_block_length(self.requested_piece, self.requested_block))
+
+		self.requested_piece = None
+		self.requested_block = None
+		self.cancel_timer()
+
 	def handle_keepalive(self):
 		pass 
 
@@ -166,10 +407,25 @@ class TorrentPeer():
 	def send_handshake(self):
 
 		log.debug('%s: send_handshake' % self)
-		msg = self.build_handshake(self.torrent.metainfo.info_hash,CONFIG['peer_id'])
+		reserved = bytearray(8)
+		reserved[5] |= 0x10 # BEP 10 - we take extended messages
+		if self.torrent.metainfo.info.get('meta_version') == 2:
+			reserved[7] |= 0x10 # BEP 52 - we can talk v2, i.e. hash requests
+
+		msg = self.build_handshake(self.info_hash or self.torrent.metainfo.info_hash, CONFIG['peer_id'], bytes(reserved))
 
 		self.write_message(msg)
 
+	def send_extended_handshake(self):
+		""" BEP 10 - the extensions we take, and the message ids to send them on """
+
+		extensions = {}
+		if self.torrent.pex:
+			extensions[b'ut_pex'] = UT_PEX_ID
+
+		payload = bencodepy.encode({b'm': extensions, b'p': CONFIG['listen_port'], b'v': b'bt_sr_client'})
+		self.send_message('extended', ext_id=EXTENDED_HANDSHAKE_ID, payload=payload)
+
 
 	def send_message(self, msg_type, **params):
 
@@ -187,16 +443,31 @@ class TorrentPeer():
 		self.write_message(msg)
 
 
-	def request_next_block(self, piece_index, begin):
-		
-		piece_length = self.torrent.metainfo.get_piece_length(piece_length)
+	def request_next_block(self, piece_index):
 
-		begin = 0 if begin is None else begin + CONFIG['block_length']
-		# TODO: Understand why it is begin + block_length
-		
-		block_length = min(piece_length-begin, CONFIG['block_length'])
+		if self.requested_block is not None or self.peer_choking: # one request at a time, and only when unchoked
+			return
+
+		begin = self.torrent.get_next_block(piece_index)
+		if begin is None:
+			return
+
+		self.requested_block = begin
+		self.request_sent_at = self.torrent.conn_man.now()
+		self.send_message('request', index=piece_index, begin=begin, length=self.torrent.get_block_length(piece_index, begin))
+
+		self.cancel_timer()
+		self.timer = self.torrent.conn_man.call_later(self.get_request_timeout(), self.handle_request_timeout)
+
+	def request_piece_hashes(self, piece_index):
+		""" v2: ask for the leaf hashes of the piece, so its blocks can be checked one by one as they come in """
 
-		self.send_message('request', index=piece_index, begin=begin, length=block_length)
+		if not self.supports_v2:
+			return
+
+		request = self.torrent.get_hash_request(piece_index)
+		if request:
+			self.send_message('hash_request', **request)
 		
 
 	# ========= Message Management SUB-Functions below ========= #
@@ -211,19 +482,35 @@ class TorrentPeer():
 		"""
 
 		pstrlen = int(data[0]) 
-		handshake_data = data[1:49+pstrlen]
-		handshake = self.decode_handshake(pstrlen, handshake_data)
+		if len(data) < 49+pstrlen: # wait for the rest of it
+			return 0
+
+		handshake = self.decode_handshake(data[:49+pstrlen])
 		
-		if handshake['pstr'] != 'BitTorrent protocol':
+		if handshake['pstr'] != b'BitTorrent protocol':
 			raise PeerProtocolError('Unrecognized protocol')
 
+		if handshake['info_hash'] != (self.info_hash or self.torrent.metainfo.info_hash):
+			raise PeerProtocolError('Info hash mismatch')
+
+		self.peer_id = handshake['peer_id']
+		self.supports_v2 = bool(handshake['reserved'][7] & 0x10)
+		if self.torrent.is_duplicate_peer(self): # already connected the other way round, or it's us
+			log.info('%s: duplicate connection, dropping it' % self)
+			self.conn.disconnect()
+			return len(data) # ignore whatever else is in the buffer
+
 		# Now, if, handshake is all good
 
 		self.is_started = True
+		self.set_state('active')
 		log.debug('%s: received_handshake' % self)
+
+		if handshake['reserved'][5] & 0x10:
+			self.send_extended_handshake()
 		self.handle_handshake_ok() # initiates the run download command 
 
-		return (1+len(handshake_data))
+		return 49+pstrlen
 
 	def parse_message(self, data):
 		
@@ -269,14 +556,16 @@ class TorrentPeer():
 		msg_id = msg_dict['msg_id']
 		payload = msg_dict['payload']
 
-		msg_types = ['choke','unchoke','interested','not_interested','have',
-					'bitfield','request','piece','cancel','port']
+		msg_types = {0:'choke', 1:'unchoke', 2:'interested', 3:'not_interested', 4:'have',
+					5:'bitfield', 6:'request', 7:'piece', 8:'cancel', 9:'port',
+					20:'extended', 21:'hash_request', 22:'hashes', 23:'hash_reject'}
 
-		msg_type = msg_types[msg_id]
+		msg_type = msg_types.get(msg_id)
 
 
-		log.debug('%s: receive_msg: id=%s type=%s payload=%s%s' % (self, msg_id,msg_type,
-			''.join('%02X' % v for v in payload[:40]),  '...' if len(payload)>64 else '' ) )
+		if log.isEnabledFor(logging.DEBUG): # formatting the payload is too costly to do for every block
+			log.debug('%s: receive_msg: id=%s type=%s payload=%s%s' % (self, msg_id,msg_type,
+				''.join('%02X' % v for v in payload[:40]),  '...' if len(payload)>64 else '' ) )
 		# the 4th and the 5th string specifier log the payload string. 
 		# 4th
 		# %02x means if your provided value is less than two digits then 0 will be prepended.
@@ -288,6 +577,7 @@ class TorrentPeer():
 		if msg_id == 0:
 			assert(msg_type=='choke')
 			self.peer_choking = True
+			self.handle_choke()
 
 		elif msg_id == 1: 
 			assert(msg_type=='unchoke')
@@ -297,58 +587,118 @@ class TorrentPeer():
 		elif msg_id == 2:
 			assert(msg_type=='interested')
 			self.peer_interested = True
+			self.handle_interested()
 
 		elif msg_id == 3:
 			assert(msg_type=='not_interested')
 			self.peer_interested = False
 
 		elif msg_id == 4:
-			assert('msg_type'=='have')
+			assert(msg_type=='have')
 			(index,) = struct.unpack('!L',payload)
-			self.peer_pieces[index] = True
+			if index >= len(self.peer_pieces):
+				raise PeerProtocolError('Have index out of range: %s' % index)
+			is_new = not self.peer_pieces[index]
+			self.peer_pieces[index] = 1
+			self.update_interest()
+			if self.am_interested and not self.peer_choking and self.requested_piece is None: # already unchoked
+				self.run_download()
+			if self.torrent.superseeder:
+				self.torrent.superseeder.handle_have(self, index, is_new)
 
 		elif msg_id == 5:
-			assert('msg_type'=='bitfield')
+			assert(msg_type=='bitfield')
 			bitfield = payload 
 			ba = bitarray.bitarray(endian='big')
 			ba.frombytes(bitfield)
-			num_pieces = len(self.torrent.metainfo.info['pieces'])
+			num_pieces = len(self.peer_pieces)
+
+			if len(ba) < num_pieces:
+				raise PeerProtocolError('Bitfield too short: %d bits' % len(ba))
 
 			# note: the bitfield message is only sent once after the handshake 
-			self.peer_pieces = ba.tolist()[:num_pieces] 
+			del ba[num_pieces:] # drop the spare bits at the end of the last byte
+			(old_pieces, self.peer_pieces) = (self.peer_pieces, ba)
+			self.has_bitfield = True
 			# through this we are storing the information as to which pieces the peer has 
+			self.update_interest()
+			if self.torrent.superseeder:
+				self.torrent.superseeder.handle_bitfield(self, old_pieces)
 
 		elif msg_id == 6:
-			assert('msg_type'=='request')
-			 # TODO - confirm if understanding is right 
-			 # since the peer is requesting for a piece, we don't care, since we are building a one way download client 
+			assert(msg_type=='request')
+			(index, begin, length) = struct.unpack('!LLL', payload)
+			self.handle_request(index, begin, length) # only served by seeds - a downloading torrent keeps its peers choked
 
 		elif msg_id == 7:
-		 	assert('msg_type'=='piece')
+		 	assert(msg_type=='piece')
 		 	(index,begin) = struct.unpack('!LL',payload[:8])
 		 	block = payload[8:]
+		 	self.bytes_received += len(block)
+		 	self.handle_block_received(index, begin, len(block))
 		 	self.torrent.handle_block(self, index, begin, block)
 
 		elif msg_id == 8:
-	 		assert('msg_type'=='cancel')
+	 		assert(msg_type=='cancel')
 
 		elif msg_id == 9:
- 			assert('msg_type'=='port')
+ 			assert(msg_type=='port')
+
+		elif msg_id == 20:
+			assert(msg_type=='extended')
+			if not payload:
+				raise PeerProtocolError('Empty extended message')
+			self.handle_extended(payload[0], payload[1:])
+
+		elif msg_id == 21:
+			assert(msg_type=='hash_request')
+			# we don't serve hashes (or pieces) - say so, rather than leave the peer waiting
+			params = self.decode_hash_request(payload)
+			self.send_message('hash_reject', **params)
+
+		elif msg_id == 22:
+			assert(msg_type=='hashes')
+			params = self.decode_hash_request(payload)
+			hashes = payload[48:]
+			self.torrent.handle_hashes(self, params, [hashes[i:i+32] for i in range(0, len(hashes), 32)])
+
+		elif msg_id == 23:
+			assert(msg_type=='hash_reject')
+			log.debug('%s: hash request rejected: %s' % (self, self.decode_hash_request(payload)))
 
 		else:
 			raise PeerProtocolMessageTypeError('Unrecognized message id: %s'% msg_id)
 
 
+	def handle_extended(self, ext_id, data):
+		""" BEP 10: id 0 is the extended handshake, the others are the ids we handed out in ours """
+
+		if ext_id == EXTENDED_HANDSHAKE_ID:
+			try:
+				extensions = bencodepy.decode(data).get(b'm', {})
+			except Exception:
+				raise PeerProtocolError('Bad extended handshake')
+
+			pex_id = extensions.get(b'ut_pex') if isinstance(extensions, dict) else None
+			self.pex_id = pex_id if isinstance(pex_id, int) and 0 < pex_id < 256 else None
+
+		elif ext_id == UT_PEX_ID and self.torrent.pex:
+			self.torrent.pex.handle_pex(self, data)
+
+		else:
+			log.debug('%s: unknown extended message %d' % (self, ext_id))
+
+
 	# ========= Static Functions below ========= #
 
 	@staticmethod
-	def build_handshake(info_hash, peer_id):
+	def build_handshake(info_hash, peer_id, reserved=bytes(8)):
 		""" 
 		A very COOL way to send a handshake in Bytes form (using Struct to pack it up like that)
 		Reqd. format of the message: <pstrlen><pstr><reserved><info_hash><peer_id>
 		pstrlen = 19 (length of pstr) [1byte]
 		pstr = BitTorrent protocol 
-		reserved = 8 bytes of zeros 
+		reserved = 8 bytes of extension bits, zeros by default
 		info_hash = 20bytes 
 		peer_id = 20bytes 
 		
@@ -357,8 +707,8 @@ class TorrentPeer():
 		"""
 
 		pstr = b'BitTorrent protocol'
-		fmt = "!B%ds8x20s20s" % len(pstr)
-		msg = struct.pack(fmt, len(pstr), pstr, info_hash, peer_id)
+		fmt = "!B%ds8s20s20s" % len(pstr)
+		msg = struct.pack(fmt, len(pstr), pstr, reserved, info_hash, peer_id)
 
 		return msg
 
@@ -371,11 +721,19 @@ class TorrentPeer():
 		
 
 		Payload Form: 
-		None of the messages carry a payload other than the request message
+		Have message payload : <len=0005><id=4><index>
+		Bitfield message payload : <len=0001+X><id=5><bitfield>
 		Request message payload : <len=0013><id=6><index><begin><length>
+		Piece message payload : <len=0009+X><id=7><index><begin><block>
+		Cancel message payload : <len=0013><id=8><index><begin><length>
 		index= integer 
 		begin= integer
 		length= integer
+
+		Extended message payload (BEP 10) : <extended message id><bencoded dict>
+
+		Hash request / reject payload (BEP 52) : <pieces_root><base_layer><index><length><proof_layers>
+		pieces_root = 32 bytes, the rest integers
 	
 
 		"""
@@ -397,9 +755,11 @@ class TorrentPeer():
 
 		elif msg_type == 'have':
 			msg_id = 4
+			payload = struct.pack('!L', params['index'])
 
 		elif msg_type == 'bitfield':
 			msg_id = 5
+			payload = params['bitfield']
 
 		elif msg_type == 'request':
 			msg_id = 6
@@ -407,13 +767,24 @@ class TorrentPeer():
 
 		elif msg_type == 'piece':
 			msg_id = 7
+			payload = struct.pack('!LL', params['index'], params['begin']) + params['block']
 
 		elif msg_type == 'cancel':
 			msg_id = 8
+			payload = struct.pack('!LLL', params['index'],params['begin'],params['length'])
 
 		elif msg_type == 'port':
 			msg_id = 9
 
+		elif msg_type == 'extended':
+			msg_id = 20
+			payload = struct.pack('!B', params['ext_id']) + params['payload']
+
+		elif msg_type in ('hash_request', 'hash_reject'):
+			msg_id = 21 if msg_type == 'hash_request' else 23
+			payload = struct.pack('!32sLLLL', params['pieces_root'], params['base_layer'], params['index'],
+				params['length'], params['proof_layers'])
+
 		else:
 			raise PeerProtocolMessageTypeError('Unrecognized message type: %s' % msg_type)
 
@@ -424,31 +795,50 @@ class TorrentPeer():
 
 		return msg
 
-		@staticmethod
-		def decode_message(data):
-			msg_id = int(data[0])
-			payload = data[1:]
+	@staticmethod
+	def decode_handshake(data):
+		pstrlen = int(data[0])
+		(pstr, reserved, info_hash, peer_id) = struct.unpack('!%ds8s20s20s' % pstrlen, data[1:49+pstrlen])
+
+		return {'pstr':pstr, 'reserved':reserved, 'info_hash':info_hash, 'peer_id':peer_id}
+
+	@staticmethod
+	def decode_message(data):
+		msg_id = int(data[0])
+		payload = data[1:]
+
+		return {'msg_id':msg_id, 'payload':payload}
+
+	@staticmethod
+	def decode_hash_request(payload):
+		""" the fields hash request, hashes and hash reject messages start with """
+
+		if len(payload) < 48:
+			raise PeerProtocolError('Hash message too short: %d bytes' % len(payload))
+
+		(pieces_root, base_layer, index, length, proof_layers) = struct.unpack('!32sLLLL', payload[:48])
 
-			return {'msg_id':msg_id, 'payload':payload}
+		return {'pieces_root':pieces_root, 'base_layer':base_layer, 'index':index, 'length':length,
+			'proof_layers':proof_layers}
 
 
-	class AnnounceFailureError(Exception):
-		pass
+class AnnounceFailureError(Exception):
+	pass
 
-	class AnnounceDecodeError(Exception):
-		pass
+class AnnounceDecodeError(Exception):
+	pass
 
-	class PeerConnectionError(Exception):
-		pass
+class PeerConnectionError(Exception):
+	pass
 
-	class PeerProtocolError(Exception):
-		pass
+class PeerProtocolError(Exception):
+	pass
 
-	class PeerProtocolMessageTypeError(Exception):
-		pass
+class PeerProtocolMessageTypeError(Exception):
+	pass
 
-	class PeerNoUnrequestedPiecesError(Exception):
-		pass
+class PeerNoUnrequestedPiecesError(Exception):
+	pass
 
 
 
@@ -0,0 +1,129 @@
+"""
+Persistent cache of peers that worked well, kept per info hash
+
+On startup the best cached peers are dialled straight away, in parallel with the tracker announce,
+so a restart doesn't have to wait for (or depend on) the tracker before the first block arrives
+
+One JSON file per torrent in CONFIG['peer_cache_dir']:
+	{"ip:port": {"ip":.., "port":.., "last_seen":.., "throughput":.., "failures":.., "stalls":..}, ...}
+
+"""
+
+import json
+import logging
+import os
+import time
+
+from config import CONFIG
+
+log = logging.getLogger(__name__)
+
+
+class PeerCache():
+
+	def __init__(self, cache_dir=None, clock=time.time):
+
+		self.cache_dir = os.path.expanduser(cache_dir or CONFIG['peer_cache_dir'])
+		self.clock = clock
+		self.entries = {} # info_hash -> {'ip:port': record}
+		self.dirty = set() # info hashes with unsaved changes
+
+	def _path(self, info_hash):
+		return os.path.join(self.cache_dir, info_hash.hex() + '.json')
+
+	def _get_entries(self, info_hash):
+
+		if info_hash not in self.entries:
+			self.entries[info_hash] = self._load(info_hash)
+
+		return self.entries[info_hash]
+
+	def _load(self, info_hash):
+
+		try:
+			with open(self._path(info_hash), 'r') as f:
+				return json.load(f)
+		except FileNotFoundError:
+			return {}
+		except ValueError:
+			log.warning('peer cache: ignoring corrupt file %s' % self._path(info_hash))
+			return {}
+
+	def _get_record(self, info_hash, ip, port):
+
+		entries = self._get_entries(info_hash)
+		key = '%s:%s' % (ip, port)
+
+		if key not in entries:
+			entries[key] = {'ip': ip, 'port': port, 'last_seen': 0, 'throughput': 0.0, 'failures': 0, 'stalls': 0}
+
+		self.dirty.add(info_hash)
+		return entries[key]
+
+	def record_success(self, info_hash, ip, port, throughput, stalls=0):
+		""" throughput in bytes/sec; smoothed so one slow session doesn't wipe out a good history.
+		stalls - block requests that timed out during the session """
+
+		record = self._get_record(info_hash, ip, port)
+		record['last_seen'] = self.clock()
+		record['failures'] = 0
+		record['stalls'] = stalls
+
+		if record['throughput']:
+			record['throughput'] = 0.5*record['throughput'] + 0.5*throughput
+		else:
+			record['throughput'] = throughput
+
+	def record_failure(self, info_hash, ip, port):
+
+		record = self._get_record(info_hash, ip, port)
+		record['failures'] += 1
+
+	def forget(self, info_hash, ip, port):
+		""" e.g. a banned peer - never dial it again """
+
+		if self._get_entries(info_hash).pop('%s:%s' % (ip, port), None):
+			self.dirty.add(info_hash)
+
+	def score(self, record):
+		""" prefer fast, recently seen peers that don't fail or stall """
+
+		age = max(0, self.clock() - record['last_seen'])
+		freshness = 1.0 - min(1.0, age / CONFIG['peer_cache_max_age'])
+
+		return (1.0 + record['throughput']) * freshness / (1 + record['failures'] + record.get('stalls', 0))
+
+	def get_best_peers(self, info_hash, limit):
+		""" peer dicts (as accepted by Torrent.add_peer) of the best cached peers """
+
+		records = [r for r in self._get_entries(info_hash).values() if self._is_usable(r)]
+		records.sort(key=self.score, reverse=True)
+
+		return [{'ip': r['ip'], 'port': r['port']} for r in records[:limit]]
+
+	def _is_usable(self, record):
+		""" only peers that have actually sent us data are worth keeping """
+
+		return (record['last_seen'] and record['failures'] < CONFIG['peer_cache_max_failures'] and
+				self.clock() - record['last_seen'] < CONFIG['peer_cache_max_age'])
+
+	def save(self, info_hash):
+
+		if info_hash not in self.dirty:
+			return
+
+		# only keep the best entries, the rest would never be dialled
+		records = [r for r in self._get_entries(info_hash).values() if self._is_usable(r)]
+		records.sort(key=self.score, reverse=True)
+		entries = {'%s:%s' % (r['ip'], r['port']): r for r in records[:CONFIG['peer_cache_size']]}
+		self.entries[info_hash] = entries
+
+		os.makedirs(self.cache_dir, exist_ok=True)
+		tmp_path = self._path(info_hash) + '.tmp'
+
+		with open(tmp_path, 'w') as f:
+			json.dump(entries, f)
+		os.replace(tmp_path, self._path(info_hash)) # never leave a half written cache behind
+
+		self.dirty.discard(info_hash)
+		log.debug('peer cache: saved %d peers for %s' % (len(entries), info_hash.hex()))
@@ -0,0 +1,132 @@
+"""
+Incoming peer connections, for every torrent of the session, on one port
+
+The connection manager listens on CONFIG['listen_port'] (TCP, and uTP on the same UDP port) and gives each
+new connection an IncomingHandshake as its peer. Once the remote's handshake is in, its info hash is looked up
+in the listener's index of torrents and the connection is handed over to a TorrentPeer of that torrent -
+if the torrent takes it: incoming peers count against the same max_peers as the ones we dial, and banned or
+duplicate peers are turned away. Addresses on the session's blocklist are dropped before their handshake.
+
+"""
+
+import logging
+
+from config import CONFIG
+from peer import TorrentPeer
+
+log = logging.getLogger(__name__)
+
+
+class PeerListener():
+
+	def __init__(self, conn_man, blocklist=None):
+
+		self.conn_man = conn_man
+		self.blocklist = blocklist # the session's IPBlocklist
+		self.torrents = {} # info_hash -> Torrent
+
+	def add_torrent(self, torrent):
+		for info_hash in self.get_info_hashes(torrent):
+			self.torrents[info_hash] = torrent
+
+	def remove_torrent(self, torrent):
+		for info_hash in self.get_info_hashes(torrent):
+			self.torrents.pop(info_hash, None)
+
+	@staticmethod
+	def get_info_hashes(torrent):
+		""" a hybrid torrent (BEP 52) is in two swarms, and peers of either may connect """
+
+		info_hashes = [torrent.metainfo.info_hash]
+		info_hash_v2 = getattr(torrent.metainfo, 'info_hash_v2', None)
+		if info_hash_v2 and info_hash_v2[:20] not in info_hashes:
+			info_hashes.append(info_hash_v2[:20])
+
+		return info_hashes
+
+	def accept(self, conn):
+		""" the peer for a new incoming connection, until we know which torrent it is for """
+
+		return IncomingHandshake(self)
+
+	def dispatch(self, incoming, handshake):
+
+		torrent = self.torrents.get(handshake['info_hash'])
+		(ip, port) = incoming.conn.get_address()
+
+		if handshake['pstr'] != b'BitTorrent protocol' or torrent is None:
+			log.debug('incoming %s:%s: unknown protocol or torrent' % (ip, port))
+			incoming.conn.disconnect()
+			return
+
+		peer = torrent.accept_peer(ip, port, handshake['peer_id'])
+		if peer is None:
+			incoming.conn.disconnect()
+			return
+
+		peer.info_hash = handshake['info_hash'] # answer on the hash it came in on
+
+		recorder = getattr(self.conn_man, 'recorder', None)
+		if recorder:
+			peer = recorder.wrap(peer)
+
+		conn = incoming.conn
+		conn.peer = peer
+		peer.handle_connection_made(conn) # answers with our handshake
+		peer.handle_data_received(incoming.recv_buffer) # starting with theirs
+
+
+class IncomingHandshake():
+
+	""" stands in for the peer on a new connection while we wait for the remote's handshake """
+
+	__slots__ = ('listener', 'conn', 'recv_buffer', 'timer')
+
+	download_limiter = None
+	upload_limiter = None
+
+	def __init__(self, listener):
+
+		self.listener = listener
+		self.conn = None
+		self.recv_buffer = b''
+		self.timer = None
+
+	def handle_connection_made(self, conn):
+
+		self.conn = conn
+
+		blocklist = self.listener.blocklist
+		if blocklist and blocklist.is_blocked(conn.get_address()[0]):
+			log.debug('incoming %s:%s: blocklisted' % conn.get_address())
+			blocklist.num_blocked += 1
+			conn.disconnect()
+			return
+
+		self.timer = self.listener.conn_man.call_later(CONFIG['handshake_timeout'], self.handle_timeout)
+
+	def handle_data_received(self, data):
+
+		self.recv_buffer += data
+		if len(self.recv_buffer) < 49 + self.recv_buffer[0]:
+			return
+
+		self.cancel_timer()
+		self.listener.dispatch(self, TorrentPeer.decode_handshake(self.recv_buffer))
+
+	def handle_timeout(self):
+
+		self.timer = None
+		self.conn.disconnect()
+
+	def handle_connection_lost(self):
+		self.cancel_timer()
+
+	def handle_connection_failed(self):
+		self.cancel_timer()
+
+	def cancel_timer(self):
+
+		if self.timer:
+			self.timer.cancel()
+			self.timer = None
@@ -0,0 +1,371 @@
+"""
+Record-and-replay of peer sessions
+
+Recording: with CONFIG['trace_dir'] set (--trace-dir), the connection layer wraps every peer it connects
+(or accepts) in a RecordingPeer, which writes one trace file per connection: when it was made, every chunk
+of bytes received and sent, and how it ended, timestamped on the session clock.
+
+	header:  'BTTRACE1' started(double) info_hash(20s) port(H) flags(B) ip_length(B) ip
+	records: time since started(double) kind(B) length(L) data
+
+Replay: ReplayConnectionManager stands in for the real one (like the simulator's) and plays the received
+bytes of the traces back into Torrent and TorrentPeer at the recorded times - paced to the wall clock, or
+as fast as possible on the virtual clock, so parsing, block assembly and piece picking can be profiled
+offline against real swarms. What our side sends is only counted: the remote's replies are canned, so a
+replay follows the recorded session only as far as our client behaves the same way.
+
+	python peer_trace.py downloads/x.torrent traces/ [--speed 1] [--profile]
+
+"""
+
+import argparse
+import cProfile
+import glob
+import logging
+import os
+import pstats
+import struct
+import time
+
+from simulator import VirtualClock
+from torrent import Torrent
+from torrent_metainfo import TorrentMetainfo
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'BTTRACE1'
+HEADER = '!d20sHBB'
+RECORD = '!dBL'
+
+CONNECTED, RECEIVED, SENT, LOST, FAILED = range(5)
+FLAG_INCOMING = 0x01
+
+
+class TraceRecorder():
+
+	def __init__(self, trace_dir, clock=time.time):
+
+		self.trace_dir = os.path.expanduser(trace_dir)
+		self.clock = clock
+		self.num_traces = 0
+		os.makedirs(self.trace_dir, exist_ok=True)
+
+	def wrap(self, peer):
+		""" the peer, as the connection layer should see it - everything it is told and sends gets recorded """
+
+		self.num_traces += 1
+		info_hash = peer.info_hash or peer.torrent.metainfo.info_hash
+		path = os.path.join(self.trace_dir, '%s-%s-%d-%d.trace' % (info_hash.hex()[:16], peer.ip, peer.port,
+			self.num_traces))
+
+		return RecordingPeer(peer, TraceWriter(path, info_hash, peer.ip, peer.port, peer.is_incoming, self.clock))
+
+
+class TraceWriter():
+
+	def __init__(self, path, info_hash, ip, port, is_incoming, clock):
+
+		self.clock = clock
+		self.started = clock()
+		self.f = open(path, 'wb')
+
+		ip = ip.encode('ascii')
+		self.f.write(MAGIC + struct.pack(HEADER, self.started, info_hash, port, FLAG_INCOMING if is_incoming else 0,
+			len(ip)) + ip)
+
+	def record(self, kind, data=b''):
+
+		if self.f:
+			self.f.write(struct.pack(RECORD, self.clock() - self.started, kind, len(data)))
+			self.f.write(data)
+
+	def close(self):
+
+		if self.f:
+			self.f.close()
+			self.f = None
+
+
+class RecordingPeer():
+
+	""" stands in for a TorrentPeer at the connection layer: records, then passes everything on """
+
+	def __init__(self, peer, trace):
+
+		self.peer = peer
+		self.trace = trace
+
+	def __getattr__(self, name): # ip, port, limiters, ... come from the real peer
+		return getattr(self.peer, name)
+
+	def handle_connection_made(self, conn):
+
+		self.trace.record(CONNECTED)
+		self.peer.handle_connection_made(RecordingConnection(conn, self.trace))
+
+	def handle_data_received(self, data):
+
+		self.trace.record(RECEIVED, data)
+		self.peer.handle_data_received(data)
+
+	def handle_connection_lost(self):
+
+		self.trace.record(LOST)
+		self.trace.close()
+		self.peer.handle_connection_lost()
+
+	def handle_connection_failed(self):
+
+		self.trace.record(FAILED)
+		self.trace.close()
+		self.peer.handle_connection_failed()
+
+
+class RecordingConnection():
+
+	def __init__(self, conn, trace):
+
+		self.conn = conn
+		self.trace = trace
+
+	def __getattr__(self, name):
+		return getattr(self.conn, name)
+
+	def write(self, data):
+
+		self.trace.record(SENT, data)
+		self.conn.write(data)
+
+	def disconnect(self):
+		""" our side ended it - the session is over, whenever the transport gets round to reporting it """
+
+		self.trace.record(LOST)
+		self.trace.close()
+		self.conn.disconnect()
+
+
+def read_trace(path):
+	""" (header dict, [(time, kind, data)]) """
+
+	with open(path, 'rb') as f:
+		contents = f.read()
+
+	if not contents.startswith(MAGIC):
+		raise TraceFormatError('%s: not a trace file' % path)
+
+	pos = len(MAGIC)
+	(started, info_hash, port, flags, ip_length) = struct.unpack_from(HEADER, contents, pos)
+	pos += struct.calcsize(HEADER)
+	ip = contents[pos:pos + ip_length].decode('ascii')
+	pos += ip_length
+
+	header = {'started': started, 'info_hash': info_hash, 'ip': ip, 'port': port,
+		'is_incoming': bool(flags & FLAG_INCOMING)}
+
+	events = []
+	record_size = struct.calcsize(RECORD)
+	while pos + record_size <= len(contents):
+		(t, kind, length) = struct.unpack_from(RECORD, contents, pos)
+		pos += record_size
+		events.append((t, kind, contents[pos:pos + length]))
+		pos += length
+
+	return (header, events)
+
+
+def load_traces(trace_dir, info_hash=None):
+	""" [(header, events)] of the traces in the directory, oldest first """
+
+	traces = [read_trace(path) for path in glob.glob(os.path.join(os.path.expanduser(trace_dir), '*.trace'))]
+	traces = [t for t in traces if info_hash is None or t[0]['info_hash'] == info_hash]
+
+	return sorted(traces, key=lambda t: t[0]['started'])
+
+
+class ReplayConnectionManager():
+
+	""" Drop-in replacement for ConnectionManagerTwisted that answers with recorded sessions """
+
+	def __init__(self, traces, speed=None):
+		"""
+		Args:
+			traces - [(header, events)] from load_traces
+			speed - None to replay as fast as possible, 1.0 for real time, 2.0 for twice as fast...
+		"""
+
+		self.clock = VirtualClock(speed)
+		self.traces = {} # (ip, port) -> events of the next recorded connection to that address
+		self.incoming = []
+		self.connections = []
+
+		for (header, events) in traces:
+			if header['is_incoming']:
+				self.incoming.append((header, events))
+			else:
+				self.traces.setdefault((header['ip'], header['port']), []).append(events)
+
+		self.started = min([h['started'] for (h, _) in traces] or [0.0])
+
+	def replay(self, torrent):
+		""" give the torrent the recorded peers, and schedule the incoming connections """
+
+		for (header, events) in sorted(self.incoming, key=lambda t: t[0]['started']):
+			self.clock.call_later(header['started'] - self.started, self.accept, torrent, header, events)
+
+		for (ip, port) in self.traces:
+			torrent.add_peer({'ip': ip, 'port': port})
+
+	def accept(self, torrent, header, events):
+
+		peer = torrent.accept_peer(header['ip'], header['port'], None)
+		if peer:
+			self.connections.append(ReplayConnection(self, peer, events))
+
+	def connect_peer(self, peer):
+
+		recorded = self.traces.get((peer.ip, peer.port))
+
+		if not recorded:
+			self.clock.call_later(0, peer.handle_connection_failed)
+			return
+
+		self.connections.append(ReplayConnection(self, peer, recorded.pop(0)))
+
+	def run_in_thread(self, func, callback, errback):
+
+		def run():
+			try:
+				result = func()
+			except Exception as e:
+				errback(e)
+			else:
+				callback(result)
+
+		self.clock.call_later(0, run)
+
+	def call_later(self, delay, func, *args):
+		return self.clock.call_later(delay, func, *args)
+
+	def now(self):
+		return self.clock.now()
+
+	def start_event_loop(self):
+		self.clock.run()
+
+	def stop_event_loop(self):
+		self.clock.stop()
+
+
+class ReplayConnection():
+
+	""" feeds one recorded session to a peer, an event at a time """
+
+	def __init__(self, conn_man, peer, events):
+
+		self.conn_man = conn_man
+		self.peer = peer
+		self.events = events
+		self.next_event = 0
+		self.started = conn_man.now()
+		self.closed = False
+		self.bytes_written = 0 # what our side sent - not compared, the remote's replies are canned
+
+		self._schedule()
+
+	def _schedule(self):
+
+		if self.next_event < len(self.events):
+			at = self.started + self.events[self.next_event][0]
+			self.conn_man.call_later(at - self.conn_man.now(), self._play)
+
+	def _play(self):
+
+		if self.closed:
+			return
+
+		(_, kind, data) = self.events[self.next_event]
+		self.next_event += 1
+
+		if kind == CONNECTED:
+			self.peer.handle_connection_made(self)
+		elif kind == RECEIVED:
+			self.peer.handle_data_received(data)
+		elif kind == LOST:
+			self.closed = True
+			self.peer.handle_connection_lost()
+			return
+		elif kind == FAILED:
+			self.closed = True
+			self.peer.handle_connection_failed()
+			return
+
+		self._schedule()
+
+	def write(self, data):
+		self.bytes_written += len(data)
+
+	def disconnect(self):
+
+		if not self.closed:
+			self.closed = True
+			self.conn_man.call_later(0, self.peer.handle_connection_lost)
+
+	def get_address(self):
+		return (self.peer.ip, self.peer.port)
+
+
+def replay_main(argv=None):
+
+	parser = argparse.ArgumentParser(prog='replay', description='replay recorded peer sessions into a download')
+	parser.add_argument('torrent', help='.torrent metainfo file the traces were recorded for')
+	parser.add_argument('trace_dir')
+	parser.add_argument('--speed', type=float, help='1 for real time; as fast as possible when not given')
+	parser.add_argument('--profile', default=False, action='store_true', help='print the hottest functions')
+
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.WARNING)
+
+	with open(args.torrent, 'rb') as f:
+		metainfo = TorrentMetainfo(f.read())
+	metainfo.announce = None # no tracker or web seeds - the traces are the only peers
+	metainfo.url_list = []
+
+	traces = load_traces(args.trace_dir, metainfo.info_hash)
+	if not traces:
+		print('no traces for %s in %s' % (metainfo.info_hash.hex(), args.trace_dir))
+		return 1
+
+	conn_man = ReplayConnectionManager(traces, args.speed)
+	completed = []
+
+	def on_completed_torrent(torrent, data):
+		completed.append(conn_man.now())
+		conn_man.stop_event_loop()
+
+	torrent = Torrent(conn_man, metainfo, on_completed_torrent)
+	conn_man.replay(torrent)
+
+	profile = cProfile.Profile() if args.profile else None
+	started = time.time()
+
+	if profile:
+		profile.enable()
+	torrent.start_torrent()
+	conn_man.start_event_loop()
+	if profile:
+		profile.disable()
+
+	print('%d traces, completed=%s replay_time=%.1fs wall_time=%.2fs events=%d' % (len(traces), bool(completed),
+		completed[0] if completed else conn_man.now(), time.time() - started, conn_man.clock.num_events))
+	print(torrent.get_stats())
+
+	if profile:
+		pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+
+
+class TraceFormatError(Exception):
+	pass
+
+
+if __name__=='__main__':
+	replay_main()
@@ -0,0 +1,149 @@
+"""
+Peer exchange (BEP 11), carried by the extension protocol (BEP 10)
+
+Peers that set the extension bit in their handshake swap an extended handshake (extended message 0) that maps
+extension names to the message ids each side wants to receive them on. With ut_pex agreed, every
+CONFIG['pex_interval'] seconds each connected peer is sent the change in our connected set since the last
+message it got from us:
+
+	{'added': <6 bytes per peer, ip + port>, 'added.f': <a flags byte per added peer>, 'dropped': <6 bytes per peer>}
+
+and what peers send us goes into the torrent's candidate pool, keeping it full of addresses that somebody
+actually reached, without asking the tracker. Both directions are rate limited: at most MAX_PEX_PEERS
+addresses each way per message, and messages that come faster than CONFIG['pex_min_interval'] are dropped.
+Private torrents (BEP 27) get no PEX.
+
+"""
+
+import logging
+import socket
+import struct
+
+import bencodepy
+
+from config import CONFIG
+
+log = logging.getLogger(__name__)
+
+EXTENDED_HANDSHAKE_ID = 0
+UT_PEX_ID = 1 # the id we ask peers to send ut_pex messages on
+MAX_PEX_PEERS = 50 # added (and dropped) per message, as BEP 11 asks
+PEX_FLAG_REACHABLE = 0x10 # we only pass on peers we dialled, so they take incoming connections
+
+
+def encode_peers(addresses):
+
+	return b''.join(socket.inet_aton(ip) + struct.pack('!H', port) for (ip, port) in addresses)
+
+
+def decode_peers(data):
+
+	if len(data) % 6:
+		raise PEXMessageError('compact peers length %d' % len(data))
+
+	return [(socket.inet_ntoa(data[i:i+4]), struct.unpack('!H', data[i+4:i+6])[0]) for i in range(0, len(data), 6)]
+
+
+def build_pex(added, dropped):
+
+	return bencodepy.encode({
+		b'added': encode_peers(added),
+		b'added.f': bytes([PEX_FLAG_REACHABLE]) * len(added),
+		b'dropped': encode_peers(dropped)
+	})
+
+
+def parse_pex(data):
+	""" ([(ip, port)] added, [(ip, port)] dropped) - IPv4 only, added6/dropped6 are ignored """
+
+	try:
+		msg = bencodepy.decode(data)
+	except Exception:
+		raise PEXMessageError('not bencoded')
+
+	if not isinstance(msg, dict):
+		raise PEXMessageError('not a dict')
+
+	return (decode_peers(msg.get(b'added', b'')), decode_peers(msg.get(b'dropped', b'')))
+
+
+class PeerExchange():
+
+	""" one per torrent - sends the periodic ut_pex updates and takes in the ones peers send """
+
+	def __init__(self, torrent, interval=None):
+
+		self.torrent = torrent
+		self.interval = interval or CONFIG['pex_interval']
+		self.timer = None
+		self.num_received = 0 # new addresses learned from peers, for the stats
+
+	def start(self):
+
+		if not self.timer:
+			self.timer = self.torrent.conn_man.call_later(self.interval, self.tick)
+
+	def stop(self):
+
+		if self.timer:
+			self.timer.cancel()
+			self.timer = None
+
+	def tick(self):
+
+		self.timer = None
+
+		if (self.torrent.is_complete and not self.torrent.is_seeding) or self.torrent.is_paused:
+			return
+
+		connected = self.get_connected()
+		for p in self.torrent.peers:
+			if p.state == 'active' and p.pex_id:
+				self.send_update(p, connected)
+
+		self.start()
+
+	def get_connected(self):
+		""" addresses worth passing on: active peers we dialled - an incoming peer's port is not one it listens on """
+
+		return set((p.ip, p.port) for p in self.torrent.peers if p.state == 'active' and not p.is_incoming)
+
+	def send_update(self, peer, connected):
+
+		sent = peer.pex_sent or set()
+		current = connected - {(peer.ip, peer.port)}
+
+		added = sorted(current - sent)[:MAX_PEX_PEERS]
+		dropped = sorted(sent - current)[:MAX_PEX_PEERS]
+
+		if not added and not dropped:
+			return
+
+		peer.send_message('extended', ext_id=peer.pex_id, payload=build_pex(added, dropped))
+		peer.pex_sent = (sent | set(added)) - set(dropped)
+
+	def handle_pex(self, peer, data):
+
+		now = self.torrent.conn_man.now()
+		if peer.pex_received_at is not None and now - peer.pex_received_at < CONFIG['pex_min_interval']:
+			log.debug('%s: ut_pex too soon, ignored' % peer)
+			return
+		peer.pex_received_at = now
+
+		try:
+			(added, _) = parse_pex(data)
+		except PEXMessageError as e:
+			log.debug('%s: bad ut_pex message: %s' % (peer, e))
+			return
+
+		# dropped peers stay in the pool - one peer losing a connection says little about the address
+		num_peers = len(self.torrent.peers)
+		for peer_dict in self.torrent.filter_peers([{'ip': ip, 'port': port} for (ip, port) in added[:MAX_PEX_PEERS]]):
+			self.torrent.add_peer(peer_dict)
+		self.num_received += len(self.torrent.peers) - num_peers
+
+		self.torrent.fill_peer_slots()
+
+
+class PEXMessageError(Exception):
+	pass
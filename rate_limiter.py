@@ -0,0 +1,83 @@
+"""
+Token bucket rate limiting, in a session -> torrent -> peer hierarchy
+
+Each bucket has its own rate (bytes/sec, 0 = unlimited) and a parent; a transfer is charged to the bucket and
+all of its ancestors, so it has to fit under every limit on the way up. Buckets are allowed to go into debt:
+consume() always succeeds and returns how long the caller should wait before the next transfer. The connection
+layer turns that into paused socket reads and deferred writes, so throttling never sleeps or spins.
+
+"""
+
+import time
+
+from config import CONFIG
+
+
+class TokenBucket():
+
+	__slots__ = ('rate', 'burst', 'tokens', 'parent', 'clock', 'last_update', 'total_bytes')
+
+	def __init__(self, rate=0, burst=None, parent=None, clock=None):
+		"""
+		Args:
+			rate - bytes/sec, 0 for unlimited
+			burst - bucket size in bytes; defaults to a second's worth (at least two blocks)
+			parent - bucket that is charged as well, e.g. the torrent's bucket for a peer's
+			clock - time source; defaults to the parent's clock
+		"""
+
+		self.parent = parent
+		self.clock = clock or (parent.clock if parent else time.monotonic)
+		self.total_bytes = 0
+		self.set_rate(rate, burst)
+
+	def set_rate(self, rate, burst=None):
+		""" can be changed at any time, e.g. from the daemon's control API """
+
+		self.rate = rate
+		self.burst = burst or max(rate, 2*CONFIG['block_length'])
+		self.tokens = self.burst
+		self.last_update = self.clock()
+
+	def _refill(self):
+
+		now = self.clock()
+		if self.rate:
+			self.tokens = min(self.burst, self.tokens + (now - self.last_update) * self.rate)
+		self.last_update = now
+
+	def _own_delay(self):
+
+		if not self.rate:
+			return 0.0
+
+		self._refill()
+		return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+	def get_delay(self):
+		""" seconds until this bucket and all its ancestors are out of debt """
+
+		delay = 0.0
+		bucket = self
+		while bucket:
+			delay = max(delay, bucket._own_delay())
+			bucket = bucket.parent
+
+		return delay
+
+	def consume(self, nbytes):
+		""" charge a transfer to the whole chain; returns the delay before the next transfer """
+
+		bucket = self
+		while bucket:
+			bucket._refill()
+			bucket.total_bytes += nbytes
+			if bucket.rate:
+				bucket.tokens -= nbytes
+			bucket = bucket.parent
+
+		return self.get_delay()
+
+	def get_stats(self):
+
+		return {'rate_limit': self.rate, 'bytes': self.total_bytes}
@@ -0,0 +1,483 @@
+"""
+Deterministic swarm simulator
+
+Torrent and TorrentPeer only reach the network through conn_man (connect_peer, call_later, now, ...) and the
+peer's handle_* callbacks. SimConnectionManager plugs in at that seam: simulated remote peers speak the real
+wire protocol over in-memory connections, and everything is driven by a virtual clock, so a run is exactly
+reproducible from its seed and takes as long as the CPU work, not the simulated transfer time.
+
+Used to measure picker / pipelining / scheduling changes at scales a loopback test can't reach:
+
+	python simulator.py --pieces 100000 --peers 2000 --seed 1
+
+"""
+
+import argparse
+import hashlib
+import heapq
+import ipaddress
+import logging
+import random
+import struct
+import time
+
+import bitarray
+
+from config import CONFIG
+from peer import TorrentPeer
+from torrent import Torrent
+
+log = logging.getLogger(__name__)
+
+CONNECT_FAILURE_DELAY = 3.0 # simulated seconds before a refused connection is reported
+
+
+class SimTimer():
+
+	__slots__ = ('func', 'args', 'cancelled')
+
+	def __init__(self, func, args):
+		self.func = func
+		self.args = args
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
+
+
+class VirtualClock():
+
+	""" Event queue with simulated time - call_later mirrors reactor.callLater """
+
+	def __init__(self, speed=None):
+		""" speed - None runs events as fast as possible; otherwise simulated seconds per wall clock second """
+
+		self.speed = speed
+		self.time = 0.0
+		self.events = []
+		self.seq = 0
+		self.num_events = 0
+		self.is_stopped = False
+
+	def now(self):
+		return self.time
+
+	def call_later(self, delay, func, *args):
+
+		timer = SimTimer(func, args)
+		# seq keeps same-time events in scheduling order (and the heap never has to compare timers)
+		heapq.heappush(self.events, (self.time + max(0.0, delay), self.seq, timer))
+		self.seq += 1
+
+		return timer
+
+	def run(self, until=None):
+		""" run events in time order until stopped, out of events, or past 'until' (simulated seconds) """
+
+		self.is_stopped = False
+		wall_start = time.time() - self.time / self.speed if self.speed else None
+
+		while self.events and not self.is_stopped:
+			event = heapq.heappop(self.events)
+			(at, _, timer) = event
+
+			if timer.cancelled:
+				continue
+
+			if until is not None and at > until:
+				heapq.heappush(self.events, event)
+				self.time = until
+				break
+
+			if wall_start is not None and wall_start + at / self.speed > time.time():
+				time.sleep(wall_start + at / self.speed - time.time())
+
+			self.time = at
+			self.num_events += 1
+			timer.func(*timer.args)
+
+	def stop(self):
+		self.is_stopped = True
+
+
+class SimMetainfo():
+
+	""" Stands in for TorrentMetainfo - piece data is derived from the seed, so it never has to be stored """
+
+	def __init__(self, num_pieces, piece_length, seed=0, last_piece_length=None):
+
+		self.seed = seed
+		self.announce = None # trackerless
+		self.name = 'sim-%d' % seed
+		self.info_hash = hashlib.sha1(b'sim:%d:%d:%d' % (seed, num_pieces, piece_length)).digest()
+
+		last_piece_length = last_piece_length or piece_length
+
+		self.info = {
+			'piece_length': piece_length,
+			'length': (num_pieces-1)*piece_length + last_piece_length,
+			'format': 'SINGLE_FILE',
+			'files': 'NONE'
+		}
+		self.info['pieces'] = [hashlib.sha1(self.get_piece_data(i)).digest() for i in range(num_pieces)]
+
+	def get_piece_length(self, indx):
+
+		num_pieces = len(self.info['pieces'])
+		if indx == num_pieces-1:
+			return self.info['length'] - ( (num_pieces-1)*self.info['piece_length'] )
+
+		return self.info['piece_length']
+
+	def get_piece_data(self, indx):
+
+		if indx == (self.info['length'] - 1) // self.info['piece_length']:
+			length = self.info['length'] - indx*self.info['piece_length']
+		else:
+			length = self.info['piece_length']
+
+		digest = hashlib.sha256(b'%d:%d' % (self.seed, indx)).digest()
+		return (digest * (length // len(digest) + 1))[:length]
+
+
+class SimPeer():
+
+	"""
+	A simulated remote peer. It only uploads, and its behaviour is set per peer:
+		bandwidth - upload rate in bytes/sec
+		latency - one way delay in seconds
+		pieces - bitarray of the pieces it has, or the fraction of pieces it should get at random
+		choke_prob - chance of choking us after each block; unchokes again after choke_duration
+		loss - chance of silently dropping a request
+		corrupt - chance of sending a damaged block
+		refuse - connection attempts fail
+		silent - accepts the connection but never unchokes
+	"""
+
+	def __init__(self, swarm, ip, port, rng, bandwidth=1e6, latency=0.05, pieces=1.0, choke_prob=0.0,
+			choke_duration=5.0, loss=0.0, corrupt=0.0, refuse=False, silent=False):
+
+		self.swarm = swarm
+		self.ip = ip
+		self.port = port
+		self.rng = rng
+		self.bandwidth = bandwidth
+		self.latency = latency
+		self.choke_prob = choke_prob
+		self.choke_duration = choke_duration
+		self.loss = loss
+		self.corrupt = corrupt
+		self.refuse = refuse
+		self.silent = silent
+
+		num_pieces = len(swarm.metainfo.info['pieces'])
+		self.pieces = pieces if isinstance(pieces, bitarray.bitarray) else self._random_pieces(num_pieces, pieces)
+
+		self.blocks_sent = 0
+		self.requests_dropped = 0
+
+	def _random_pieces(self, num_pieces, fraction):
+		""" each bit set with probability 'fraction' (to 1/256), built from a few bulk bitarray ops """
+
+		pieces = bitarray.bitarray(num_pieces, endian='big')
+		pieces.setall(1 if fraction >= 1.0 else 0)
+
+		if 0.0 < fraction < 1.0:
+			level = int(round(fraction * 256))
+			num_bytes = (num_pieces + 7) // 8
+
+			for bit in range(8): # least significant first: x = x|r for a 1 bit, x&r for a 0 bit
+				r = bitarray.bitarray(endian='big')
+				r.frombytes(self.rng.randbytes(num_bytes))
+				del r[num_pieces:]
+				pieces = (pieces | r) if level >> bit & 1 else (pieces & r)
+
+		return pieces
+
+	def __repr__(self):
+		return 'SimPeer(ip=%s, port=%s)' % (self.ip, self.port)
+
+
+class SimConnection():
+
+	"""
+	One in-memory TCP-like connection between a TorrentPeer and a SimPeer.
+	TorrentPeer sees the write() / disconnect() interface of PeerConnectionProtocol
+	"""
+
+	def __init__(self, conn_man, local, remote):
+
+		self.conn_man = conn_man
+		self.clock = conn_man.clock
+		self.local = local
+		self.remote = remote
+		self.closed = False
+
+		self.recv_buffer = b'' # remote side's view of the stream
+		self.handshake_done = False
+		self.choking = True
+		self.upload_free_at = 0.0 # when the remote peer's uplink is next idle
+		self.last_delivery = 0.0
+
+	# ========= the TorrentPeer facing side ========= #
+
+	def write(self, data):
+
+		if self.closed:
+			return
+		if len(data) == 9 and data[4] == 4: # a have - a SimPeer never wants anything from us, so it goes nowhere
+			return
+		self.clock.call_later(self.remote.latency, self._remote_receive, data)
+
+	def disconnect(self):
+
+		if self.closed:
+			return
+		self.closed = True
+		self.clock.call_later(0, self.local.handle_connection_lost)
+
+	# ========= the SimPeer side ========= #
+
+	def _send_to_local(self, data, delay=None):
+		""" delivery keeps stream order, like TCP """
+
+		at = self.clock.now() + (self.remote.latency if delay is None else delay)
+		at = max(at, self.last_delivery)
+		self.last_delivery = at
+		self.clock.call_later(at - self.clock.now(), self._local_receive, data)
+
+	def _local_receive(self, data):
+
+		if not self.closed:
+			self.local.handle_data_received(data)
+
+	def _remote_receive(self, data):
+
+		if self.closed:
+			return
+
+		data = self.recv_buffer + data
+
+		if not self.handshake_done:
+			if len(data) < 68:
+				self.recv_buffer = data
+				return
+			self.handshake_done = True
+			data = data[68:]
+			self._send_handshake()
+
+		while len(data) >= 4:
+			(length,) = struct.unpack('!L', data[:4])
+			if len(data) < 4 + length:
+				break
+			if length:
+				self._handle_message(data[4], data[5:4+length])
+			data = data[4+length:]
+
+		self.recv_buffer = data
+
+	def _send_handshake(self):
+
+		metainfo = self.conn_man.swarm.metainfo
+		msg = TorrentPeer.build_handshake(metainfo.info_hash, b'-SIM000-' + b'%012d' % int(ipaddress.ip_address(self.remote.ip)))
+
+		bits = self.remote.pieces.copy()
+		bits.fill() # pad to a whole byte
+		payload = bits.tobytes()
+		msg += struct.pack('!LB', 1 + len(payload), 5) + payload
+
+		self._send_to_local(msg)
+
+	def _handle_message(self, msg_id, payload):
+
+		remote = self.remote
+
+		if msg_id == 2: # interested
+			if self.choking and not remote.silent:
+				self.choking = False
+				self._send_to_local(TorrentPeer.build_message('unchoke'))
+
+		elif msg_id == 6: # request
+			(index, begin, length) = struct.unpack('!LLL', payload)
+
+			if self.choking or not remote.pieces[index]:
+				return
+
+			if remote.rng.random() < remote.loss:
+				remote.requests_dropped += 1
+				return
+
+			block = self.conn_man.swarm.metainfo.get_piece_data(index)[begin:begin+length]
+
+			if remote.rng.random() < remote.corrupt:
+				block = bytes(b ^ 0xFF for b in block)
+
+			msg = struct.pack('!LBLL', 9 + len(block), 7, index, begin) + block
+
+			# the block queues behind whatever the peer is already uploading
+			start = max(self.clock.now(), self.upload_free_at)
+			self.upload_free_at = start + len(msg) / remote.bandwidth
+			self._send_to_local(msg, self.upload_free_at - self.clock.now() + remote.latency)
+			remote.blocks_sent += 1
+
+			if remote.rng.random() < remote.choke_prob:
+				self.choking = True
+				self._send_to_local(TorrentPeer.build_message('choke'), self.upload_free_at - self.clock.now() + remote.latency)
+				self.clock.call_later(remote.choke_duration, self._unchoke)
+
+	def _unchoke(self):
+
+		if not self.closed and self.choking:
+			self.choking = False
+			self._send_to_local(TorrentPeer.build_message('unchoke'))
+
+
+class SimConnectionManager():
+
+	""" Drop-in replacement for ConnectionManagerTwisted that connects to the swarm's SimPeers """
+
+	def __init__(self, swarm):
+		self.swarm = swarm
+		self.clock = swarm.clock
+		self.connections = []
+
+	def connect_peer(self, peer):
+
+		remote = self.swarm.peers.get((peer.ip, peer.port))
+
+		if remote is None or remote.refuse:
+			self.clock.call_later(CONNECT_FAILURE_DELAY, peer.handle_connection_failed)
+			return
+
+		conn = SimConnection(self, peer, remote)
+		self.connections.append(conn)
+		self.clock.call_later(2*remote.latency, peer.handle_connection_made, conn) # SYN / SYN-ACK
+
+	def run_in_thread(self, func, callback, errback):
+
+		def run():
+			try:
+				result = func()
+			except Exception as e:
+				errback(e)
+			else:
+				callback(result)
+
+		self.clock.call_later(0, run)
+
+	def call_later(self, delay, func, *args):
+		return self.clock.call_later(delay, func, *args)
+
+	def now(self):
+		return self.clock.now()
+
+	def start_event_loop(self):
+		self.clock.run()
+
+	def stop_event_loop(self):
+		self.clock.stop()
+
+
+class SimSwarm():
+
+	"""
+	A simulated torrent, its peers, and the clock that drives them
+
+		swarm = SimSwarm(num_pieces=1000, piece_length=2**14, seed=1)
+		swarm.add_peers(100, bandwidth=5e5, pieces=0.5)
+		swarm.add_peers(5, loss=0.5)
+		result = swarm.run()
+
+	"""
+
+	def __init__(self, num_pieces, piece_length=CONFIG['block_length'], seed=0):
+
+		self.seed = seed
+		self.rng = random.Random(seed)
+		self.clock = VirtualClock()
+		self.metainfo = SimMetainfo(num_pieces, piece_length, seed)
+		self.conn_man = SimConnectionManager(self)
+		self.peers = {} # (ip, port) -> SimPeer
+
+	def add_peer(self, **behaviour):
+
+		n = len(self.peers) + 1
+		ip = '10.%d.%d.%d' % (n >> 16 & 0xFF, n >> 8 & 0xFF, n & 0xFF)
+		peer = SimPeer(self, ip, 6881, random.Random(self.rng.random()), **behaviour)
+		self.peers[(ip, peer.port)] = peer
+
+		return peer
+
+	def add_peers(self, count, **behaviour):
+		return [self.add_peer(**behaviour) for _ in range(count)]
+
+	def make_torrent(self, **kwargs):
+		""" a Torrent on the simulated network, with the swarm's peers in a seeded random order """
+
+		torrent = Torrent(self.conn_man, self.metainfo, **kwargs)
+
+		peer_dicts = [{'ip': p.ip, 'port': p.port} for p in self.peers.values()]
+		self.rng.shuffle(peer_dicts)
+		for peer_dict in peer_dicts:
+			torrent.add_peer(peer_dict)
+
+		return torrent
+
+	def run(self, torrent=None, until=None):
+		""" download the torrent; returns stats for the run """
+
+		completed = []
+
+		def on_completed_torrent(t, data):
+			completed.append(self.clock.now())
+			self.clock.stop()
+
+		if torrent is None:
+			torrent = self.make_torrent(on_completed_torrent=on_completed_torrent)
+		else:
+			torrent.on_completed_torrent = on_completed_torrent
+
+		torrent.rng = random.Random(self.seed) # for the endgame picks - reproducible, and the random module is left alone
+		started = time.time()
+		torrent.start_torrent()
+		self.clock.run(until)
+
+		return {
+			'completed': bool(completed),
+			'sim_time': completed[0] if completed else self.clock.now(),
+			'wall_time': time.time() - started,
+			'events': self.clock.num_events,
+			'torrent': torrent.get_stats()
+		}
+
+
+def main(argv=None):
+
+	parser = argparse.ArgumentParser(description='run a simulated download')
+	parser.add_argument('--pieces', type=int, default=10000)
+	parser.add_argument('--piece-length', type=int, default=CONFIG['block_length'])
+	parser.add_argument('--peers', type=int, default=500)
+	parser.add_argument('--have', type=float, default=0.5, help='fraction of pieces each peer has')
+	parser.add_argument('--bandwidth', type=float, default=1e6, help='peer upload bytes/sec')
+	parser.add_argument('--latency', type=float, default=0.05, help='one way seconds')
+	parser.add_argument('--loss', type=float, default=0.0)
+	parser.add_argument('--bad-peers', type=int, default=0, help='peers that drop half of all requests')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--until', type=float, help='stop after this many simulated seconds')
+
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.WARNING)
+
+	swarm = SimSwarm(args.pieces, args.piece_length, args.seed)
+	swarm.add_peers(args.peers, bandwidth=args.bandwidth, latency=args.latency, pieces=args.have, loss=args.loss)
+	swarm.add_peers(args.bad_peers, bandwidth=args.bandwidth, latency=args.latency, pieces=args.have, loss=0.5)
+
+	result = swarm.run(until=args.until)
+
+	print('completed=%s sim_time=%.1fs wall_time=%.1fs events=%d' % (result['completed'], result['sim_time'],
+		result['wall_time'], result['events']))
+	print(result['torrent'])
+
+
+if __name__=='__main__':
+	main()
@@ -0,0 +1,195 @@
+"""
+Super-seeding (BEP 16) - initial seeding from one origin, handing out each piece once to as many peers as we can
+
+A plain seed sends its full bitfield, and peers all ask for the same early or rarest-looking pieces - our
+uplink carries the same piece many times while the rest of the torrent exists nowhere else. A super-seed
+sends no bitfield and reveals pieces to each peer one at a time with a have message:
+
+- a peer is offered a piece nobody has been offered yet (then, once every piece is out, the rarest one it lacks)
+- requests are only served for pieces revealed to that peer
+- the peer gets its next piece once the last one has spread: another peer announces it, so the swarm is
+  carrying it without us. If nobody else could take it from that peer, or it hasn't spread after
+  CONFIG['superseed_timeout'] seconds, the peer gets its next piece anyway, so a small swarm can't stall
+
+Availability counts come from the bitfields and have messages of the connected peers. The stats report when
+the first peer held every piece - the first full copy we are no longer the only source of.
+
+"""
+
+import array
+import logging
+
+from config import CONFIG
+
+log = logging.getLogger(__name__)
+
+
+class SuperSeeder():
+
+	""" one per seeding torrent, told about peers' bitfields and haves by TorrentPeer """
+
+	def __init__(self, torrent, interval=None):
+
+		self.torrent = torrent
+		self.interval = interval or CONFIG['superseed_interval']
+		num_pieces = len(torrent.metainfo.info['pieces'])
+
+		self.availability = array.array('I', [0]) * num_pieces # connected peers that have each piece
+		self.times_offered = array.array('I', [0]) * num_pieces
+		self.next_unoffered = 0 # every piece before this has been offered, or is out there already
+
+		self.peers = set() # started peers - the ones counted in availability
+		self.offers = {} # peer -> [piece, offered at, when the peer announced it (None until then)]
+		self.offered_to = {} # piece -> peers it is the current offer of
+		self.revealed = {} # peer -> pieces we told it about, the ones it may request
+
+		self.started_at = None
+		self.first_copy_at = None
+		self.num_spread = 0 # offers that reached another peer
+		self.timer = None
+
+	def start(self):
+
+		if self.started_at is None:
+			self.started_at = self.torrent.conn_man.now()
+		if not self.timer:
+			self.timer = self.torrent.conn_man.call_later(self.interval, self.tick)
+
+	def stop(self):
+
+		if self.timer:
+			self.timer.cancel()
+			self.timer = None
+
+	def tick(self):
+		""" move on the peers whose piece did not spread in time """
+
+		self.timer = None
+		now = self.torrent.conn_man.now()
+
+		for (peer, (_, _, announced_at)) in list(self.offers.items()):
+			if announced_at is not None and now - announced_at >= CONFIG['superseed_timeout']:
+				self.offer(peer)
+
+		self.start()
+
+	# ========= Peer events ========= #
+
+	def handle_peer_started(self, peer):
+		""" handshake done - instead of a bitfield the peer gets its first piece """
+
+		self.peers.add(peer)
+		for i in peer.peer_pieces.search(1): # from an earlier connection
+			self.availability[i] += 1
+
+		self.offer(peer)
+
+	def handle_bitfield(self, peer, old_pieces):
+
+		if peer not in self.peers:
+			return
+
+		for i in old_pieces.search(1):
+			self.availability[i] -= 1
+		for i in peer.peer_pieces.search(1):
+			self.availability[i] += 1
+
+		self.check_first_copy(peer)
+		offer = self.offers.get(peer)
+		if offer is None or peer.peer_pieces[offer[0]]: # it had that one already
+			self.offer(peer)
+
+	def handle_have(self, peer, index, is_new):
+
+		if peer not in self.peers:
+			return
+
+		if is_new:
+			self.availability[index] += 1
+			self.check_first_copy(peer)
+
+		for other in list(self.offered_to.get(index, ())):
+			if other is not peer: # the piece went on from the peer we gave it to
+				self.num_spread += 1
+				self.offer(other)
+
+		offer = self.offers.get(peer)
+		if offer and offer[0] == index:
+			offer[2] = self.torrent.conn_man.now()
+			if not any(not p.peer_pieces[index] for p in self.peers if p is not peer): # no one to spread it to
+				self.offer(peer)
+
+	def handle_peer_stopped(self, peer):
+
+		if peer not in self.peers:
+			return
+
+		self.peers.discard(peer)
+		for i in peer.peer_pieces.search(1):
+			self.availability[i] -= 1
+
+		self.withdraw(peer)
+		self.revealed.pop(peer, None)
+
+	def may_serve(self, peer, index):
+		return index in self.revealed.get(peer, ())
+
+	# ========= Offers ========= #
+
+	def offer(self, peer):
+		""" reveal the peer its next piece """
+
+		self.withdraw(peer)
+
+		piece = self.choose_piece(peer)
+		if piece is None: # it has everything we could offer
+			return
+
+		self.offers[peer] = [piece, self.torrent.conn_man.now(), None]
+		self.offered_to.setdefault(piece, set()).add(peer)
+		self.revealed.setdefault(peer, set()).add(piece)
+		self.times_offered[piece] += 1
+
+		log.debug('%s: super-seeding piece %d to %s' % (self.torrent, piece, peer))
+		peer.send_message('have', index=piece)
+
+	def withdraw(self, peer):
+
+		offer = self.offers.pop(peer, None)
+		if offer:
+			peers = self.offered_to[offer[0]]
+			peers.discard(peer)
+			if not peers:
+				del self.offered_to[offer[0]]
+
+	def choose_piece(self, peer):
+		""" the next piece nobody has been offered, or once all are out, the least offered and rarest it lacks """
+
+		(availability, times_offered) = (self.availability, self.times_offered)
+		num_pieces = len(availability)
+
+		while self.next_unoffered < num_pieces and (times_offered[self.next_unoffered] or availability[self.next_unoffered]):
+			self.next_unoffered += 1
+
+		if self.next_unoffered < num_pieces: # nobody has it, so neither has this peer
+			return self.next_unoffered
+
+		missing = list((~peer.peer_pieces).search(1))
+		if not missing:
+			return None
+
+		return min(missing, key=lambda i: (availability[i] + times_offered[i], i))
+
+	def check_first_copy(self, peer):
+
+		if self.first_copy_at is None and peer.peer_pieces.all():
+			self.first_copy_at = self.torrent.conn_man.now()
+			log.info('%s: first full copy at %s after %.1fs' % (self.torrent, peer, self.first_copy_at - self.started_at))
+
+	def get_stats(self):
+
+		return {
+			'pieces_offered': sum(1 for n in self.times_offered if n),
+			'offers_spread': self.num_spread,
+			'first_copy_time': self.first_copy_at - self.started_at if self.first_copy_at is not None else None
+		}
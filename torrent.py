@@ -1,9 +1,18 @@
 import logging 
 import hashlib
+import random
+import time
+import bitarray
 
+import merkle
 from config import CONFIG
-from peer import TorrentPeer 
+from peer import TorrentPeer, PEER_STATES
 from tracker import TorrentTracker
+from conn_controller import ConnectionController
+from rate_limiter import TokenBucket
+from web_seed import WebSeed
+from pex import PeerExchange
+from superseed import SuperSeeder
 
 log = logging.getLogger(__name__)
 
@@ -13,44 +22,234 @@ class Torrent():
 	from the beginning to the completion
 	"""
 
-	def __init__(self, conn_man, metainfo, on_completed_torrent=None, on_completed_piece=None):
+	__slots__ = ('metainfo', 'conn_man', 'active_peers', 'peers', 'tracker', 'is_complete', 'is_paused', 'peer_cache',
+				'on_completed_torrent', 'on_completed_piece',
+				'piece_blocks', 'piece_requests', 'complete_pieces', 'have_pieces',
+				'requested_pieces', 'num_complete', 'num_requested', 'peer_states', 'peer_index', 'next_peer_index',
+				'max_peers', 'bytes_downloaded', 'conn_controller', 'download_limiter', 'upload_limiter',
+				'banned_ips', 'failed_pieces', 'num_hash_failures', 'web_seeds', 'piece_leaves', 'pex',
+				'num_seeders', 'num_leechers', 'blocklist', 'is_seeding', 'superseeder', 'bytes_uploaded', 'rng')
+
+	def __init__(self, conn_man, metainfo, on_completed_torrent=None, on_completed_piece=None, peer_cache=None,
+			download_limiter=None, upload_limiter=None, blocklist=None, rng=None):
 		"""
 		Args: 
 			conn_man - connection manager for peer connections
 			metainfo - contains the decoded information from the torrent file 
 			on_completed_torrent - a function that does the activities after torrent donwload is completed  
 			on_completed_piece - a function that does the activities after a piece of the torrent is downloaded
+			peer_cache - optional PeerCache; good peers from earlier runs are dialled before the tracker answers
+			download_limiter, upload_limiter - the session's TokenBuckets; this torrent's buckets sit under them
+			blocklist - the session's IPBlocklist, None when no lists are configured
+			rng - random.Random for the random piece picks, e.g. seeded by the simulator; the random module by default
 
 		"""
 		self.metainfo = metainfo
 		self.conn_man = conn_man
+		self.peer_cache = peer_cache
+		self.blocklist = blocklist
+		self.rng = rng or random
+
+		clock = conn_man.now if conn_man else time.monotonic
+		self.download_limiter = TokenBucket(CONFIG['torrent_download_rate_limit'], parent=download_limiter, clock=clock)
+		self.upload_limiter = TokenBucket(CONFIG['torrent_upload_rate_limit'], parent=upload_limiter, clock=clock)
 
 		self.active_peers = []
 		self.peers = []
+		self.peer_index = {} # (ip, port) -> peer, so that duplicate checks don't scan the peer list
+		self.next_peer_index = 0 # self.peers before this index have already been tried
+		self.peer_states = dict.fromkeys(PEER_STATES, 0) # running count of peers in each state
+		self.max_peers = CONFIG['max_peers'] # target number of connected peers, tuned by conn_controller
+		self.conn_controller = ConnectionController(self) if CONFIG['adaptive_max_peers'] else None
 		self.tracker = None
+		self.num_seeders = None # swarm size from the tracker's last announce or scrape, None until we hear
+		self.num_leechers = None
 		self.is_complete = False 
+		self.is_paused = False
+		self.is_seeding = False # started with all the data (seed), rather than having downloaded it
+		self.superseeder = None
 
 		self.on_completed_torrent = on_completed_torrent
 		self.on_completed_piece = on_completed_piece
 
-		self.piece_blocks = [ [] for _ in self.metainfo.info['pieces'] ] # array that stores the received blocks of an in-progress piece
-		self.piece_requests = [ [] for _ in self.metainfo.info['pieces'] ] # array that stores which pieces have been requested 
+		# both created on demand, so untouched pieces cost a single list slot
+		self.piece_blocks = [ None for _ in self.metainfo.info['pieces'] ] # {begin: block} of the received blocks of an in-progress piece
+		self.piece_requests = [ None for _ in self.metainfo.info['pieces'] ] # which peers each piece has been requested from 
 
 		 # list with No elements to begin with -- but stores which pieces have been completed 
 		self.complete_pieces = [ None for _ in self.metainfo.info['pieces'] ]
 
+		# our own completion bitmap - peers AND against it to decide whether they have anything we need
+		self.have_pieces = bitarray.bitarray(len(self.metainfo.info['pieces']), endian='big')
+		self.have_pieces.setall(0)
+
+		# pieces with at least one outstanding request
+		self.requested_pieces = bitarray.bitarray(len(self.metainfo.info['pieces']), endian='big')
+		self.requested_pieces.setall(0)
+
+		# counters kept in step with the bitmaps above so that progress checks are constant time
+		self.num_complete = 0
+		self.num_requested = 0
+		self.bytes_downloaded = 0
+		self.bytes_uploaded = 0
+
+		# smart-ban: for pieces that failed the hash check, {(begin, ip): sha1 of the block that ip sent}.
+		# once the piece passes, whoever sent a block that differs from the good one is banned
+		self.failed_pieces = {}
+		self.banned_ips = set()
+		self.num_hash_failures = 0
+
+		# v2: verified leaf hashes of in-progress pieces, from peers' hashes messages - with them every 16 KiB
+		# block is checked on arrival, and a bad one pins the blame on its sender straight away
+		self.piece_leaves = {}
+
+		# HTTP servers from the metainfo's url-list, fetching pieces alongside the peers
+		self.web_seeds = [WebSeed(self, url) for url in getattr(metainfo, 'url_list', [])]
+
+		# swaps addresses of connected peers with the peers that support ut_pex
+		self.pex = PeerExchange(self) if CONFIG['pex'] and not getattr(metainfo, 'private', False) else None
+
+	def __repr__(self):
+		return 'Torrent(%s)' % self.metainfo.name
 
 	def start_torrent(self):
 
 		self.tracker = TorrentTracker(self,self.metainfo.announce)
-		self.tracker.send_announce_request()
 
-		for peer in self.peers[:CONFIG['max_peers']]: 
-			peer.connect()
+		if self.peer_cache: # dial known good peers right away, the announce runs in the background
+			for peer_dict in self.filter_peers(self.peer_cache.get_best_peers(self.metainfo.info_hash, self.max_peers)):
+				self.add_peer(peer_dict)
+			self.fill_peer_slots()
+
+		if self.metainfo.announce: 
+			self.tracker.send_announce_request() # calls fill_peer_slots once the tracker replies
+		else: # trackerless, e.g. a simulated swarm - go with the peers we were given
+			self.fill_peer_slots()
+
+		for seed in self.web_seeds:
+			seed.start()
+
+		if self.conn_controller:
+			self.conn_controller.start()
+
+		if self.pex:
+			self.pex.start()
+
+		if self.superseeder:
+			self.superseeder.start()
+
+	def seed(self, data):
+		""" start out with all of the data, checked against the piece hashes, and upload it instead of downloading """
+
+		for i in range(len(self.complete_pieces)):
+			offset = self.metainfo.get_piece_offset(i)
+			piece = data[offset : offset + self.metainfo.get_piece_length(i)]
+			if not self.check_piece(i, piece):
+				raise TorrentPieceError('%s: piece %d does not match the metainfo' % (self, i))
+			self.complete_pieces[i] = piece
+
+		self.have_pieces.setall(1)
+		self.num_complete = len(self.complete_pieces)
+		self.is_complete = True
+		self.is_seeding = True
+
+		# reveal pieces one peer at a time rather than advertising all of them
+		self.superseeder = SuperSeeder(self) if CONFIG['superseed'] else None
+
+	def get_block(self, piece_index, begin, length):
+		""" the data a peer's request asks for, None if we don't have it or the request is out of range """
+
+		piece = self.complete_pieces[piece_index] if piece_index < len(self.complete_pieces) else None
+
+		if piece is None or not 0 < length <= CONFIG['max_request_length'] or begin + length > len(piece):
+			return None
+
+		return piece[begin:begin+length]
+
+	def fill_peer_slots(self):
+		""" connect to untried peers until we are at max_peers """
+
+		if self.is_paused or (self.is_complete and not self.is_seeding):
+			return
+
+		while self.num_active_peers() < self.max_peers:
+			if not self.connect_next_peer():
+				break
+
+	def set_max_peers(self, max_peers):
+		""" change the connected peer target; going down drops the slowest peers """
+
+		self.max_peers = max_peers
+		excess = self.num_active_peers() - max_peers
+
+		if excess > 0:
+			active = [p for p in self.peers if p.state == 'active' and p.conn]
+			active.sort(key=lambda p: p.get_throughput())
+			for p in active[:excess]:
+				log.debug('%s: dropping slow peer %s' % (self, p))
+				p.conn.disconnect()
+		else:
+			self.fill_peer_slots()
+
+	def pause(self):
+		""" drop all peer connections but keep the downloaded pieces, so the torrent can be resumed later """
+
+		if self.is_paused:
+			return
+
+		log.info('%s: pause' % self)
+		self.is_paused = True
+
+		for p in self.peers:
+			if p.conn:
+				self.record_peer(p)
+				p.conn.disconnect()
+
+		for seed in self.web_seeds:
+			seed.stop()
+
+		if self.pex:
+			self.pex.stop()
+
+		if self.superseeder:
+			self.superseeder.stop()
+
+		if self.peer_cache:
+			self.peer_cache.save(self.metainfo.info_hash)
+
+	def resume(self):
+
+		if not self.is_paused:
+			return
+
+		log.info('%s: resume' % self)
+		self.is_paused = False
+
+		# peers we dropped on pause are worth trying again
+		for p in self.peers:
+			if p.state == 'stopped' and not p.is_incoming:
+				p.reset()
+		self.next_peer_index = 0
+
+		if self.tracker is None:
+			self.start_torrent()
+		else:
+			self.fill_peer_slots()
+			for seed in self.web_seeds:
+				seed.start()
+			if self.conn_controller:
+				self.conn_controller.start()
+			if self.superseeder:
+				self.superseeder.start()
+			if self.pex:
+				self.pex.start()
 
 
 	def add_peer(self,peer_dict):
-		""" add a peer to the torrent download pipeline - IF not already present """
+		""" add a peer to the torrent download pipeline - IF not already present (None for banned peers) """
+		if peer_dict['ip'] in self.banned_ips:
+			return None
+
 		peer = self.find_peer(**peer_dict)
 
 		if peer: 
@@ -58,43 +257,184 @@ class Torrent():
 
 		peer = TorrentPeer(self,**peer_dict)
 		self.peers.append(peer)
+		self.peer_index[(peer.ip, peer.port)] = peer
+		self.peer_states[peer.state] += 1
+
+		return peer
+
+	def filter_peers(self, peer_dicts):
+		""" the peers of a list (tracker reply, PEX message...) worth adding: a usable address, not banned or blocklisted """
+
+		peer_dicts = [p for p in peer_dicts if p['ip'] and p['port'] > 0 and p['ip'] not in self.banned_ips]
+
+		return self.blocklist.filter_peers(peer_dicts) if self.blocklist else peer_dicts
+
+	def add_local_peer(self, peer_dict):
+		""" a peer on our LAN (local service discovery) - dialled right away, even over max_peers """
+
+		if not self.filter_peers([peer_dict]):
+			return None
+
+		peer = self.add_peer(peer_dict)
+
+		if peer is None or self.is_paused or (self.is_complete and not self.is_seeding):
+			return peer
+
+		if peer.state == 'stopped' and not peer.is_incoming: # it announced again, so it is worth another try
+			peer.reset()
+
+		if peer.state == 'new':
+			peer.connect()
+
+		return peer
+
+	def accept_peer(self, ip, port, peer_id):
+		""" a peer that connected to us - same limits and dedupe as the peers we dial. None to turn it away """
+
+		if self.is_paused or (self.is_complete and not self.is_seeding) or ip in self.banned_ips:
+			return None
+
+		if self.num_active_peers() >= self.max_peers:
+			log.debug('%s: turning away %s:%s, at max_peers' % (self, ip, port))
+			return None
+
+		peer = self.find_peer(ip, port)
+		if peer and peer.state in ('connecting', 'active'):
+			return None
+
+		if peer is None:
+			peer = TorrentPeer(self, ip, port, peer_id, is_incoming=True)
+			self.peers.append(peer)
+			self.peer_index[(ip, port)] = peer
+			self.peer_states[peer.state] += 1
+		elif peer.state == 'stopped':
+			peer.reset()
 
+		peer.set_state('connecting')
 		return peer
 
+	def is_duplicate_peer(self, peer):
+		""" another connection to the same client (by peer id), or a connection to ourselves """
+
+		if peer.peer_id == CONFIG['peer_id']:
+			return True
+
+		for p in self.peers:
+			if p is not peer and p.peer_id == peer.peer_id and p.state == 'active':
+				return True
+
+		return False
+
 	def find_peer(self, ip, port, **kwargs):
 
-		for peer_list in (self.active_peers, self.peers): 
-			for v in peer_list:
-				if v.ip == ip and v.port == port:
-					return v
+		return self.peer_index.get((ip, port))
+
+	def connect_next_peer(self):
+		""" connect to the next peer that has not been tried yet; returns False when there are none left """
+
+		while self.next_peer_index < len(self.peers):
+			peer = self.peers[self.next_peer_index]
+			self.next_peer_index += 1
+
+			if peer.state == 'new':
+				peer.connect()
+				return True
+
+		return False
+
+	def num_active_peers(self):
+
+		return self.peer_states['connecting'] + self.peer_states['active']
+
+	def set_swarm_info(self, seeders, leechers):
+
+		self.num_seeders = seeders
+		self.num_leechers = leechers
+
+	def handle_peer_state_change(self, peer, old_state, new_state):
+
+		self.peer_states[old_state] -= 1
+		self.peer_states[new_state] += 1
+
+		if new_state == 'active':
+			self.active_peers.append(peer)
+		elif old_state == 'active':
+			self.active_peers.remove(peer)
+
+	def handle_piece_requested(self, peer, piece_index):
+
+		if self.piece_requests[piece_index] is None:
+			self.piece_requests[piece_index] = []
+		self.piece_requests[piece_index].append(peer)
+
+		if not self.requested_pieces[piece_index]:
+			self.requested_pieces[piece_index] = 1
+			self.num_requested += 1
+
+	def get_num_blocks(self, piece_index):
+
+		piece_length = self.metainfo.get_piece_length(piece_index)
+		return (piece_length + CONFIG['block_length'] - 1) // CONFIG['block_length']
+
+	def get_block_length(self, piece_index, begin):
+
+		return min(self.metainfo.get_piece_length(piece_index) - begin, CONFIG['block_length'])
+
+	def get_next_block(self, piece_index):
+		""" offset of the first block of the piece we don't have yet, None if we have them all """
+
+		blocks = self.piece_blocks[piece_index] or {}
+		num_blocks = self.get_num_blocks(piece_index)
+
+		# blocks normally arrive in order, so the block after the ones we hold is the likely answer
+		guess = len(blocks) * CONFIG['block_length']
+		if len(blocks) < num_blocks and guess not in blocks:
+			return guess
+
+		for i in range(num_blocks):
+			begin = i * CONFIG['block_length']
+			if begin not in blocks:
+				return begin
 
 		return None
 
 	def handle_block(self, peer, piece_index, begin, block):
 
 		""" 
-		Didn't completely understand this function - where are we requesting the current block?
+		Stores a received block, and either completes the piece or has the peer ask for the next block
 		"""
 
-		if self.complete_pieces[piece_index]: # implies piece already completed
+		if peer.ip in self.banned_ips: # still in flight when we banned it
+			return
+
+		if self.have_pieces[piece_index]: # implies piece already completed
+			peer.run_download()
+			return
+
+		if begin % CONFIG['block_length'] or len(block) != self.get_block_length(piece_index, begin):
+			log.warning('%s: unexpected block piece=%d begin=%d length=%d' % (peer, piece_index, begin, len(block)))
 			return
 
-		for v in self.piece_blocks[piece_index]:
+		if not self.check_block(piece_index, begin, block):
+			log.warning('%s: bad block piece=%d begin=%d' % (peer, piece_index, begin))
+			self.num_hash_failures += 1
+			self.ban_ip(peer.ip)
+			return
 
-			if v[0] == begin: #TODO: Understand this 
-				# already got the block 
-				peer.request_next_block(piece_index, begin)
-				return 
+		if self.piece_blocks[piece_index] is None:
+			self.piece_blocks[piece_index] = {}
 
-		# since we haven't gotten the block yet
-		self.piece_blocks[piece_index].append((begin, block))
-		expected_length = self.metainfo.get_piece_length(piece_index)
-		piece_length = sum(len(v[1]) for v in self.piece_blocks[piece_index])
+		blocks = self.piece_blocks[piece_index]
+		if begin not in blocks: # keep the first copy if we already got the block 
+			blocks[begin] = (block, peer) # who sent it, in case the piece fails the hash check
+			self.bytes_downloaded += len(block)
 
-		if piece_length == expected_length:
+		if len(blocks) == self.get_num_blocks(piece_index):
 			self.handle_completed_piece(peer, piece_index)
-		else:
-			peer.request_next_block(piece_index, begin)
+		elif peer.requested_piece == piece_index:
+			peer.request_next_block(piece_index)
+		else: # a late block for a piece this peer no longer has assigned
+			peer.run_download()
 
 
 	def handle_completed_piece(self, peer, piece_index):
@@ -103,46 +443,190 @@ class Torrent():
 			log.warning('Piece already completed: %s' % piece_index)
 			return 
 
-		self.piece_blocks[piece_index].sort(key = lambda v: v[0]) # sorting this piece blocks array by the 0th column elemts 
-
-		block = [ v[1] for v in self.piece_blocks[piece_index] ] # getting a sorted list of blocks 
+		blocks = self.piece_blocks[piece_index]
+		piece = b''.join(blocks[begin][0] for begin in sorted(blocks))
 
-		# a byteArray kinna representation for the piece 
-		piece = bytes( v for block in blocks for v in block ) 
-
-		# sha1 encoding the piece bytearray
-		piece_sha = hashlib.sha1(piece).digest()
+		if not self.check_piece(piece_index, piece):
+			self.handle_failed_piece(piece_index)
+			return
 
-		# the already encrypted sha for the piece 
-		canonical_sha = self.metainfo.info['pieces'][piece_index]
+		self.piece_leaves.pop(piece_index, None)
 
-		if piece_sha != canonical_sha:
-			raise TorrentPieceError('Piece %d sha mismatch' % piece_index)
+		if piece_index in self.failed_pieces: # now we know what the blocks should have been
+			self.smart_ban(piece_index, blocks)
 
 		self.complete_pieces[piece_index] = piece
+		self.have_pieces[piece_index] = 1
+		self.num_complete += 1
 		self.piece_blocks[piece_index] = None # this array of received blocks is only for in-progress piece; since this piece is completed, we no longer need it
 
+		# so peers know they can ask us for it. Not to the ones whose bitfield had it - with many peers that is most
+		# of them, for every piece - but always to peers without a bitfield: a super-seed only revealed it to us,
+		# and sees from our have that we got it
+		have = TorrentPeer.build_message('have', index=piece_index)
+		for p in self.active_peers:
+			if p.is_started and not (p.has_bitfield and p.peer_pieces[piece_index]):
+				p.write_message(have)
+
 		# Clearing the piece related  bookkeeping on Peers and torrent 
 
-		for p in self.piece_requests[piece_index]:
+		requesters = self.piece_requests[piece_index] or []
+		self.piece_requests[piece_index] = None 
+
+		if self.requested_pieces[piece_index]:
+			self.requested_pieces[piece_index] = 0
+			self.num_requested -= 1
+
+		log.debug('handle_completed_piece: %d' % piece_index)
+
+		if self.on_completed_piece:
+			self.on_completed_piece(self)
+
+		if self.num_complete == len(self.complete_pieces):
+			self.handle_completed_torrent()
+			return
+
+		if peer.requested_piece == piece_index:
+			peer.requested_piece = None
+		peer.run_download() # initiate the download for the next piece with this peer
+
+		for p in requesters:
+			if p != peer and p.requested_piece == piece_index: # pending request to some other peer for this piece 
+				p.cancel_request()
+				p.run_download()
+
+
+	def check_piece(self, piece_index, piece):
+
+		info = self.metainfo.info
+
+		if info.get('meta_version') == 2 and not info.get('hybrid'): # merkle root of the piece's blocks
+			(_, _, piece_hash, width, _, _) = info['v2_pieces'][piece_index]
+			return merkle.merkle_root(merkle.hash_blocks(piece), width) == piece_hash
+
+		# sha1 encoding the piece bytearray, against the already encrypted sha for the piece 
+		return hashlib.sha1(piece).digest() == info['pieces'][piece_index]
+
+	def check_block(self, piece_index, begin, block):
+		""" False if we have the piece's leaf hashes and the block doesn't match its leaf """
+
+		leaves = self.piece_leaves.get(piece_index)
+		if leaves is None:
+			return True
+
+		# a hybrid piece can run past the end of its v2 file into padding, which has no leaves
+		data_length = self.metainfo.info['v2_pieces'][piece_index][5]
+		if begin >= data_length:
+			return True
+
+		return merkle.sha256(block[:data_length - begin]) == leaves[begin // merkle.BLOCK_SIZE]
+
+	def get_hash_request(self, piece_index):
+		""" parameters of the hash request for the leaf hashes of a v2 piece, None if there is nothing to ask """
+
+		if self.metainfo.info.get('meta_version') != 2 or piece_index in self.piece_leaves:
+			return None
+
+		(pieces_root, index_in_file, _, width, _, _) = self.metainfo.info['v2_pieces'][piece_index]
+		if not 2 <= width <= 512: # what one request can cover; a one block piece is checked whole anyway
+			return None
+
+		return {'pieces_root': pieces_root, 'base_layer': 0, 'index': index_in_file * width, 'length': width,
+			'proof_layers': 0}
+
+	def handle_hashes(self, peer, params, hashes):
+		"""
+		Leaf hashes from a peer. We asked for no proof layers: the piece hash in the metainfo is trusted already,
+		so the leaves only need to add up to it
+		"""
+
+		first_piece = self.metainfo.info.get('pieces_roots', {}).get(params['pieces_root'])
+		length = params['length']
+
+		if first_piece is None or params['base_layer'] != 0 or not length or len(hashes) < length:
+			log.debug('%s: unexpected hashes %s' % (peer, params))
+			return
+
+		piece_index = first_piece + params['index'] // length
+		if piece_index >= len(self.complete_pieces) or self.have_pieces[piece_index] or piece_index in self.piece_leaves:
+			return
+
+		(pieces_root, index_in_file, piece_hash, width, _, _) = self.metainfo.info['v2_pieces'][piece_index]
+		leaves = hashes[:length]
+
+		if pieces_root != params['pieces_root'] or width != length or params['index'] != index_in_file * width \
+				or merkle.merkle_root(leaves, width) != piece_hash:
+			log.warning('%s: bad hashes for piece %d' % (peer, piece_index))
+			return
+
+		self.piece_leaves[piece_index] = leaves
+
+		# check the blocks that came in before the hashes did
+		blocks = self.piece_blocks[piece_index] or {}
+		for (begin, (block, p)) in list(blocks.items()):
+			if not self.check_block(piece_index, begin, block):
+				log.warning('%s: bad block piece=%d begin=%d' % (p, piece_index, begin))
+				self.num_hash_failures += 1
+				del blocks[begin]
+				self.bytes_downloaded -= len(block)
+				if p.ip not in self.banned_ips:
+					self.ban_ip(p.ip)
+
+	def handle_failed_piece(self, piece_index):
+		""" a piece failed the hash check - throw it away, work out who to blame and download it again """
+
+		blocks = self.piece_blocks[piece_index]
+		senders = set(p.ip for (_, p) in blocks.values())
+		self.num_hash_failures += 1
+
+		log.warning('%s: piece %d failed the hash check, sent by %s' % (self, piece_index, ', '.join(sorted(senders))))
+
+		if len(senders) == 1: # nobody else to blame
+			self.ban_ip(senders.pop())
+		else:
+			record = self.failed_pieces.setdefault(piece_index, {})
+			for (begin, (block, p)) in blocks.items():
+				record[(begin, p.ip)] = hashlib.sha1(block).digest()
+
+		self.piece_blocks[piece_index] = None
+
+		requesters = self.piece_requests[piece_index] or []
+		self.piece_requests[piece_index] = None
+
+		if self.requested_pieces[piece_index]:
+			self.requested_pieces[piece_index] = 0
+			self.num_requested -= 1
+
+		for p in requesters:
 			if p.requested_piece == piece_index:
-				p.requested_piece = None
+				p.cancel_request()
+				if p.ip not in self.banned_ips:
+					p.run_download()
+
+	def smart_ban(self, piece_index, blocks):
+		""" the piece passed this time: ban everyone whose earlier copy of a block was different """
 
-			if p != peer: # pending request to some other peer for this piece 
-				# ideally want to cancel
-				pass 
+		record = self.failed_pieces.pop(piece_index)
 
-			self.piece_requests[piece_index] = None 
-			log.debug('handle_completed_piece: %d' % piece_index)
+		for ((begin, ip), digest) in record.items():
+			if ip not in self.banned_ips and digest != hashlib.sha1(blocks[begin][0]).digest():
+				self.ban_ip(ip)
 
-			if self.on_completed_piece:
-				self.on_completed_piece(self)
+	def ban_ip(self, ip):
 
-			peer.run_download() # initiate the download for the next piece with this peer
+		log.warning('%s: banning %s for sending corrupt data' % (self, ip))
+		self.banned_ips.add(ip)
 
-			if not any(v is None for v in self.complete_pieces):
-				self.handle_completed_torrent()
+		for p in self.peers:
+			if p.ip == ip:
+				if self.peer_cache:
+					self.peer_cache.forget(self.metainfo.info_hash, p.ip, p.port)
+				if p.conn:
+					p.conn.disconnect()
 
+		for seed in self.web_seeds:
+			if seed.url == ip:
+				seed.stop()
 
 	def handle_completed_torrent(self):
 
@@ -150,11 +634,22 @@ class Torrent():
 
 		self.is_complete=True
 
-		data = bytes(v for piece in self.complete_pieces for v in piece)
+		data = b''.join(self.complete_pieces)
 
 		for p in self.peers:
+			if p.conn:
+				self.record_peer(p)
 			p.handle_torrent_completed() # function disconects from those peers 
 
+		for seed in self.web_seeds:
+			seed.stop()
+
+		if self.pex:
+			self.pex.stop()
+
+		if self.peer_cache:
+			self.peer_cache.save(self.metainfo.info_hash)
+
 		if self.on_completed_torrent: 
 			self.on_completed_torrent(self, data)
 
@@ -165,30 +660,82 @@ class Torrent():
 		initiates the start with a new peer 
 		""" 
 
-		if self.is_complete: #torrent download is over 
+		self.release_piece(peer)
+
+		if self.superseeder:
+			self.superseeder.handle_peer_stopped(peer)
+
+		if self.is_paused or (self.is_complete and not self.is_seeding): #torrent download is over 
+			return
+
+		self.record_peer(peer)
+
+		if self.num_active_peers() >= self.max_peers:
+			return
+
+		if self.connect_next_peer():
+			log.info('handle_peer_stopped: started new peer')
+
+	def record_peer(self, peer):
+		""" remember how the peer did, for the next run """
+
+		if not self.peer_cache or peer.ip in self.banned_ips or peer.is_incoming:
 			return
 
-		num_active = sum(1 for p in self.peers if p.is_started and not p.conn_failed)
+		if peer.bytes_received:
+			self.peer_cache.record_success(self.metainfo.info_hash, peer.ip, peer.port, peer.get_throughput(), peer.stalls)
+		elif not peer.is_started:
+			self.peer_cache.record_failure(self.metainfo.info_hash, peer.ip, peer.port)
 
-		if num_active >= CONFIG['max_peers']:
-			return # TODO: understand, why we are allowing active peers to be over max peers 
+	def release_piece(self, peer):
+		""" hand the piece requested from this peer back to the picker """
 
-		for p in self.peers[CONFIG['max_peers']:]: # for all peers greater than 8 (max # peers)
-			
-			if p.conn or p.is_started or p.conn_failed: #these peers have already been tried to connect to
-				continue 
-			log.info('handle_peer_stopped: starting new peer: %s' % p)
-			p.connect()
-			break
+		piece_index = peer.requested_piece
+		peer.requested_piece = None
+
+		if piece_index is None or not self.piece_requests[piece_index]:
+			return
+
+		if peer in self.piece_requests[piece_index]:
+			self.piece_requests[piece_index].remove(peer)
+
+		if not self.piece_requests[piece_index] and self.requested_pieces[piece_index]:
+			self.requested_pieces[piece_index] = 0
+			self.num_requested -= 1
 
 	def get_progress_string(self):
 
-		num_complete = sum(v is not None for v in self.complete_pieces)
 		num_pieces = len(self.complete_pieces)
 
-		pct_complete = 100.0 * (num_complete/num_pieces)
-
-		return ('%s / %s (%02.1f%%) complete' % (num_complete,num_pieces,pct_complete))
+		pct_complete = 100.0 * (self.num_complete/num_pieces)
+
+		return ('%s / %s (%02.1f%%) complete, %s in flight, %s peers' % (self.num_complete, num_pieces,
+			pct_complete, self.num_requested, self.num_active_peers()))
+
+	def get_stats(self):
+		""" snapshot of the progress counters - cheap enough to poll from a UI or metrics exporter """
+
+		return {
+			'pieces_total': len(self.complete_pieces),
+			'pieces_complete': self.num_complete,
+			'pieces_in_flight': self.num_requested,
+			'bytes_downloaded': self.bytes_downloaded,
+			'bytes_uploaded': self.bytes_uploaded,
+			'peers': dict(self.peer_states),
+			'max_peers': self.max_peers,
+			'hash_failures': self.num_hash_failures,
+			'banned_ips': len(self.banned_ips),
+			'web_seeds': [seed.get_stats() for seed in self.web_seeds],
+			'pex_peers': self.pex.num_received if self.pex else 0,
+			'seeders': self.num_seeders,
+			'leechers': self.num_leechers,
+			'download': self.download_limiter.get_stats(),
+			'upload': self.upload_limiter.get_stats(),
+			'is_complete': self.is_complete,
+			'is_seeding': self.is_seeding,
+			'superseed': self.superseeder.get_stats() if self.superseeder else None,
+			'is_paused': self.is_paused
+		}
 
 
 
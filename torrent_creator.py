@@ -0,0 +1,317 @@
+"""
+Creates .torrent metainfo files - the other half of TorrentMetainfo
+
+Pieces are hashed across a process pool. Each worker mmaps the files and hashes a run of consecutive pieces,
+reading straight through file boundaries (a piece can span several files), so throughput scales with cores
+on fast storage.
+
+With --hybrid the torrent also gets a v2 (BEP 52) description: a sha256 merkle tree per file, which lets
+downloaders check every 16 KiB block. Padding files (BEP 47) align each v1 file to a piece boundary, so the
+pieces of both halves line up and identical files get identical pieces in any torrent.
+
+	python CLI_entry_point.py create <file or dir> -a http://tracker/announce [-o out.torrent]
+
+"""
+
+import argparse
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+import time
+
+import bencodepy
+
+import merkle
+
+log = logging.getLogger(__name__)
+
+MIN_PIECE_LENGTH = 2**14 # one block
+MAX_PIECE_LENGTH = 2**24
+TARGET_NUM_PIECES = 1500 # keeps the metainfo small without making pieces huge
+PIECES_PER_TASK = 64 # pieces a worker hashes per task
+MIN_POOL_LENGTH = 2**26 # below this a process pool costs more than it saves
+
+
+def choose_piece_length(total_length):
+	""" smallest power of two that gives at most TARGET_NUM_PIECES pieces, within [16 KiB, 16 MiB] """
+
+	piece_length = MIN_PIECE_LENGTH
+	while piece_length < MAX_PIECE_LENGTH and total_length / piece_length > TARGET_NUM_PIECES:
+		piece_length *= 2
+
+	return piece_length
+
+
+def collect_files(path):
+	"""
+	Returns (name, files) for a file or a directory; files are (abs_path, length, path_segments)
+	in a fixed (sorted) order, since the order decides the piece hashes
+	"""
+
+	path = os.path.abspath(path)
+	name = os.path.basename(path.rstrip(os.sep))
+
+	if os.path.isfile(path):
+		return (name, [(path, os.path.getsize(path), [name])])
+
+	files = []
+	for (dirpath, dirnames, filenames) in os.walk(path):
+		dirnames.sort()
+		for filename in sorted(filenames):
+			file_path = os.path.join(dirpath, filename)
+			if os.path.isfile(file_path):
+				segments = os.path.relpath(file_path, path).split(os.sep)
+				files.append((file_path, os.path.getsize(file_path), segments))
+
+	if not files:
+		raise TorrentCreateError('No files in %s' % path)
+
+	return (name, files)
+
+
+# ========= Hashing - runs in the pool's worker processes ========= #
+
+_worker_files = None
+_worker_piece_length = None
+
+def _init_worker(files, piece_length):
+
+	global _worker_files, _worker_piece_length
+	_worker_files = files
+	_worker_piece_length = piece_length
+
+
+def _hash_piece_range(piece_range):
+	""" sha1 of pieces [first, last), concatenated """
+
+	(first, last) = piece_range
+	piece_length = _worker_piece_length
+	total_length = sum(length for (_, length, _) in _worker_files)
+
+	start = first * piece_length
+	end = min(last * piece_length, total_length)
+
+	hashes = []
+	sha = hashlib.sha1()
+	piece_end = min(start + piece_length, end)
+
+	file_start = 0
+	for (file_path, length, _) in _worker_files:
+		file_end = file_start + length
+
+		if file_end <= start or length == 0:
+			file_start = file_end
+			continue
+		if file_start >= end:
+			break
+
+		if file_path is None: # padding file, all zeros
+			read = lambda first, last: bytes(last - first)
+			mm = None
+		else:
+			f = open(file_path, 'rb')
+			mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			read = lambda first, last: mm[first:last]
+
+		pos = max(start, file_start)
+
+		while pos < min(end, file_end):
+			chunk_end = min(piece_end, file_end)
+			sha.update(read(pos - file_start, chunk_end - file_start))
+			pos = chunk_end
+
+			if pos == piece_end: # piece done - it may have started in an earlier file
+				hashes.append(sha.digest())
+				sha = hashlib.sha1()
+				piece_end = min(piece_end + piece_length, end)
+
+		if mm is not None:
+			mm.close()
+			f.close()
+
+		file_start = file_end
+
+	return b''.join(hashes)
+
+
+def hash_pieces(files, piece_length, processes=None, min_pool_length=MIN_POOL_LENGTH):
+	""" the concatenated 20 byte sha1 of every piece; in a process pool from min_pool_length bytes """
+
+	total_length = sum(length for (_, length, _) in files)
+	num_pieces = (total_length + piece_length - 1) // piece_length
+	tasks = [(i, min(i + PIECES_PER_TASK, num_pieces)) for i in range(0, num_pieces, PIECES_PER_TASK)]
+
+	if processes == 1 or total_length < min_pool_length:
+		_init_worker(files, piece_length)
+		return b''.join(_hash_piece_range(task) for task in tasks)
+
+	with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(files, piece_length)) as pool:
+		return b''.join(pool.imap(_hash_piece_range, tasks)) # imap keeps the pieces in order
+
+
+def _hash_file_v2(file):
+	""" (pieces root, piece layer) of one file """
+
+	(file_path, length, _) = file
+	if length == 0:
+		return (None, b'')
+
+	with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+		leaves = [merkle.sha256(mm[i:i + merkle.BLOCK_SIZE]) for i in range(0, length, merkle.BLOCK_SIZE)]
+
+	return merkle.get_file_tree(leaves, _worker_piece_length)
+
+
+def hash_files_v2(files, piece_length, processes=None, min_pool_length=MIN_POOL_LENGTH):
+	""" (pieces root, piece layer) of every file, one file per task; in a process pool from min_pool_length bytes """
+
+	total_length = sum(length for (_, length, _) in files)
+
+	if processes == 1 or total_length < min_pool_length:
+		_init_worker(files, piece_length)
+		return [_hash_file_v2(file) for file in files]
+
+	with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(files, piece_length)) as pool:
+		return pool.map(_hash_file_v2, files)
+
+
+def pad_files(files, piece_length):
+	""" the files with a padding file (path None) after each one that doesn't end on a piece boundary """
+
+	padded = []
+	for (i, file) in enumerate(files):
+		padded.append(file)
+		pad = -file[1] % piece_length
+		if pad and i < len(files) - 1: # nothing follows the last file
+			padded.append((None, pad, ['.pad', str(pad)]))
+
+	return padded
+
+
+def build_file_tree(files, roots, single_file):
+	""" the v2 'file tree': nested dicts of path segments, a file being {'': {length, pieces root}} """
+
+	tree = {}
+	for ((_, length, segments), (root, _)) in zip(files, roots):
+		node = tree
+		for s in ([] if single_file else segments):
+			node = node.setdefault(s.encode('utf-8'), {})
+		node[b''] = {b'length': length, b'pieces root': root} if root else {b'length': length}
+
+	return tree
+
+
+# ========= Metainfo ========= #
+
+def create_torrent(path, announce, announce_list=None, piece_length=None, comment=None, private=False, processes=None,
+		url_list=None, hybrid=False):
+	"""
+	Bencoded metainfo for a file or directory
+	Args:
+		announce - tracker URL
+		announce_list - optional list of tiers (lists of tracker URLs), BEP 12
+		piece_length - bytes, a power of two; picked from the data size when not given
+		processes - hashing processes; defaults to the number of CPUs
+		url_list - optional web seed URLs, BEP 19
+		hybrid - add the v2 file tree and piece layers (BEP 52), with v1 files padded to piece boundaries
+	"""
+
+	(name, files) = collect_files(path)
+	total_length = sum(length for (_, length, _) in files)
+
+	if piece_length is None:
+		piece_length = choose_piece_length(total_length)
+	elif piece_length < MIN_PIECE_LENGTH or piece_length & (piece_length - 1):
+		raise TorrentCreateError('Piece length must be a power of two of at least %d' % MIN_PIECE_LENGTH)
+
+	single_file = os.path.isfile(os.path.abspath(path))
+	v1_files = pad_files(files, piece_length) if hybrid else files
+
+	started = time.time()
+	pieces = hash_pieces(v1_files, piece_length, processes)
+	roots = hash_files_v2(files, piece_length, processes) if hybrid else None
+	elapsed = time.time() - started
+	log.info('hashed %d bytes in %.1fs (%.1f MB/s)' % (total_length, elapsed, total_length / max(elapsed, 1e-6) / 1e6))
+
+	info = {
+		b'name': name.encode('utf-8'),
+		b'piece length': piece_length,
+		b'pieces': pieces
+	}
+
+	if single_file:
+		info[b'length'] = total_length
+	else:
+		info[b'files'] = [{b'length': length, b'path': [s.encode('utf-8') for s in segments]}
+			for (_, length, segments) in v1_files]
+		for (file_dict, (file_path, _, _)) in zip(info[b'files'], v1_files):
+			if file_path is None:
+				file_dict[b'attr'] = b'p'
+
+	if hybrid:
+		info[b'meta version'] = 2
+		info[b'file tree'] = build_file_tree(files, roots, single_file)
+		if single_file:
+			info[b'file tree'] = {name.encode('utf-8'): info[b'file tree']}
+
+	if private:
+		info[b'private'] = 1
+
+	metainfo = {
+		b'announce': announce.encode('utf-8'),
+		b'created by': b'bt_sr_client',
+		b'creation date': int(time.time()),
+		b'encoding': b'UTF-8',
+		b'info': info
+	}
+
+	if hybrid:
+		metainfo[b'piece layers'] = {root: layer for (root, layer) in roots if layer}
+
+	if announce_list:
+		metainfo[b'announce-list'] = [[url.encode('utf-8') for url in tier] for tier in announce_list]
+
+	if url_list:
+		metainfo[b'url-list'] = [url.encode('utf-8') for url in url_list]
+
+	if comment:
+		metainfo[b'comment'] = comment.encode('utf-8')
+
+	return bencodepy.encode(metainfo)
+
+
+def create_main(argv):
+
+	parser = argparse.ArgumentParser(prog='create', description='create a .torrent file')
+	parser.add_argument('path', help='file or directory to share')
+	parser.add_argument('-a', '--announce', action='append', required=True,
+		help='tracker URL; repeat for backup trackers (each becomes its own announce-list tier)')
+	parser.add_argument('-w', '--web-seed', action='append', help='URL of an HTTP server hosting the files; repeatable')
+	parser.add_argument('-o', '--output', help='defaults to <name>.torrent')
+	parser.add_argument('--piece-length', type=int, help='KiB, a power of two (default: picked from the size)')
+	parser.add_argument('--processes', type=int, help='hashing processes (default: number of CPUs)')
+	parser.add_argument('--comment', type=str)
+	parser.add_argument('--private', default=False, action='store_true')
+	parser.add_argument('--hybrid', default=False, action='store_true',
+		help='v1 + v2 (BEP 52) torrent, lets v2 downloaders check each 16 KiB block')
+
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.INFO)
+
+	announce_list = [[url] for url in args.announce] if len(args.announce) > 1 else None
+	piece_length = args.piece_length * 1024 if args.piece_length else None
+
+	contents = create_torrent(args.path, args.announce[0], announce_list, piece_length, args.comment,
+		args.private, args.processes, args.web_seed, args.hybrid)
+
+	output = args.output or os.path.basename(os.path.abspath(args.path).rstrip(os.sep)) + '.torrent'
+	with open(output, 'wb') as f:
+		f.write(contents)
+
+	print(output)
+
+
+class TorrentCreateError(Exception):
+	pass
@@ -3,6 +3,8 @@ import voluptuous as vol
 import hashlib
 import os
 
+import merkle
+
 # Read the torrent file using this function 
 def file_read(filepath):
 	f = open(filepath,"rb")
@@ -37,14 +39,31 @@ class TorrentMetainfo():
 		except:
 			raise f'Invalid Url {self.announce}'
 
+		# Web seeds (BEP 19) - a single URL or a list of them
+		url_list = content.get(b'url-list') or []
+		if isinstance(url_list, bytes):
+			url_list = [url_list]
+		self.url_list = [url.decode("utf-8") for url in url_list if url]
+
 			
 		info_dict = content[b'info']
 		
 		# 2 --  Name of the torrent 
 		self.name = info_dict[b'name'].decode("utf-8")
+
+		# private torrents (BEP 27) get their peers from the tracker only - no peer exchange
+		self.private = info_dict.get(b'private') == 1
 		
 		# 3 --  Hash of the bencoded info dictionary 
 		self.info_hash = hashlib.sha1(bencodepy.encode(info_dict)).digest()
+
+		# v2 torrents (BEP 52) are identified by the sha256 instead, cut to 20 bytes in handshakes and announces.
+		# hybrid torrents carry both a v1 and a v2 description of the same data, and can join either swarm
+		self.info_hash_v2 = None
+		if info_dict.get(b'meta version') == 2:
+			self.info_hash_v2 = hashlib.sha256(bencodepy.encode(info_dict)).digest()
+			if b'pieces' not in info_dict: # v2 only
+				self.info_hash = self.info_hash_v2[:20]
 		
 		# 4 --  Info dictionary parsed into an "Info" dictionary that contains
 			# a) piece length - length of each piece 
@@ -58,6 +77,8 @@ class TorrentMetainfo():
 
 		self.info = self.parse_info_dict(info_dict)
 
+		if self.info_hash_v2:
+			self.parse_v2_info(info_dict, content.get(b'piece layers') or {})
 
 	def parse_info_dict(self,info_dict):
 
@@ -75,12 +96,15 @@ class TorrentMetainfo():
 
 		info['piece_length'] = info_dict[b'piece length']
 
+		if b'pieces' not in info_dict: # v2 only - pieces and files come from the file tree
+			return info
+
 		SHA_LEN  = 20
 		sha_pieces = info_dict[b'pieces']
 
 		info['pieces']=[]
 		for i in range(0,len(sha_pieces),SHA_LEN):
-			info['pieces'].append([sha_pieces[i:i+SHA_LEN]])
+			info['pieces'].append(sha_pieces[i:i+SHA_LEN])
 
 		try:
 			files = info_dict[b'files']
@@ -102,15 +126,102 @@ class TorrentMetainfo():
 				path_seg = [p.decode("utf-8") for p in file_dict[b'path']]
 				info['files'].append({
 					'length': file_dict[b'length'],
-					'path': os.path.join(*path_seg)
+					'path': os.path.join(*path_seg),
+					'padding': b'p' in file_dict.get(b'attr', b'') # BEP 47 - zeros that align the next file to a piece
 					})
 			info['length']=sum(f['length'] for f in info['files'])
 
 		return info
-		
+
+	def parse_v2_info(self, info_dict, piece_layers):
+		"""
+		The v2 half of the metainfo: the file tree, and the piece layers (outside the info dict, keyed by pieces root)
+		v2 pieces never span files, so every piece lies in one file. info['v2_pieces'][i] is a tuple
+			(pieces root of its file, index in the file, hash, width, offset, length)
+		where the hash is the root of the piece's subtree, `width` 16 KiB leaves wide, and offset is where the piece
+		starts with the files back to back. Hybrid torrents pad their v1 files to piece boundaries, so the
+		pieces of both halves line up; v2 only torrents take their pieces and files from here
+		"""
+
+		info = self.info
+		piece_length = info['piece_length']
+		if piece_length < merkle.BLOCK_SIZE or piece_length & (piece_length - 1):
+			raise TorrentMetainfoError('v2 piece length must be a power of two of at least 16 KiB')
+
+		leaves_per_piece = piece_length // merkle.BLOCK_SIZE
+		depth = leaves_per_piece.bit_length() - 1
+
+		files = []
+		self.walk_file_tree(info_dict[b'file tree'], [], files)
+
+		v2_pieces = []
+		pieces_roots = {} # pieces root -> index of the file's first piece
+		offset = 0
+
+		for f in files:
+			root = f['pieces_root']
+			num_pieces = (f['length'] + piece_length - 1) // piece_length
+
+			if num_pieces == 1: # the whole file is one piece, the root is its hash
+				num_leaves = (f['length'] + merkle.BLOCK_SIZE - 1) // merkle.BLOCK_SIZE
+				hashes = [root]
+				width = merkle.next_power_of_two(num_leaves)
+
+			elif num_pieces > 1:
+				layer = piece_layers.get(root, b'')
+				hashes = merkle.split_hashes(layer)
+				if len(hashes) != num_pieces or merkle.merkle_root(hashes, depth=depth) != root:
+					raise TorrentMetainfoError('Missing or bad piece layer for %s' % f['path'])
+				width = leaves_per_piece
+
+			else:
+				continue
+
+			pieces_roots[root] = len(v2_pieces)
+			for (j, h) in enumerate(hashes):
+				length = min(piece_length, f['length'] - j*piece_length)
+				v2_pieces.append((root, j, h, width, offset, length))
+				offset += length
+
+		info['meta_version'] = 2
+		info['v2_pieces'] = v2_pieces
+		info['pieces_roots'] = pieces_roots
+
+		if 'pieces' not in info: # v2 only
+			info['pieces'] = [p[2] for p in v2_pieces]
+			info['length'] = offset
+			if len(files) == 1 and files[0]['path'] == self.name:
+				info['format'] = 'SINGLE_FILE'
+				info['files'] = 'NONE'
+			else:
+				info['format'] = 'MULTIPLE_FILE'
+				info['files'] = files
+			return
+
+		info['hybrid'] = True
+
+		v1_lengths = [info['length']] if info['format'] == 'SINGLE_FILE' else [f['length'] for f in info['files'] if not f['padding']]
+		if v1_lengths != [f['length'] for f in files] or len(v2_pieces) != len(info['pieces']):
+			raise TorrentMetainfoError('v1 and v2 parts of the hybrid torrent describe different data')
+
+	def walk_file_tree(self, tree, path_seg, files):
+		""" files of a v2 file tree, depth first in name order: a file is a node with an empty key """
+
+		for (name, node) in sorted(tree.items()):
+			if name == b'':
+				files.append({
+					'length': node[b'length'],
+					'path': os.path.join(*path_seg),
+					'pieces_root': node.get(b'pieces root') # none for empty files
+					})
+			else:
+				self.walk_file_tree(node, path_seg + [name.decode("utf-8")], files)
 
 	def get_piece_length(self,indx):
 
+		if self.info.get('meta_version') == 2 and not self.info.get('hybrid'):
+			return self.info['v2_pieces'][indx][5]
+
 		num_pieces = len(self.info['pieces'])
 		if indx == num_pieces-1:
 			piece_length = self.info['length'] - ( (num_pieces-1)*self.info['piece_length'] )
@@ -118,3 +229,15 @@ class TorrentMetainfo():
 			piece_length = self.info['piece_length']
 
 		return piece_length
+
+	def get_piece_offset(self, indx):
+		""" where the piece starts in the torrent's data, the files back to back """
+
+		if self.info.get('meta_version') == 2 and not self.info.get('hybrid'):
+			return self.info['v2_pieces'][indx][4]
+
+		return indx * self.info['piece_length']
+
+
+class TorrentMetainfoError(Exception):
+	pass
@@ -0,0 +1,219 @@
+"""
+Torrent queueing by swarm health - only the best CONFIG['queue_max_active'] torrents of the session run at a time
+
+Connections and bandwidth spread over every torrent the session holds go mostly to swarms that can't deliver.
+The queue scrapes each tracker for all of its torrents at once (a batched multi info hash scrape), keeps the
+seeder and leecher counts on the torrents (announces update them too), and every CONFIG['queue_interval']
+seconds ranks the unfinished torrents:
+
+	score = log(1 + seeders + leechers/5 + web seeds) * (1 + fraction we already have)
+
+- more sources help with diminishing returns, and a torrent close to done is cheap to finish. The top K run,
+the rest are paused. A running torrent that has made no progress for CONFIG['queue_stall_time'] is benched -
+scored 0 for CONFIG['queue_bench_time'] - so it rotates out and a waiting one gets its turn; swarms with
+no sources at all score 0 anyway, and only run when nothing better is waiting.
+
+"""
+
+import functools
+import logging
+import math
+
+from config import CONFIG
+from tracker import TorrentTracker
+
+log = logging.getLogger(__name__)
+
+MAX_SCRAPE_HASHES = 50 # info hashes per scrape request, keeps the URL a sane length
+RUNNING_BONUS = 1.25 # a waiting torrent has to be this much better to take a running one's slot
+
+
+class TorrentQueue():
+
+	def __init__(self, conn_man, max_active=None, interval=None):
+
+		self.conn_man = conn_man
+		self.max_active = max_active or CONFIG['queue_max_active']
+		self.interval = interval or CONFIG['queue_interval']
+
+		self.torrents = [] # in the order they were added - breaks ties between equal scores
+		self.queued = set() # torrents we hold back: not started yet, or paused by us
+		self.held = set() # torrents the user paused - out of the rotation until they resume them
+		self.last_progress = {} # running torrent -> (bytes_downloaded, time it last went up)
+		self.benched = {} # torrent -> time until which it scores 0
+		self.last_scrape = None
+		self.timer = None
+
+	def add(self, torrent):
+
+		self.torrents.append(torrent)
+		self.queued.add(torrent)
+
+		if self.timer: # already running - see whether it gets a slot now
+			self.update()
+
+	def remove(self, torrent):
+
+		if torrent in self.torrents:
+			self.torrents.remove(torrent)
+		self.queued.discard(torrent)
+		self.held.discard(torrent)
+		self.last_progress.pop(torrent, None)
+		self.benched.pop(torrent, None)
+
+	def pause(self, torrent):
+		""" a user pause - the torrent gives up its slot, or its place in the queue, until resume() """
+
+		if torrent not in self.torrents:
+			torrent.pause()
+			return
+
+		self.queued.discard(torrent)
+		self.held.add(torrent)
+		self.last_progress.pop(torrent, None)
+		torrent.pause()
+
+		if self.timer: # its slot goes to the next in line
+			self.update()
+
+	def resume(self, torrent):
+		""" back in the queue - it runs when it ranks in the top max_active, like a newly added torrent """
+
+		if torrent not in self.torrents:
+			torrent.resume()
+			return
+
+		if torrent in self.held:
+			self.held.discard(torrent)
+			self.queued.add(torrent)
+
+		if self.timer:
+			self.update()
+
+	def start(self):
+
+		self.update()
+		self.scrape()
+		self.timer = self.conn_man.call_later(self.interval, self.handle_timer)
+
+	def stop(self):
+
+		if self.timer:
+			self.timer.cancel()
+			self.timer = None
+
+	def handle_timer(self):
+
+		self.timer = None
+		if self.last_scrape is None or self.conn_man.now() - self.last_scrape >= CONFIG['scrape_interval']:
+			self.scrape()
+		self.update()
+		self.timer = self.conn_man.call_later(self.interval, self.handle_timer)
+
+	def get_running(self):
+		""" torrents using a slot - started and not paused, by us or the user (the ones in held) """
+
+		return [t for t in self.torrents if t not in self.queued and not t.is_paused and not t.is_complete]
+
+	def get_score(self, torrent, now):
+
+		if self.benched.get(torrent, 0) > now:
+			return 0.0
+
+		if torrent.num_seeders is None: # not scraped yet - assume somebody has it
+			sources = 1.0
+		else:
+			sources = torrent.num_seeders + (torrent.num_leechers or 0) / 5.0
+		sources += len(torrent.web_seeds)
+
+		progress = torrent.num_complete / max(len(torrent.complete_pieces), 1)
+
+		return math.log1p(sources) * (1 + progress)
+
+	def update(self):
+		""" rank the unfinished torrents, run the top max_active and pause the rest """
+
+		now = self.conn_man.now()
+
+		for t in [t for t in self.torrents if t.is_complete]:
+			self.remove(t)
+
+		running = self.get_running()
+		self.check_progress(running, now)
+
+		candidates = running + [t for t in self.torrents if t in self.queued]
+		order = dict((t, i) for (i, t) in enumerate(self.torrents))
+
+		def rank(t):
+			score = self.get_score(t, now)
+			return (-(score * RUNNING_BONUS if t in running else score), order[t])
+
+		candidates.sort(key=rank)
+		chosen = set(candidates[:self.max_active])
+
+		for t in running:
+			if t not in chosen:
+				log.info('queue: pausing %s (seeders %s, leechers %s)' % (t, t.num_seeders, t.num_leechers))
+				t.pause()
+				self.queued.add(t)
+				self.last_progress.pop(t, None)
+
+		for t in candidates[:self.max_active]:
+			if t in self.queued:
+				log.info('queue: starting %s (seeders %s, leechers %s)' % (t, t.num_seeders, t.num_leechers))
+				self.queued.discard(t)
+				self.last_progress[t] = (t.bytes_downloaded, now)
+				if t.tracker is None:
+					t.start_torrent()
+				else:
+					t.resume()
+
+	def check_progress(self, running, now):
+		""" bench the running torrents that have been stuck for queue_stall_time """
+
+		for t in running:
+			(last_bytes, since) = self.last_progress.get(t, (t.bytes_downloaded, now))
+
+			if t.bytes_downloaded > last_bytes:
+				self.last_progress[t] = (t.bytes_downloaded, now)
+			elif now - since >= CONFIG['queue_stall_time']:
+				log.info('queue: %s made no progress for %ds, benching it' % (t, now - since))
+				self.benched[t] = now + CONFIG['queue_bench_time']
+				self.last_progress[t] = (t.bytes_downloaded, now)
+			else:
+				self.last_progress[t] = (last_bytes, since)
+
+	# ========= Scrape ========= #
+
+	def scrape(self):
+		""" one scrape per tracker (in batches) for all our unfinished torrents """
+
+		self.last_scrape = self.conn_man.now()
+
+		by_tracker = {}
+		for t in self.torrents:
+			url = TorrentTracker.get_scrape_url(t.metainfo.announce)
+			if url and not t.is_complete:
+				by_tracker.setdefault(url, []).append(t)
+
+		for (url, torrents) in by_tracker.items():
+			for i in range(0, len(torrents), MAX_SCRAPE_HASHES):
+				batch = torrents[i:i + MAX_SCRAPE_HASHES]
+				self.conn_man.run_in_thread(
+					functools.partial(TorrentTracker.fetch_scrape, url, [t.metainfo.info_hash for t in batch]),
+					functools.partial(self.handle_scrape, batch),
+					functools.partial(self.handle_scrape_failed, url))
+
+	def handle_scrape(self, torrents, files):
+
+		for t in torrents:
+			stats = files.get(t.metainfo.info_hash)
+			if stats is not None:
+				t.set_swarm_info(stats['complete'], stats['incomplete'])
+
+		self.update()
+
+	def handle_scrape_failed(self, url, error):
+
+		# not fatal - announces still report the swarm size of the running torrents
+		log.warning('queue: scrape of %s failed: %s' % (url, error))
@@ -1,7 +1,36 @@
 from nose.tools import *
+import hashlib
+import tempfile
 
 from torrent import Torrent
 from tracker import TorrentTracker, AnnounceDecodeError
+from client import SaiClient
+from daemon import SaiDaemon, METHOD_NOT_FOUND, INVALID_PARAMS
+from peer_cache import PeerCache
+from simulator import SimSwarm, VirtualClock
+from config import CONFIG
+from rate_limiter import TokenBucket
+from torrent_creator import create_torrent, hash_pieces, collect_files, choose_piece_length
+from torrent_metainfo import TorrentMetainfo
+import os
+import threading
+import http.server
+import random
+import socket
+import struct
+from peer import TorrentPeer, PeerProtocolError
+from peer_listener import PeerListener
+from lsd import LocalServiceDiscovery
+from utp import UTPMultiplexer, encode_packet, decode_packet, ST_DATA
+from pex import build_pex, parse_pex
+from torrent_queue import TorrentQueue
+from peer_trace import TraceRecorder, ReplayConnectionManager, load_traces, CONNECTED, RECEIVED, SENT, LOST
+from memory_benchmark import measure, check_budgets, BUDGETS
+from blocklist import IPBlocklist
+import gzip
+import urllib.parse
+import bencodepy
+import merkle
 
 
 def test_torrent_peer():
@@ -31,5 +60,1165 @@ def test_torrent_peer():
 	assert(len(torrent.peers)==2)
 	print('finished')
 
+
+def test_peer_piece_map():
+
+	class MockMetainfo():
+		def __init__(self):
+			self.info = {
+			'pieces' : [b'x'*20 for _ in range(10)]
+			}
+
+	torrent = Torrent(None, MockMetainfo())
+	peer = torrent.add_peer({'ip':'1.1.1.1', 'port':3})
+	peer.is_started = True # pretend the handshake is done; no conn so nothing is written
+
+	peer.handle_message({'msg_id':5, 'payload':b'\xa0\x40'}) # pieces 0, 2 and 9
+	assert_equal(list(peer.peer_pieces.search(1)), [0,2,9])
+	assert(peer.am_interested)
+
+	torrent.have_pieces[0] = 1
+	torrent.have_pieces[2] = 1
+	assert_equal(peer._choose_next_piece(), 9)
+
+	torrent.have_pieces[9] = 1
+	assert(not peer.wanted_pieces().any())
+
+
+def test_progress_counters():
+
+	data = [b'a'*8, b'b'*8, b'c'*4]
+
+	class MockMetainfo():
+		def __init__(self):
+			self.info_hash = b'i'*20
+			self.name = 'mock'
+			self.info = {
+			'pieces' : [hashlib.sha1(d).digest() for d in data]
+			}
+
+		def get_piece_length(self, index):
+			return len(data[index])
+
+	completed = []
+	torrent = Torrent(None, MockMetainfo(), lambda t, d: completed.append(d))
+	peer = torrent.add_peer({'ip':'1.1.1.1', 'port':3})
+
+	torrent.handle_piece_requested(peer, 1)
+	assert_equal(torrent.get_stats()['pieces_in_flight'], 1)
+	assert_equal(torrent.get_stats()['peers']['new'], 1)
+
+	torrent.handle_block(peer, 1, 0, data[1])
+	stats = torrent.get_stats()
+	assert_equal((stats['pieces_complete'], stats['pieces_in_flight']), (1, 0))
+	assert(not completed)
+
+	torrent.handle_block(peer, 0, 0, data[0])
+	torrent.handle_block(peer, 2, 0, data[2])
+	assert(torrent.is_complete)
+	assert_equal(completed, [b''.join(data)])
+
+
+def test_have_broadcast():
+
+	data = [b'a'*8, b'b'*8]
+
+	class MockMetainfo():
+		def __init__(self):
+			self.info_hash = b'i'*20
+			self.name = 'mock'
+			self.info = {
+			'pieces' : [hashlib.sha1(d).digest() for d in data]
+			}
+
+		def get_piece_length(self, index):
+			return len(data[index])
+
+	class MockConn():
+		def __init__(self):
+			self.written = b''
+		def write(self, data):
+			self.written += data
+		def disconnect(self):
+			pass
+
+	torrent = Torrent(None, MockMetainfo())
+	sender = torrent.add_peer({'ip':'1.1.1.1', 'port':3})
+
+	# the have for a completed piece skips the peers whose bitfield had it - but not peers without a bitfield
+	peers = []
+	for (ip, bitfield) in (('2.2.2.2', b'\x40'), ('3.3.3.3', b'\x80'), ('4.4.4.4', None)):
+		p = torrent.add_peer({'ip':ip, 'port':3})
+		p.is_started = True # pretend the handshake is done
+		if bitfield:
+			p.handle_message({'msg_id':5, 'payload':bitfield})
+		p.conn = MockConn()
+		p.set_state('active')
+		peers.append(p)
+	assert_equal(torrent.get_stats()['peers']['active'], 3)
+
+	torrent.handle_block(sender, 1, 0, data[1])
+	have = TorrentPeer.build_message('have', index=1)
+	assert_equal([p.conn.written for p in peers], [b'', have, have])
+
+
+def test_daemon_requests():
+
+	class MockMetainfo():
+		def __init__(self):
+			self.info_hash = b'i'*20
+			self.name = 'mock'
+			self.info = {
+			'pieces' : [b'x'*20 for _ in range(4)]
+			}
+
+	client = SaiClient(keep_running=True)
+	torrent = Torrent(None, MockMetainfo())
+	client.active_torrents.append(torrent)
+	daemon = SaiDaemon(client, '/tmp/unused.sock')
+
+	resp = daemon.handle_request_line(b'{"jsonrpc": "2.0", "id": 1, "method": "get_stats"}')
+	assert_equal(resp['result'][(b'i'*20).hex()]['pieces_total'], 4)
+
+	resp = daemon.handle_request({'jsonrpc': '2.0', 'id': 2, 'method': 'pause_torrent', 'params': {'info_hash': (b'i'*20).hex()}})
+	assert(resp['result'])
+	assert(torrent.is_paused)
+
+	resp = daemon.handle_request({'jsonrpc': '2.0', 'id': 3, 'method': 'pause_torrent', 'params': {'info_hash': 'ff'}})
+	assert_equal(resp['error']['code'], INVALID_PARAMS)
+
+	resp = daemon.handle_request({'jsonrpc': '2.0', 'id': 4, 'method': 'nope'})
+	assert_equal(resp['error']['code'], METHOD_NOT_FOUND)
+
+
+def test_peer_cache():
+
+	info_hash = b'i'*20
+	now = [1000.0]
+	cache_dir = tempfile.mkdtemp()
+
+	cache = PeerCache(cache_dir, clock=lambda: now[0])
+	cache.record_success(info_hash, '1.1.1.1', 1, 1000.0)
+	cache.record_success(info_hash, '2.2.2.2', 2, 50000.0)
+	cache.record_failure(info_hash, '3.3.3.3', 3)
+	cache.save(info_hash)
+
+	now[0] += 60
+	cache = PeerCache(cache_dir, clock=lambda: now[0]) # a fresh process reads the file back
+	assert_equal(cache.get_best_peers(info_hash, 2), [{'ip':'2.2.2.2', 'port':2}, {'ip':'1.1.1.1', 'port':1}])
+
+	for _ in range(3):
+		cache.record_failure(info_hash, '2.2.2.2', 2)
+	assert_equal(cache.get_best_peers(info_hash, 5), [{'ip':'1.1.1.1', 'port':1}])
+
+
+def test_request_timeout_reassigns_piece():
+
+	class MockTimer():
+		def __init__(self, delay, func):
+			self.delay = delay
+			self.func = func
+			self.cancelled = False
+
+		def cancel(self):
+			self.cancelled = True
+
+	class MockConnMan():
+		def __init__(self):
+			self.timers = []
+
+		def now(self):
+			return 0.0
+
+		def call_later(self, delay, func, *args):
+			self.timers.append(MockTimer(delay, func))
+			return self.timers[-1]
+
+	class MockMetainfo():
+		def __init__(self):
+			self.info_hash = b'i'*20
+			self.name = 'mock'
+			self.info = {
+			'pieces' : [b'x'*20 for _ in range(2)]
+			}
+
+		def get_piece_length(self, index):
+			return 2**15 # two blocks
+
+	conn_man = MockConnMan()
+	torrent = Torrent(conn_man, MockMetainfo())
+	slow = torrent.add_peer({'ip':'1.1.1.1', 'port':3})
+	other = torrent.add_peer({'ip':'2.2.2.2', 'port':3})
+
+	for peer in (slow, other):
+		peer.is_started = True
+		peer.peer_choking = False
+		peer.peer_pieces.setall(1)
+
+	slow.run_download()
+	assert_equal((slow.requested_piece, slow.requested_block), (0, 0))
+
+	conn_man.timers[-1].func() # the request times out
+	assert_equal(slow.stalls, 1)
+	assert_equal(slow.requested_piece, None)
+	assert(not torrent.requested_pieces[0])
+
+	other.run_download()
+	assert_equal(other.requested_piece, 0) # piece 0 went back to the picker
+
+	other.handle_message({'msg_id':0, 'payload':b''}) # choke
+	assert_equal(other.requested_piece, None)
+	assert(not torrent.requested_pieces[0])
+
+	# the block that timed out turns up late - it is kept, but the slow peer still sits out its backoff
+	slow.handle_message({'msg_id':7, 'payload':struct.pack('!LL', 0, 0) + bytes(2**14)})
+	assert_equal(sorted(torrent.piece_blocks[0]), [0])
+	assert_equal(slow.requested_piece, None)
+
+	slow.timer.func() # backoff over
+	assert_equal((slow.requested_piece, slow.requested_block), (0, 2**14))
+
+	# a short block doesn't answer the request - it is dropped, and the request times out as if nothing came
+	slow.handle_message({'msg_id':7, 'payload':struct.pack('!LL', 0, 2**14) + bytes(100)})
+	assert_equal(sorted(torrent.piece_blocks[0]), [0])
+	assert_equal(slow.requested_block, 2**14)
+	assert(not slow.timer.cancelled)
+
+	slow.timer.func()
+	assert_equal((slow.stalls, slow.requested_piece), (2, None))
+	assert(not torrent.requested_pieces[0])
+
+
+def test_simulated_swarm():
+
+	def run(seed):
+		swarm = SimSwarm(num_pieces=300, piece_length=2**15, seed=seed)
+		swarm.add_peers(20, bandwidth=2e5, pieces=0.3)
+		swarm.add_peers(5, pieces=1.0, loss=0.5)
+		swarm.add_peers(5, pieces=1.0, choke_prob=0.2)
+		swarm.add_peers(5, refuse=True)
+		return swarm.run()
+
+	state = random.getstate()
+	result = run(7)
+	assert(result['completed'])
+	assert_equal(random.getstate(), state) # the run has its own generators, the random module is untouched
+	assert_equal(result['torrent']['pieces_complete'], 300)
+
+	again = run(7) # same seed, same run
+	assert_equal((again['sim_time'], again['events']), (result['sim_time'], result['events']))
+
+
+def test_adaptive_max_peers():
+
+	def run(adaptive):
+		CONFIG['adaptive_max_peers'] = adaptive
+		swarm = SimSwarm(num_pieces=1000, piece_length=2**15, seed=3)
+		swarm.add_peers(200, bandwidth=5e4, pieces=0.5) # many slow peers - 8 of them is not enough
+		return swarm.run()
+
+	try:
+		fixed = run(False)
+		adaptive = run(True)
+	finally:
+		CONFIG['adaptive_max_peers'] = True
+
+	assert(adaptive['completed'])
+	assert(adaptive['torrent']['max_peers'] > CONFIG['max_peers'])
+	assert(adaptive['sim_time'] < fixed['sim_time'])
+
+
+def test_token_bucket_hierarchy():
+
+	now = [0.0]
+	session = TokenBucket(10000, burst=10000, clock=lambda: now[0])
+	torrent = TokenBucket(0, parent=session) # unlimited itself, still bound by the session
+	peer = TokenBucket(1000, burst=1000, parent=torrent)
+
+	assert_equal(peer.consume(500), 0.0)
+	assert_equal(peer.consume(1500), 1.0) # peer bucket is 1000 bytes in debt at 1000 B/s
+	assert_equal(session.get_stats(), {'rate_limit': 10000, 'bytes': 2000})
+
+	now[0] = 1.0
+	assert_equal(peer.get_delay(), 0.0)
+
+	other = TokenBucket(0, parent=torrent)
+	assert_equal(other.consume(20000), 1.0) # the (refilled) session bucket is 10000 in debt at 10000 B/s
+
+	session.set_rate(0) # limits change at runtime
+	assert_equal(other.get_delay(), 0.0)
+
+
+def test_smart_ban():
+
+	good = [b'a'*2**14, b'b'*2**14]
+
+	class MockMetainfo():
+		def __init__(self):
+			self.info_hash = b'i'*20
+			self.name = 'mock'
+			self.info = {
+			'pieces' : [hashlib.sha1(b''.join(good)).digest()]
+			}
+
+		def get_piece_length(self, index):
+			return 2**15
+
+	torrent = Torrent(None, MockMetainfo())
+	honest = torrent.add_peer({'ip':'1.1.1.1', 'port':3})
+	liar = torrent.add_peer({'ip':'6.6.6.6', 'port':3})
+
+	torrent.handle_block(honest, 0, 0, good[0])
+	torrent.handle_block(liar, 0, 2**14, b'X'*2**14)
+	assert_equal(torrent.num_hash_failures, 1)
+	assert(not torrent.have_pieces[0]) # discarded, to be downloaded again
+	assert(not torrent.banned_ips) # can't tell who it was yet
+
+	torrent.handle_block(honest, 0, 0, good[0])
+	torrent.handle_block(honest, 0, 2**14, good[1])
+	assert(torrent.have_pieces[0])
+	assert_equal(torrent.banned_ips, {'6.6.6.6'})
+	assert_equal(torrent.add_peer({'ip':'6.6.6.6', 'port':4}), None)
+
+def test_simulated_corrupt_peer():
+
+	swarm = SimSwarm(num_pieces=200, seed=5)
+	swarm.add_peers(10, pieces=1.0)
+	swarm.add_peer(pieces=1.0, corrupt=1.0)
+	result = swarm.run()
+
+	assert(result['completed'])
+	assert_equal(result['torrent']['banned_ips'], 1)
+	assert_equal(result['torrent']['hash_failures'], 1) # the first bad piece is all it costs
+
+
+def test_create_torrent():
+
+	base = tempfile.mkdtemp()
+	data = {
+		'a.bin': os.urandom(50000),
+		'empty': b'',
+		os.path.join('sub', 'b.bin'): os.urandom(3*2**14 + 7), # pieces span the file boundaries
+	}
+	os.makedirs(os.path.join(base, 'set', 'sub'))
+	for (name, contents) in data.items():
+		with open(os.path.join(base, 'set', name), 'wb') as f:
+			f.write(contents)
+
+	contents = create_torrent(os.path.join(base, 'set'), 'http://tracker.example.com/announce', piece_length=2**14)
+	metainfo = TorrentMetainfo(contents)
+
+	everything = data['a.bin'] + data[os.path.join('sub', 'b.bin')] # sorted order, empty file adds nothing
+	expected = [hashlib.sha1(everything[i:i+2**14]).digest() for i in range(0, len(everything), 2**14)]
+
+	assert_equal(metainfo.name, 'set')
+	assert_equal(metainfo.info['pieces'], expected)
+	assert_equal(metainfo.info['length'], len(everything))
+	assert_equal([f['path'] for f in metainfo.info['files']], ['a.bin', 'empty', os.path.join('sub', 'b.bin')])
+
+	# the process pool gives the same answer as hashing in-process - with no threshold, even for this little data
+	(_, files) = collect_files(os.path.join(base, 'set'))
+	assert_equal(hash_pieces(files, 2**14, processes=1), b''.join(expected))
+	assert_equal(hash_pieces(files, 2**14, processes=2, min_pool_length=0), b''.join(expected))
+
+	assert_equal(choose_piece_length(10**6), 2**14)
+	assert_equal(choose_piece_length(10**12), 2**24)
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+	""" serves self.server.files {path: bytes}, honouring single Range headers """
+
+	protocol_version = 'HTTP/1.1' # keep-alive
+
+	def do_GET(self):
+
+		content = self.server.files.get(self.path)
+		if content is None:
+			self.send_error(404)
+			return
+
+		first, last = 0, len(content) - 1
+		if 'Range' in self.headers:
+			(first, last) = (int(x) for x in self.headers['Range'].split('=')[1].split('-'))
+			self.send_response(206)
+		else:
+			self.send_response(200)
+
+		self.send_header('Content-Length', str(last - first + 1))
+		self.end_headers()
+		self.wfile.write(content[first:last + 1])
+
+	def log_message(self, *args):
+		pass
+
+
+def test_web_seed():
+
+	base = tempfile.mkdtemp()
+	data = {'a.bin': os.urandom(40000), 'b.bin': os.urandom(70000)}
+	os.makedirs(os.path.join(base, 'www'))
+	for (name, contents) in data.items():
+		with open(os.path.join(base, 'www', name), 'wb') as f:
+			f.write(contents)
+
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+	server.files = {'/files/www/' + name: contents for (name, contents) in data.items()}
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+
+	url = 'http://127.0.0.1:%d/' % server.server_address[1]
+	contents = create_torrent(os.path.join(base, 'www'), 'http://tracker.example.com/announce', piece_length=2**15,
+		url_list=[url + 'files', url + 'missing/']) # pieces span both files
+	metainfo = TorrentMetainfo(contents)
+	metainfo.announce = None # no tracker - the web seeds are the only source
+	assert_equal(metainfo.url_list, [url + 'files', url + 'missing/'])
+
+	swarm = SimSwarm(1) # just for its connection manager and clock
+	torrent = Torrent(swarm.conn_man, metainfo)
+	result = swarm.run(torrent)
+	server.shutdown()
+
+	assert result['completed']
+	assert_equal(b''.join(torrent.complete_pieces), data['a.bin'] + data['b.bin'])
+
+	(good, missing) = result['torrent']['web_seeds']
+	assert_equal(good['bytes'], len(data['a.bin']) + len(data['b.bin'])) # nothing fetched twice
+	assert missing['is_stopped'] # the server without the files was given up on
+
+
+class UTPEndpoint():
+	""" the peer side of a uTP connection - records what it is told """
+
+	download_limiter = None
+	upload_limiter = None
+
+	def __init__(self, payload):
+		self.payload = payload
+		self.received = bytearray()
+		self.events = []
+
+	def handle_connection_made(self, conn):
+		self.events.append('made')
+		conn.write(self.payload)
+
+	def handle_data_received(self, data):
+		self.received += data
+		if len(self.received) == len(self.payload): # both sides send the same amount
+			self.events.append('done')
+
+	def handle_connection_lost(self):
+		self.events.append('lost')
+
+	def handle_connection_failed(self):
+		self.events.append('failed')
+
+
+def test_utp_transfer():
+
+	packet = decode_packet(encode_packet(ST_DATA, 7, 1, 2, 3, 65535, 4, sack=b'\x05\0\0\0', payload=b'data'))
+	assert_equal((packet.type, packet.conn_id, packet.seq_nr, packet.ack_nr, packet.sack, packet.payload),
+		(ST_DATA, 7, 65535, 4, b'\x05\0\0\0', b'data'))
+
+	# two endpoints over a lossy link with jitter, so packets get dropped and reordered
+	clock = VirtualClock()
+	rng = random.Random(3)
+	muxes = {}
+
+	def link(src):
+		def send(data, addr):
+			if rng.random() > 0.05:
+				clock.call_later(0.02 + rng.random() * 0.01, muxes[addr].handle_datagram, data, src)
+		return send
+
+	(a, b) = (('10.0.0.1', 6881), ('10.0.0.2', 6881))
+	client = UTPEndpoint(os.urandom(300000))
+	server = UTPEndpoint(os.urandom(300000))
+	muxes[a] = UTPMultiplexer(clock, link(a))
+	muxes[b] = UTPMultiplexer(clock, link(b), accept_peer=lambda conn: server)
+
+	conn = muxes[a].connect(client, b)
+	clock.call_later(30.0, conn.disconnect)
+	clock.run(120.0)
+
+	assert_equal(bytes(client.received), server.payload)
+	assert_equal(bytes(server.received), client.payload)
+	assert_equal(client.events, ['made', 'done', 'lost'])
+	assert_equal(server.events, ['made', 'done', 'lost'])
+	assert conn.get_stats()['resent'] > 0
+	assert_equal(muxes[a].connections, {})
+	assert_equal(muxes[b].connections, {})
+
+	# nobody listening - the connection is refused, and 'auto' would fall back to TCP here
+	muxes[b].accept_peer = None
+	fell_back = []
+	muxes[a].connect(client, b, fallback=lambda: fell_back.append(True))
+	clock.run(130.0)
+	assert_equal(fell_back, [True])
+
+
+def test_incoming_peer_dispatch():
+
+	class MockMetainfo():
+		def __init__(self, info_hash):
+			self.info_hash = info_hash
+			self.name = 'mock'
+			self.announce = None
+			self.info = {'pieces': [b'x'*20 for _ in range(8)]}
+		def get_piece_length(self, index):
+			return 2**14
+
+	class MockConnection():
+		def __init__(self, ip, port):
+			self.address = (ip, port)
+			self.written = []
+			self.closed = False
+			self.peer = None
+		def write(self, data):
+			self.written.append(data)
+		def disconnect(self): # like a real transport, tell the peer
+			if not self.closed:
+				self.closed = True
+				self.peer.handle_connection_lost()
+		def get_address(self):
+			return self.address
+
+	conn_man = SimSwarm(1).conn_man
+	listener = PeerListener(conn_man)
+	torrents = [Torrent(conn_man, MockMetainfo(bytes([i])*20)) for i in range(3)]
+	for t in torrents:
+		listener.add_torrent(t)
+
+	def connect(info_hash, ip, port, peer_id):
+		conn = MockConnection(ip, port)
+		conn.peer = listener.accept(conn)
+		conn.peer.handle_connection_made(conn)
+		handshake = TorrentPeer.build_handshake(info_hash, peer_id)
+		conn.peer.handle_data_received(handshake[:30]) # handshakes can arrive in pieces
+		conn.peer.handle_data_received(handshake[30:])
+		return conn
+
+	target = torrents[1]
+	target.max_peers = 2
+
+	conn = connect(target.metainfo.info_hash, '1.1.1.1', 50000, b'A'*20)
+	peer = conn.peer
+	assert isinstance(peer, TorrentPeer)
+	assert_equal((peer.torrent, peer.state, peer.is_incoming), (target, 'active', True))
+	our_handshake = TorrentPeer.decode_handshake(conn.written[0])
+	assert_equal((our_handshake['info_hash'], our_handshake['peer_id']), (target.metainfo.info_hash, CONFIG['peer_id']))
+	assert not conn.closed
+
+	assert connect(b'z'*20, '1.1.1.2', 50000, b'B'*20).closed # not one of ours
+	assert connect(target.metainfo.info_hash, '1.1.1.1', 50001, b'A'*20).closed # same client again
+	assert not connect(target.metainfo.info_hash, '1.1.1.3', 50000, b'C'*20).closed
+	assert connect(target.metainfo.info_hash, '1.1.1.4', 50000, b'D'*20).closed # over max_peers
+	assert_equal(target.num_active_peers(), 2)
+	assert_equal(torrents[0].peers, [])
+
+	target.ban_ip('1.1.1.5')
+	assert connect(target.metainfo.info_hash, '1.1.1.5', 50000, b'E'*20).closed
+
+
+def test_local_service_discovery():
+
+	class MockMetainfo():
+		def __init__(self, info_hash):
+			self.info_hash = info_hash
+			self.name = 'mock'
+			self.announce = None
+			self.info = {'pieces': [b'x'*20 for _ in range(8)]}
+
+	group = ('239.192.152.143', 16771) # the BEP 14 group, on a port of our own
+
+	def multicast_socket():
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		sock.bind(('', group[1]))
+		sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+			struct.pack('4s4s', socket.inet_aton(group[0]), socket.inet_aton('127.0.0.1')))
+		sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton('127.0.0.1'))
+		sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+		sock.settimeout(0.5)
+		return sock
+
+	# three clients on this machine: two share torrent 'a', the third only has 'b' - and seeds it
+	conn_man = SimSwarm(1).conn_man
+	clients = []
+	for (port, info_hashes) in ((7001, [b'a'*20]), (7002, [b'a'*20, b'b'*20]), (7003, [b'b'*20])):
+		sock = multicast_socket()
+		listener = PeerListener(conn_man)
+		for info_hash in info_hashes:
+			listener.add_torrent(Torrent(conn_man, MockMetainfo(info_hash)))
+		lsd = LocalServiceDiscovery(conn_man, listener, lambda data, sock=sock: sock.sendto(data, group), port, group)
+		clients.append((sock, listener, lsd))
+
+	seed = clients[2][1].torrents[b'b'*20]
+	(seed.is_complete, seed.is_seeding) = (True, True) # complete, but still announced and dialling local peers
+
+	for (sock, listener, lsd) in clients:
+		lsd.announce()
+		lsd.announce() # too soon, not sent again
+
+	for (sock, listener, lsd) in clients:
+		for _ in range(3): # everyone's announce comes back to every socket, ours included
+			(data, addr) = sock.recvfrom(2048)
+			lsd.handle_datagram(data, addr)
+		sock.close()
+
+	def local_peers(client, info_hash):
+		torrent = client[1].torrents[info_hash]
+		return sorted((p.ip, p.port, p.state) for p in torrent.peers)
+
+	assert_equal(local_peers(clients[0], b'a'*20), [('127.0.0.1', 7002, 'connecting')]) # dialled right away
+	assert_equal(local_peers(clients[1], b'a'*20), [('127.0.0.1', 7001, 'connecting')])
+	assert_equal(local_peers(clients[1], b'b'*20), [('127.0.0.1', 7003, 'connecting')])
+	assert_equal(local_peers(clients[2], b'b'*20), [('127.0.0.1', 7002, 'connecting')])
+
+
+def test_v2_block_verification():
+
+	piece_length = 2**15
+	base = tempfile.mkdtemp()
+	data = {
+		'a.bin': os.urandom(80000), # three pieces, the last one short
+		'b.bin': os.urandom(20000), # one piece of two blocks
+		os.path.join('sub', 'c.bin'): os.urandom(5000),
+	}
+	os.makedirs(os.path.join(base, 'set', 'sub'))
+	for (name, contents) in data.items():
+		with open(os.path.join(base, 'set', name), 'wb') as f:
+			f.write(contents)
+
+	contents = create_torrent(os.path.join(base, 'set'), 'http://tracker.example.com/announce',
+		piece_length=piece_length, hybrid=True)
+	metainfo = TorrentMetainfo(contents)
+
+	# v1 files are padded to piece boundaries, so both halves have the same five pieces
+	assert_true(metainfo.info['hybrid'])
+	assert_equal([(f['path'], f['padding']) for f in metainfo.info['files']], [('a.bin', False),
+		(os.path.join('.pad', '18304'), True), ('b.bin', False), (os.path.join('.pad', '12768'), True),
+		(os.path.join('sub', 'c.bin'), False)])
+	assert_equal(len(metainfo.info['pieces']), 5)
+	assert_equal(metainfo.info['pieces_roots'][merkle.merkle_root(merkle.hash_blocks(data['b.bin']))], 3)
+
+	class MockPeer():
+		def __init__(self, ip):
+			self.ip = ip
+			self.requested_piece = None
+			self.conn = None
+		def run_download(self):
+			pass
+		def request_next_block(self, piece_index):
+			pass
+
+	def get_leaves(file_data, piece_in_file, width):
+		leaves = merkle.hash_blocks(file_data[piece_in_file*piece_length:(piece_in_file + 1)*piece_length])
+		return leaves + [bytes(32)] * (width - len(leaves))
+
+	def get_blocks(piece_index):
+		stream = data['a.bin'] + bytes(18304) + data['b.bin'] + bytes(12768) + data[os.path.join('sub', 'c.bin')]
+		piece = stream[piece_index*piece_length:(piece_index + 1)*piece_length]
+		return [(begin, piece[begin:begin + 2**14]) for begin in range(0, len(piece), 2**14)]
+
+	torrent = Torrent(None, metainfo)
+	(good, bad, early) = (MockPeer('1.1.1.1'), MockPeer('6.6.6.6'), MockPeer('7.7.7.7'))
+
+	# leaf hashes for piece 0 that don't add up to its piece hash are ignored
+	request = torrent.get_hash_request(0)
+	assert_equal((request['index'], request['length']), (0, 2))
+	torrent.handle_hashes(good, request, [bytes(32), bytes(32)])
+	assert_equal(torrent.piece_leaves, {})
+
+	torrent.handle_hashes(good, request, get_leaves(data['a.bin'], 0, 2))
+	assert_true(0 in torrent.piece_leaves)
+
+	# with the leaves in hand, a corrupt block is caught on arrival and its sender alone is banned
+	(begin, block) = get_blocks(0)[1]
+	torrent.handle_block(bad, 0, begin, bytes(len(block)))
+	assert_equal(torrent.banned_ips, set(['6.6.6.6']))
+	assert_equal(torrent.piece_blocks[0], None)
+
+	for (begin, block) in get_blocks(0):
+		torrent.handle_block(good, 0, begin, block)
+	assert_true(torrent.have_pieces[0])
+
+	# blocks that came before the hashes are checked when they arrive - the tail of b.bin runs into padding
+	blocks = get_blocks(3)
+	torrent.handle_block(early, 3, blocks[1][0], blocks[1][1][:3615] + bytes([blocks[1][1][3615] ^ 0xFF]) + blocks[1][1][3616:])
+	torrent.handle_hashes(good, torrent.get_hash_request(3), get_leaves(data['b.bin'], 0, 2))
+	assert_equal(torrent.banned_ips, set(['6.6.6.6', '7.7.7.7']))
+	assert_equal(torrent.piece_blocks[3], {})
+
+	for (begin, block) in blocks:
+		torrent.handle_block(good, 3, begin, block)
+	assert_true(torrent.have_pieces[3])
+	assert_equal(torrent.num_hash_failures, 2)
+
+	# the same data as a v2 only torrent: pieces follow the files back to back, checked by their merkle roots
+	content = bencodepy.decode(contents)
+	info = content[b'info']
+	for key in (b'pieces', b'files'):
+		del info[key]
+	metainfo = TorrentMetainfo(bencodepy.encode(content))
+
+	assert_equal(metainfo.info_hash, hashlib.sha256(bencodepy.encode(info)).digest()[:20])
+	assert_equal([metainfo.get_piece_offset(i) for i in range(5)], [0, 32768, 65536, 80000, 100000])
+	assert_equal([metainfo.get_piece_length(i) for i in range(5)], [32768, 32768, 14464, 20000, 5000])
+	assert_equal([f['path'] for f in metainfo.info['files']], ['a.bin', 'b.bin', os.path.join('sub', 'c.bin')])
+
+	torrent = Torrent(None, metainfo)
+	assert_true(torrent.check_piece(2, data['a.bin'][65536:]))
+	assert_false(torrent.check_piece(2, data['a.bin'][65536:-1] + b'x'))
+
+
+
+class PipeConnection():
+	""" one end of an in-memory connection between two Torrents - writes queue up until pump_connections() """
+
+	def __init__(self, queue, address):
+		self.queue = queue
+		self.address = address
+		self.peer = None
+		self.other = None
+		self.sent_handshake = False
+
+	def write(self, data):
+		if not self.sent_handshake: # both ends run in this process - give each its own peer id
+			data = data[:48] + b'-TEST0-' + self.address[0].encode().rjust(13, b'0') + data[68:]
+			self.sent_handshake = True
+		self.queue.append((self.other, data))
+
+	def disconnect(self):
+		pass
+
+	def get_address(self):
+		return self.address
+
+
+def pump_connections(queue):
+	""" deliver the queued writes, and whatever they write back, until both ends go quiet """
+
+	while queue:
+		(conn, data) = queue.pop(0)
+		conn.peer.handle_data_received(data)
+
+
+def connect_torrents(a, b, a_addr, b_addr):
+	""" torrent a dials torrent b over a PipeConnection; (a's peer for b, b's peer for a, the queue) once pumped """
+
+	queue = []
+	(conn_a, conn_b) = (PipeConnection(queue, b_addr), PipeConnection(queue, a_addr))
+	(conn_a.other, conn_b.other) = (conn_b, conn_a)
+	conn_a.peer = a.add_peer({'ip': b_addr[0], 'port': b_addr[1]})
+	conn_b.peer = b.accept_peer(a_addr[0], a_addr[1], None)
+	conn_a.peer.handle_connection_made(conn_a)
+	conn_b.peer.handle_connection_made(conn_b)
+	pump_connections(queue)
+	return (conn_a.peer, conn_b.peer, queue)
+
+
+def test_peer_exchange():
+
+	class MockMetainfo():
+		def __init__(self, private=False):
+			self.info_hash = b'i'*20
+			self.name = 'mock'
+			self.announce = None
+			self.private = private
+			self.info = {'pieces': [b'x'*20 for _ in range(8)]}
+		def get_piece_length(self, index):
+			return 2**14
+
+	assert_equal(parse_pex(build_pex([('1.2.3.4', 6881)], [('5.6.7.8', 1)])), ([('1.2.3.4', 6881)], [('5.6.7.8', 1)]))
+
+	conn_man = SimSwarm(1).conn_man
+	(a, b) = (Torrent(conn_man, MockMetainfo()), Torrent(conn_man, MockMetainfo()))
+	b.max_peers = 1 # so b doesn't dial what it learns
+
+	others = [a.add_peer({'ip': '10.0.0.%d' % i, 'port': 6881}) for i in (1, 2)]
+	for p in others:
+		p.set_state('active')
+
+	(to_b, from_a, queue) = connect_torrents(a, b, ('192.168.0.1', 6881), ('192.168.0.2', 6881))
+	assert_equal((to_b.state, from_a.state), ('active', 'active'))
+	assert_equal((to_b.pex_id, from_a.pex_id), (1, 1)) # agreed in the extended handshakes
+	assert_raises(PeerProtocolError, from_a.handle_message, {'msg_id':20, 'payload':b''}) # no extended id
+
+	# a tells b about its other peers, not about b itself - and not about b's ephemeral port either way
+	a.pex.tick()
+	pump_connections(queue)
+	assert_equal(sorted((p.ip, p.port) for p in b.peers), [('10.0.0.1', 6881), ('10.0.0.2', 6881), ('192.168.0.1', 6881)])
+	assert_equal(b.get_stats()['pex_peers'], 2)
+
+	# the next update is a delta; b drops it for coming too soon
+	others[0].set_state('stopped')
+	a.add_peer({'ip': '10.0.0.3', 'port': 6881}).set_state('active')
+	a.pex.tick()
+	assert_equal(to_b.pex_sent, set([('10.0.0.2', 6881), ('10.0.0.3', 6881)]))
+	pump_connections(queue)
+	assert_equal(len(b.peers), 3)
+
+	conn_man.clock.run(conn_man.now() + CONFIG['pex_min_interval'])
+	to_b.pex_sent.discard(('10.0.0.3', 6881)) # as if the last update had not been sent yet
+	a.pex.tick()
+	pump_connections(queue)
+	assert_equal(len(b.peers), 4)
+
+	# no peer exchange for private torrents
+	(c, d) = (Torrent(conn_man, MockMetainfo(private=True)), Torrent(conn_man, MockMetainfo()))
+	(to_d, from_c, _) = connect_torrents(c, d, ('192.168.0.3', 6881), ('192.168.0.4', 6881))
+	assert_equal((c.pex, to_d.pex_id, from_c.pex_id), (None, 1, None))
+
+
+
+class TrackerRequestHandler(http.server.BaseHTTPRequestHandler):
+	""" announce and scrape for self.server.swarms {info_hash: (complete, incomplete)}; logs the scrapes """
+
+	def do_GET(self):
+
+		(path, _, query) = self.path.partition('?')
+		info_hashes = [v.encode('latin-1') for (k, v) in urllib.parse.parse_qsl(query, encoding='latin-1') if k == 'info_hash']
+
+		if path == '/scrape':
+			self.server.scrapes.append(info_hashes)
+			resp = {b'files': {h: {b'complete': self.server.swarms[h][0], b'incomplete': self.server.swarms[h][1],
+				b'downloaded': 0} for h in info_hashes if h in self.server.swarms}}
+		else:
+			(complete, incomplete) = self.server.swarms[info_hashes[0]]
+			resp = {b'interval': 1800, b'complete': complete, b'incomplete': incomplete, b'peers': b''}
+
+		body = bencodepy.encode(resp)
+		self.send_response(200)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+def test_torrent_queue():
+
+	assert_equal(TorrentTracker.get_scrape_url('http://t.example.com/x/announce.php?k=1'), 'http://t.example.com/x/scrape.php?k=1')
+	assert_equal(TorrentTracker.get_scrape_url('http://t.example.com/a'), None)
+
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), TrackerRequestHandler)
+	server.scrapes = []
+	server.swarms = {b'0'*20: (0, 0), b'1'*20: (5, 0), b'2'*20: (1, 10), b'3'*20: (20, 3)}
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+
+	class MockMetainfo():
+		def __init__(self, info_hash, announce):
+			self.info_hash = info_hash
+			self.name = info_hash[:1].decode()
+			self.announce = announce
+			self.info = {'pieces': [b'x'*20 for _ in range(8)], 'length': 8 * 2**14}
+		def get_piece_length(self, index):
+			return 2**14
+
+	conn_man = SimSwarm(1).conn_man
+	announce = 'http://127.0.0.1:%d/announce' % server.server_address[1]
+	torrents = [Torrent(conn_man, MockMetainfo(b'%d' % i * 20, announce)) for i in range(4)]
+	torrents.append(Torrent(conn_man, MockMetainfo(b'4'*20, None))) # no tracker to scrape
+
+	queue = TorrentQueue(conn_man, max_active=2, interval=60.0)
+	for t in torrents:
+		queue.add(t)
+
+	def running():
+		return sorted(t.metainfo.name for t in queue.get_running())
+
+	# nothing is known at first, so the first two go; the scrape (one request for the four on the tracker) reorders
+	queue.start()
+	assert_equal(running(), ['0', '1'])
+	conn_man.clock.run(1.0)
+
+	assert_equal([sorted(h) for h in server.scrapes], [[b'0'*20, b'1'*20, b'2'*20, b'3'*20]])
+	assert_equal((torrents[2].num_seeders, torrents[2].num_leechers), (1, 10))
+	assert_equal(running(), ['1', '3'])
+	assert(torrents[0].is_paused)
+
+	# '3' makes progress and '1' doesn't - after queue_stall_time '1' is rotated out for the next best, '2'
+	torrents[3].bytes_downloaded += 2**14
+	conn_man.clock.run(conn_man.now() + 60.0)
+	torrents[3].bytes_downloaded += 2**14
+	conn_man.clock.run(conn_man.now() + CONFIG['queue_stall_time'])
+	assert_equal(running(), ['2', '3'])
+	assert(torrents[1].is_paused)
+
+	# a finished torrent frees its slot; the unscraped one ranks above the dead swarm
+	torrents[3].is_complete = True
+	queue.update()
+	assert_equal(running(), ['2', '4'])
+
+	# a user pause frees the slot for the next in line ('1' is still benched, so '0'), and keeps it out of the
+	# rotation; resumed, it is queued again and takes its slot back on rank
+	queue.pause(torrents[2])
+	assert_equal(running(), ['0', '4'])
+	assert(torrents[2] not in queue.queued)
+	conn_man.clock.run(conn_man.now() + 60.0)
+	assert(torrents[2].is_paused)
+	queue.resume(torrents[2])
+	assert_equal(running(), ['2', '4'])
+	assert(torrents[0].is_paused and torrents[0] in queue.queued)
+
+	# resuming a torrent the queue paused leaves it waiting for a slot - the cap holds
+	queue.resume(torrents[0])
+	assert_equal(running(), ['2', '4'])
+	assert(torrents[0].is_paused and torrents[0] in queue.queued)
+
+	server.shutdown()
+	server.server_close()
+
+
+
+def test_record_and_replay():
+
+	trace_dir = tempfile.mkdtemp()
+
+	swarm = SimSwarm(num_pieces=40, piece_length=2**15, seed=3)
+	swarm.add_peers(3, pieces=1.0, choke_prob=0.1)
+	swarm.add_peers(2, pieces=0.5)
+	swarm.add_peers(1, refuse=True)
+
+	# record at the connection layer, as ConnectionManagerTwisted does with a recorder set
+	recorder = TraceRecorder(trace_dir, swarm.conn_man.now)
+	connect_peer = swarm.conn_man.connect_peer
+	swarm.conn_man.connect_peer = lambda peer: connect_peer(recorder.wrap(peer))
+
+	torrent = swarm.make_torrent()
+	original = swarm.run(torrent)
+	assert original['completed']
+
+	traces = load_traces(trace_dir, swarm.metainfo.info_hash)
+	assert_equal(len(traces), 6)
+	(header, events) = traces[0]
+	assert_equal([kind for (_, kind, _) in events[:2]], [CONNECTED, SENT]) # our handshake goes first
+	received = sum(len(d) for (_, events) in traces for (_, kind, d) in events if kind == RECEIVED)
+	assert received >= 40 * 2**15 # every block is in there
+	assert_equal(sorted(events[-1][1] for (_, events) in traces).count(LOST), 5) # and the refused one failed
+	assert all(t1 <= t2 for ((t1, _, _), (t2, _, _)) in zip(events, events[1:]))
+
+	# as fast as possible: same data in, same pieces out, in the recorded simulated time
+	conn_man = ReplayConnectionManager(traces)
+	completed = []
+	replayed = Torrent(conn_man, swarm.metainfo, on_completed_torrent=lambda t, data: completed.append(data),
+		rng=random.Random(swarm.seed)) # the same endgame picks as the recorded run
+	conn_man.replay(replayed)
+	replayed.start_torrent()
+	conn_man.clock.run(original['sim_time'] + 60)
+
+	assert_equal(completed, [b''.join(swarm.metainfo.get_piece_data(i) for i in range(40))])
+	assert sum(c.bytes_written for c in conn_man.connections) > 0
+
+
 	
+def test_memory_budgets():
+
+	results = measure(1000, 10)
+	assert_equal([r['component'] for r in results], ['metainfo', 'torrent', 'peers', 'piece_blocks', 'complete_pieces'])
+	assert_equal(check_budgets(results), [])
+
+	# completing pieces reuses the slots the torrent made up front
+	complete = [r for r in results if r['component'] == 'complete_pieces'][0]
+	assert(complete['steady'] <= 0)
+
+	# and a budget that is too small is reported
+	budgets = dict(BUDGETS, metainfo=(1, 0, 0))
+	failures = check_budgets(results, budgets)
+	assert_equal(len(failures), 1)
+	assert(failures[0].startswith('metainfo at 1000 pieces, 10 peers'))
+
+
+def test_blocklist():
+
+	tmp = tempfile.mkdtemp()
+	paths = [os.path.join(tmp, name) for name in ('level1.p2p', 'ipfilter.dat', 'ranges.txt.gz')]
+
+	with open(paths[0], 'w') as f:
+		f.write('# comment\nSome Corp, Inc.:1.2.3.0-1.2.3.255\nNext door:1.2.4.0-1.2.4.9\n')
+	with open(paths[1], 'w') as f: # zero padded octets are decimal; level 128 and up is allowed
+		f.write('010.000.000.010 - 010.000.000.020 , 000 , ten: a few\n010.000.000.100 - 010.000.000.200 , 200 , allowed\n')
+	with gzip.open(paths[2], 'wt') as f:
+		f.write('1.2.3.128/25\n9.9.9.9\nfe80::/10\n')
+
+	cache = os.path.join(tmp, 'cache', 'blocklist.cache')
+	blocklist = IPBlocklist.load(paths, cache)
+
+	assert_equal(len(blocklist), 3) # 1.2.3.0-1.2.4.9 merged (the /25 lies inside, the next range touches it)
+	for ip in ('1.2.3.0', '1.2.3.200', '1.2.4.9', '10.0.0.10', '10.0.0.20', '9.9.9.9'):
+		assert(blocklist.is_blocked(ip)), ip
+	for ip in ('1.2.2.255', '1.2.4.10', '10.0.0.9', '10.0.0.150', '9.9.9.10', 'tracker.example.org', '1.2.3.4\x00'):
+		assert(not blocklist.is_blocked(ip)), ip
+
+	# the compiled form is cached, and rebuilt once a list changes
+	assert(os.path.exists(cache))
+	assert_equal(IPBlocklist.load(paths, cache).starts, blocklist.starts)
+	with open(paths[0], 'a') as f:
+		f.write('Another:5.5.5.0-5.5.5.255\n')
+	assert(IPBlocklist.load(paths, cache).is_blocked('5.5.5.5'))
+
+	class MockMetainfo():
+		def __init__(self):
+			self.info = {'pieces' : [b'x'*20]}
+
+	torrent = Torrent(None, MockMetainfo(), blocklist=blocklist)
+	torrent.banned_ips.add('7.7.7.7')
+	peers = [{'ip': '1.2.3.4', 'port': 1}, {'ip': '8.8.8.8', 'port': 2}, {'ip': '7.7.7.7', 'port': 3},
+		{'ip': '8.8.4.4', 'port': 0}, {'ip': '10.0.0.15', 'port': 4}, {'ip': '4.4.4.4', 'port': 5}]
+	assert_equal([p['ip'] for p in torrent.filter_peers(peers)], ['8.8.8.8', '4.4.4.4'])
+	assert_equal(blocklist.num_blocked, 2)
+	assert_is_none(torrent.add_local_peer({'ip': '1.2.3.5', 'port': 6881}))
+
+	# incoming connections from a blocked address are dropped before their handshake
+	class MockConn():
+		def __init__(self, ip):
+			self.ip = ip
+			self.closed = False
+		def get_address(self):
+			return (self.ip, 6881)
+		def disconnect(self):
+			self.closed = True
+
+	clock = VirtualClock()
+	listener = PeerListener(clock, blocklist)
+	conn = MockConn('9.9.9.9')
+	listener.accept(conn).handle_connection_made(conn)
+	assert(conn.closed)
+	conn = MockConn('9.9.9.8')
+	incoming = listener.accept(conn)
+	incoming.handle_connection_made(conn)
+	assert(not conn.closed)
+	incoming.cancel_timer()
+
+
+def test_superseeding():
+
+	block = CONFIG['block_length']
+	data = bytes(range(256)) * (4 * block // 256) # 4 one block pieces
+
+	class MockMetainfo():
+		def __init__(self):
+			self.info_hash = b's'*20
+			self.name = 'superseed'
+			self.announce = None
+			self.info = {'pieces': [hashlib.sha1(data[i:i+block]).digest() for i in range(0, len(data), block)],
+				'length': len(data), 'piece_length': block}
+		def get_piece_length(self, index):
+			return block
+		def get_piece_offset(self, index):
+			return index * block
+
+	class MockConn():
+		def __init__(self):
+			self.written = b''
+		def write(self, data):
+			self.written += data
+		def disconnect(self):
+			pass
+
+	def sent(conn): # (msg_id, payload) of the messages since the last call, after our handshake
+		data = conn.written[68:] if conn.written[:1] == b'\x13' else conn.written
+		conn.written = b''
+		msgs = []
+		while data:
+			(length,) = struct.unpack('!L', data[:4])
+			msgs.append((data[4], data[5:4+length]))
+			data = data[4+length:]
+		return [m for m in msgs if m[0] != 20] # without the extended handshake
+
+	def message(msg_type, **params):
+		return TorrentPeer.build_message(msg_type, **params)
+
+	conn_man = SimSwarm(1).conn_man
+	CONFIG['superseed'] = True
+	try:
+		seed = Torrent(conn_man, MockMetainfo())
+		seed.seed(data)
+	finally:
+		CONFIG['superseed'] = False
+	seed.start_torrent()
+
+	leechers = []
+	for n in range(3):
+		peer = seed.accept_peer('10.0.0.%d' % n, 6881, None)
+		conn = MockConn()
+		peer.handle_connection_made(conn)
+		peer.handle_data_received(TorrentPeer.build_handshake(b's'*20, b'-LEECH-%013d' % n))
+		leechers.append((peer, conn))
+
+	# no bitfield - each peer is shown a different piece
+	assert_equal([sent(conn) for (_, conn) in leechers], [[(4, struct.pack('!L', i))] for i in range(3)])
+	((a, conn_a), (b, conn_b), (c, conn_c)) = leechers
+
+	# only the revealed piece is served, and only once unchoked
+	a.handle_data_received(message('request', index=0, begin=0, length=block))
+	a.handle_data_received(message('interested'))
+	assert_equal(sent(conn_a), [(1, b'')])
+	a.handle_data_received(message('request', index=1, begin=0, length=block))
+	a.handle_data_received(message('request', index=0, begin=0, length=block))
+	assert_equal(sent(conn_a), [(7, struct.pack('!LL', 0, 0) + data[:block])])
+	assert_equal(seed.bytes_uploaded, block)
+
+	# a has it - but b and c don't yet, so a waits until the piece spreads
+	a.handle_data_received(message('have', index=0))
+	assert_equal(sent(conn_a), [])
+	b.handle_data_received(message('have', index=0))
+	assert_equal(sent(conn_a), [(4, struct.pack('!L', 3))])
+	assert_equal(seed.superseeder.num_spread, 1)
+
+	# c's piece goes nowhere - after the timeout it gets the least offered, rarest piece it lacks
+	c.handle_data_received(message('have', index=2))
+	conn_man.clock.run(conn_man.now() + CONFIG['superseed_timeout'] + CONFIG['superseed_interval'])
+	assert_equal(sent(conn_c), [(4, struct.pack('!L', 1))])
+
+	for i in (1, 2, 3):
+		a.handle_data_received(message('have', index=i))
+	assert_is_not_none(seed.get_stats()['superseed']['first_copy_time'])
+	assert_equal(seed.superseeder.availability.tolist(), [2, 1, 2, 1])
+	a.handle_connection_lost()
+	assert_equal(seed.superseeder.availability.tolist(), [1, 0, 1, 0])
+	seed.pause()
+
+	# one of our own downloads gets everything from a super-seed, a piece at a time
+	CONFIG['superseed'] = True
+	try:
+		seed = Torrent(conn_man, MockMetainfo())
+		seed.seed(data)
+	finally:
+		CONFIG['superseed'] = False
+	seed.start_torrent()
+
+	completed = []
+	leecher = Torrent(conn_man, MockMetainfo(), on_completed_torrent=lambda t, d: completed.append(d))
+	connect_torrents(leecher, seed, ('10.1.0.2', 6881), ('10.1.0.1', 6881))
+
+	assert_equal(completed, [data])
+	assert_equal(seed.bytes_uploaded, len(data)) # every piece went out exactly once
+	assert_equal(seed.superseeder.times_offered.tolist(), [1, 1, 1, 1])
+
+
 test_torrent_peer()
+test_peer_piece_map()
+test_progress_counters()
+test_have_broadcast()
+test_daemon_requests()
+test_peer_cache()
+test_request_timeout_reassigns_piece()
+test_simulated_swarm()
+test_adaptive_max_peers()
+test_token_bucket_hierarchy()
+test_smart_ban()
+test_simulated_corrupt_peer()
+test_create_torrent()
+test_web_seed()
+test_utp_transfer()
+test_incoming_peer_dispatch()
+test_local_service_discovery()
+test_v2_block_verification()
+test_peer_exchange()
+test_torrent_queue()
+test_record_and_replay()
+test_memory_budgets()
+test_blocklist()
+test_superseeding()
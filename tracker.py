@@ -20,16 +20,26 @@ class TorrentTracker():
 
 	def send_announce_request(self):
 		""" This function seeks to send an announce request to the server, 
-		obtains the response and passes control to the function that can handle the response """
-		http_resp = requests.get(self.announce, {
+		obtains the response and passes control to the function that can handle the response 
+
+		The HTTP request runs on a worker thread so peers (e.g. from the peer cache) can be dialled meanwhile """
+		self.torrent.conn_man.run_in_thread(self.fetch_announce, self.handle_announce_response, self.handle_announce_failed)
+
+	def fetch_announce(self):
+
+		return requests.get(self.announce, {
 			'info_hash': self.torrent.metainfo.info_hash,
 			'peer_id': CONFIG['peer_id'],
-			'port':6881,
+			'port':CONFIG['listen_port'],
 			'uploaded':0,
 			'downloaded':0,
-			'left': str(self.torrent.metainfo.info['length'])
+			'left': '0' if self.torrent.is_seeding else str(self.torrent.metainfo.info['length'])
 		})
-		self.handle_announce_response(http_resp)
+
+	def handle_announce_failed(self, error):
+
+		# not fatal - we carry on with whatever peers we already know about
+		log.warning('%s: announce failed: %s' % (self.torrent, error))
 
 	def handle_announce_response(self, http_resp):
 
@@ -39,10 +49,13 @@ class TorrentTracker():
 		
 		d = self.decode_announce_response(resp)
 
+		if d['complete'] is not None: # the swarm's health, for the torrent queue
+			self.torrent.set_swarm_info(d['complete'], d['incomplete'] or 0)
+
+		for peer_dict in self.torrent.filter_peers(d['peers']):
+			self.torrent.add_peer(peer_dict)
 
-		for peer_dict in d['peers']:
-			if peer_dict['ip'] and peer_dict['port']>0:
-				self.torrent.add_peer(peer_dict) 
+		self.torrent.fill_peer_slots()
 
 
 	@classmethod
@@ -105,6 +118,49 @@ class TorrentTracker():
 
 		return peer_dict_list
 
+	# ========= Scrape ========= #
+
+	@staticmethod
+	def get_scrape_url(announce):
+		""" by convention the scrape URL is the announce URL with 'announce' in the last path segment
+		replaced by 'scrape'; None if the tracker doesn't follow it """
+
+		if not announce:
+			return None
+
+		i = announce.rfind('/') + 1
+		if not announce.startswith('announce', i):
+			return None
+
+		return announce[:i] + 'scrape' + announce[i + len('announce'):]
+
+	@classmethod
+	def fetch_scrape(cls, scrape_url, info_hashes):
+		""" one scrape for many torrents of the same tracker - runs in a worker thread """
+
+		resp = requests.get(scrape_url, [('info_hash', info_hash) for info_hash in info_hashes],
+			timeout=CONFIG['scrape_timeout'])
+		resp.raise_for_status()
+
+		return cls.decode_scrape_response(bencodepy.decode(resp.content))
+
+	@staticmethod
+	def decode_scrape_response(resp):
+		""" {info_hash: {'complete', 'incomplete', 'downloaded'}} for the torrents the tracker knows """
+
+		if b'failure reason' in resp:
+			raise AnnounceFailureError(resp[b'failure reason'].decode('utf-8'))
+
+		files = {}
+		for (info_hash, stats) in resp.get(b'files', {}).items():
+			files[info_hash] = {
+				'complete': int(stats.get(b'complete', 0)),
+				'incomplete': int(stats.get(b'incomplete', 0)),
+				'downloaded': int(stats.get(b'downloaded', 0))
+				}
+
+		return files
+
 
 class AnnounceFailureError(Exception):
 	pass
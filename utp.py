@@ -0,0 +1,643 @@
+"""
+uTP (BEP 29) - the BitTorrent protocol over UDP, with LEDBAT congestion control
+
+Every uTP connection of the session shares one UDP socket; UTPMultiplexer tells them apart by address and
+connection id. A UTPConnection has the same interface as PeerConnectionProtocol - write() and disconnect(),
+and the handle_connection_* / handle_data_received callbacks on the peer - so TorrentPeer runs over either.
+
+LEDBAT: the remote echoes back the one way delay of our packets. The lowest delay seen in the last two
+minutes is taken as the propagation delay, anything above it is queueing we are causing. The congestion window
+grows while the queueing delay is under TARGET_DELAY and shrinks in proportion when it goes over, so bulk
+transfers back off as soon as anything else on the link starts queueing behind them. Losses (three packets
+selectively acked past a hole, or three duplicate acks) halve the window, timeouts collapse it.
+
+The protocol core doesn't touch sockets or the reactor - it is driven through handle_datagram() and a clock
+object with call_later() and now(), so it also runs on the simulator's virtual clock.
+
+"""
+
+import collections
+import logging
+import random
+import struct
+
+from twisted.internet import protocol
+
+log = logging.getLogger(__name__)
+
+ST_DATA, ST_FIN, ST_STATE, ST_RESET, ST_SYN = range(5)
+VERSION = 1
+EXT_SACK = 1
+HEADER = struct.Struct('!BBHIIIHH') # type/version, extension, connection_id, timestamp_microseconds,
+									# timestamp_difference_microseconds, wnd_size, seq_nr, ack_nr
+
+MSS = 1400 # payload bytes per packet; with the IP, UDP and uTP headers this fits a 1500 byte MTU
+TARGET_DELAY = 0.1 # seconds of queueing delay LEDBAT aims for
+GAIN = 1.0 # at most one MSS of window growth per round trip
+MIN_WINDOW = MSS
+MAX_WINDOW = 2**20
+RECV_WINDOW = 2**20 # what we advertise; data is handed to the peer as soon as it is in order
+MAX_REORDER = 1024 # packets past ack_nr we are willing to buffer
+MIN_RTO = 0.5
+MAX_RTO = 60.0
+CONNECT_RETRIES = 3 # SYN timeouts before the connection attempt fails
+MAX_TIMEOUTS = 6 # timeouts in a row before an established connection is given up
+BASE_DELAY_INTERVAL = 60.0 # base delay is the minimum over the last two of these
+DUP_ACK_THRESHOLD = 3
+
+
+UTPPacket = collections.namedtuple('UTPPacket', 'type conn_id timestamp timestamp_diff wnd_size seq_nr ack_nr sack payload')
+
+
+def encode_packet(packet_type, conn_id, timestamp, timestamp_diff, wnd_size, seq_nr, ack_nr, sack=None, payload=b''):
+
+	header = HEADER.pack(packet_type << 4 | VERSION, EXT_SACK if sack else 0, conn_id, timestamp, timestamp_diff,
+		wnd_size, seq_nr, ack_nr)
+
+	if sack:
+		header += struct.pack('!BB', 0, len(sack)) + sack
+
+	return header + payload
+
+
+def decode_packet(data):
+
+	if len(data) < HEADER.size:
+		raise UTPPacketError('packet too short: %d bytes' % len(data))
+
+	(type_ver, extension, conn_id, timestamp, timestamp_diff, wnd_size, seq_nr, ack_nr) = HEADER.unpack_from(data)
+
+	if type_ver & 0xF != VERSION or type_ver >> 4 > ST_SYN:
+		raise UTPPacketError('bad type/version %#x' % type_ver)
+
+	pos = HEADER.size
+	sack = None
+	while extension: # a chain of (next extension, length, body)
+		if len(data) < pos + 2 or len(data) < pos + 2 + data[pos + 1]:
+			raise UTPPacketError('truncated extension')
+		(next_extension, length) = (data[pos], data[pos + 1])
+		if extension == EXT_SACK:
+			sack = bytes(data[pos + 2:pos + 2 + length])
+		extension = next_extension
+		pos += 2 + length
+
+	return UTPPacket(type_ver >> 4, conn_id, timestamp, timestamp_diff, wnd_size, seq_nr, ack_nr, sack, data[pos:])
+
+
+def seq_before(a, b):
+	""" a comes before b, in 16 bit sequence number space """
+
+	return a != b and (b - a) & 0xFFFF < 0x8000
+
+
+class UTPConnection():
+
+	__slots__ = ('mux', 'addr', 'recv_id', 'send_id', 'peer', 'fallback', 'state', 'seq_nr', 'ack_nr',
+				'in_flight', 'cur_window', 'send_buffer', 'recv_buffer', 'eof_seq', 'close_when_sent', 'need_ack',
+				'cwnd', 'ssthresh', 'peer_wnd', 'srtt', 'rttvar', 'rto', 'timer', 'timeouts', 'reply_micro',
+				'base_delays', 'queuing_delay', 'last_ack', 'dup_acks', 'loss_seq', 'num_resent',
+				'read_timer', 'write_timer')
+
+	def __init__(self, mux, addr, recv_id, send_id, peer=None, fallback=None):
+		"""
+		Args:
+			peer - gets the handle_connection_* / handle_data_received callbacks; for incoming connections it is
+				set when the connection is accepted
+			fallback - called instead of peer.handle_connection_failed if we never get connected,
+				e.g. to try TCP instead
+		"""
+
+		self.mux = mux
+		self.addr = addr
+		self.recv_id = recv_id
+		self.send_id = send_id
+		self.peer = peer
+		self.fallback = fallback
+		self.state = 'new' # -> syn_sent -> connected -> fin_sent -> closed
+
+		self.seq_nr = 1 # next sequence number we send
+		self.ack_nr = 0 # last sequence number received in order
+		self.in_flight = collections.OrderedDict() # seq_nr -> [type, payload, sent_at, transmissions]
+		self.cur_window = 0 # payload bytes in flight
+		self.send_buffer = bytearray()
+		self.recv_buffer = {} # seq_nr -> payload, for packets that arrived out of order
+		self.eof_seq = None # sequence number of the remote's FIN
+		self.close_when_sent = False
+		self.need_ack = False
+
+		self.cwnd = 2*MSS
+		self.ssthresh = MAX_WINDOW # slow start until the first loss or until delay builds up
+		self.peer_wnd = RECV_WINDOW
+		self.srtt = None
+		self.rttvar = 0.0
+		self.rto = 1.0
+		self.timer = None
+		self.timeouts = 0
+
+		self.reply_micro = 0 # one way delay of the remote's last packet, echoed in ours
+		self.base_delays = collections.deque(maxlen=2) # [interval start, lowest delay] for the last two intervals
+		self.queuing_delay = 0.0
+		self.last_ack = None
+		self.dup_acks = 0
+		self.loss_seq = None # the window is only cut once per round trip
+		self.num_resent = 0
+
+		self.read_timer = None
+		self.write_timer = None
+
+	def __repr__(self):
+		return 'UTPConnection(%s:%s)' % self.addr
+
+	# ========= Interface used by TorrentPeer ========= #
+
+	def write(self, data):
+
+		if self.state == 'closed' or self.close_when_sent:
+			return
+
+		self.send_buffer += data
+		self._flush()
+
+	def get_address(self):
+		return self.addr
+
+	def disconnect(self):
+		""" send what is queued, then FIN """
+
+		if self.state in ('new', 'syn_sent'):
+			self.fallback = None # we gave up, not the transport
+			self._close()
+			return
+
+		self.close_when_sent = True
+		self._flush()
+
+	# ========= Connection set up and tear down ========= #
+
+	def connect(self):
+
+		self.state = 'syn_sent'
+		self._send_new(ST_SYN)
+
+	def accept(self, syn):
+		""" the remote's SYN - answer with a STATE packet; our first data packet carries seq_nr """
+
+		self.state = 'connected'
+		self.ack_nr = syn.seq_nr
+		self.seq_nr = random.randrange(1 << 16)
+		self.peer_wnd = syn.wnd_size
+		self.reply_micro = (self._micros() - syn.timestamp) & 0xFFFFFFFF
+		self._send_state()
+
+		if self.peer:
+			self.peer.handle_connection_made(self)
+
+	def _close(self, error=None):
+
+		if self.state == 'closed':
+			return
+
+		was_connected = self.state not in ('new', 'syn_sent')
+		self.state = 'closed'
+
+		for timer in (self.timer, self.read_timer, self.write_timer):
+			if timer:
+				timer.cancel()
+		self.timer = self.read_timer = self.write_timer = None
+		self.mux.remove(self)
+
+		if error:
+			log.debug('%s: closed: %s' % (self, error))
+
+		if was_connected:
+			if self.peer:
+				self.peer.handle_connection_lost()
+		elif self.fallback:
+			self.fallback()
+		elif self.peer:
+			self.peer.handle_connection_failed()
+
+	# ========= Sending ========= #
+
+	def _micros(self):
+		return int(self.mux.clock.now() * 1e6) & 0xFFFFFFFF
+
+	def _get_wnd_size(self):
+		return 0 if self.read_timer else RECV_WINDOW
+
+	def _build_sack(self):
+		""" bit i is set if ack_nr + 2 + i has arrived (ack_nr + 1 is the hole) """
+
+		if not self.recv_buffer:
+			return None
+
+		offsets = [(seq - self.ack_nr - 2) & 0xFFFF for seq in self.recv_buffer]
+		offsets = [i for i in offsets if i < 256]
+		if not offsets:
+			return None
+
+		sack = bytearray(min(32, (max(offsets) // 32 + 1) * 4))
+		for i in offsets:
+			sack[i >> 3] |= 1 << (i & 7)
+
+		return bytes(sack)
+
+	def _send_packet(self, packet_type, seq_nr, payload=b''):
+
+		self.need_ack = False
+		self.mux.send_datagram(encode_packet(packet_type, self.send_id if packet_type != ST_SYN else self.recv_id,
+			self._micros(), self.reply_micro, self._get_wnd_size(), seq_nr, self.ack_nr, self._build_sack(), payload),
+			self.addr)
+
+	def _send_new(self, packet_type, payload=b''):
+		""" a packet that takes a sequence number and has to be acked """
+
+		seq_nr = self.seq_nr
+		self.seq_nr = (self.seq_nr + 1) & 0xFFFF
+		self.in_flight[seq_nr] = [packet_type, payload, self.mux.clock.now(), 1]
+		self.cur_window += len(payload)
+		self._send_packet(packet_type, seq_nr, payload)
+
+		if not self.timer:
+			self._set_timer()
+
+	def _send_state(self):
+		self._send_packet(ST_STATE, self.seq_nr)
+
+	def _resend(self, seq_nr):
+
+		packet = self.in_flight[seq_nr]
+		packet[2] = self.mux.clock.now()
+		packet[3] += 1
+		self.num_resent += 1
+		self._send_packet(packet[0], seq_nr, packet[1])
+
+	def _flush(self):
+		""" send queued data as far as the congestion and receive windows allow """
+
+		if self.state not in ('connected', 'fin_sent'):
+			return
+
+		limiter = self.peer.upload_limiter if self.peer else None
+		window = min(self.cwnd, self.peer_wnd)
+
+		while self.send_buffer and self.state == 'connected' and not self.write_timer:
+			size = min(MSS, len(self.send_buffer))
+			if self.cur_window + size > window:
+				break
+
+			delay = limiter.get_delay() if limiter else 0
+			if delay > 0:
+				self.write_timer = self.mux.clock.call_later(delay, self._resume_writing)
+				break
+
+			payload = bytes(self.send_buffer[:size])
+			del self.send_buffer[:size]
+			if limiter:
+				limiter.consume(size)
+			self._send_new(ST_DATA, payload)
+
+		if self.close_when_sent and not self.send_buffer and self.state == 'connected':
+			self.state = 'fin_sent'
+			self._send_new(ST_FIN)
+
+		if self.need_ack: # nothing to piggyback the ack on
+			self._send_state()
+
+		if self.send_buffer and not self.in_flight and not self.timer: # zero window - probe once it times out
+			self._set_timer()
+
+	def _resume_writing(self):
+		self.write_timer = None
+		self._flush()
+
+	def _set_timer(self):
+
+		if self.timer:
+			self.timer.cancel()
+		self.timer = self.mux.clock.call_later(self.rto, self._handle_timeout)
+
+	def _handle_timeout(self):
+
+		self.timer = None
+		self.timeouts += 1
+
+		if self.state == 'syn_sent' and self.timeouts >= CONNECT_RETRIES:
+			self._close('connect timed out')
+			return
+
+		if self.timeouts >= MAX_TIMEOUTS:
+			self._close('timed out')
+			return
+
+		self.rto = min(MAX_RTO, self.rto * 2)
+		self.ssthresh = max(MIN_WINDOW, self.cwnd // 2)
+		self.cwnd = MIN_WINDOW
+
+		if self.in_flight:
+			self._resend(next(iter(self.in_flight)))
+		elif self.send_buffer: # the remote's window is shut - send one packet to see if it has opened
+			size = min(MSS, len(self.send_buffer))
+			payload = bytes(self.send_buffer[:size])
+			del self.send_buffer[:size]
+			self._send_new(ST_DATA, payload)
+
+		self._set_timer()
+
+	# ========= Receiving ========= #
+
+	def handle_packet(self, packet):
+
+		if self.state == 'closed':
+			return
+
+		if packet.type == ST_RESET:
+			self._close('reset by remote')
+			return
+
+		if packet.type == ST_SYN: # our STATE got lost
+			if self.state != 'syn_sent':
+				self._send_state()
+			return
+
+		self.reply_micro = (self._micros() - packet.timestamp) & 0xFFFFFFFF
+		self.peer_wnd = packet.wnd_size
+
+		if self.state == 'syn_sent':
+			if packet.type != ST_STATE:
+				return
+			self.state = 'connected'
+			self.ack_nr = (packet.seq_nr - 1) & 0xFFFF # the STATE didn't use up its seq_nr
+			self._handle_ack(packet)
+			if self.peer:
+				self.peer.handle_connection_made(self)
+			self._flush()
+			return
+
+		self._handle_ack(packet)
+
+		if packet.type in (ST_DATA, ST_FIN):
+			self._handle_data(packet)
+
+		if self.state != 'closed':
+			self._flush()
+
+	def _handle_data(self, packet):
+
+		if packet.type == ST_FIN:
+			self.eof_seq = packet.seq_nr
+
+		self.need_ack = True
+		distance = (packet.seq_nr - self.ack_nr) & 0xFFFF
+
+		if distance == 0 or distance > MAX_REORDER: # a duplicate - just ack it again
+			return
+
+		self.recv_buffer[packet.seq_nr] = packet.payload
+
+		while (self.ack_nr + 1) & 0xFFFF in self.recv_buffer:
+			self.ack_nr = (self.ack_nr + 1) & 0xFFFF
+			payload = self.recv_buffer.pop(self.ack_nr)
+			if payload:
+				self._deliver(payload)
+				if self.state == 'closed':
+					return
+
+		if self.eof_seq is not None and self.ack_nr == self.eof_seq:
+			self._send_state()
+			self._close()
+
+	def _deliver(self, payload):
+
+		peer = self.peer
+		if not peer:
+			return
+
+		delay = peer.download_limiter.consume(len(payload)) if peer.download_limiter else 0
+		peer.handle_data_received(payload)
+
+		if delay > 0 and not self.read_timer and self.state != 'closed': # shut our window until the bucket recovers
+			self.read_timer = self.mux.clock.call_later(delay, self._resume_reading)
+
+	def _resume_reading(self):
+
+		self.read_timer = None
+		self._send_state() # window update
+
+	def _handle_ack(self, packet):
+
+		now = self.mux.clock.now()
+		acked = []
+
+		while self.in_flight:
+			seq_nr = next(iter(self.in_flight))
+			if seq_before(packet.ack_nr, seq_nr):
+				break
+			acked.append(self.in_flight.pop(seq_nr))
+
+		if packet.sack:
+			for i in range(len(packet.sack) * 8):
+				if packet.sack[i >> 3] & (1 << (i & 7)):
+					seq_nr = (packet.ack_nr + 2 + i) & 0xFFFF
+					if seq_nr in self.in_flight:
+						acked.append(self.in_flight.pop(seq_nr))
+
+		if packet.ack_nr == self.last_ack and not acked and self.in_flight and packet.type == ST_STATE:
+			self.dup_acks += 1
+		elif acked:
+			self.dup_acks = 0
+		self.last_ack = packet.ack_nr
+
+		if acked:
+			bytes_acked = 0
+			for (_, payload, sent_at, transmissions) in acked:
+				bytes_acked += len(payload)
+				if transmissions == 1: # Karn - a resent packet's ack is ambiguous
+					self._update_rtt(now - sent_at)
+			self.cur_window -= bytes_acked
+			self.timeouts = 0
+			self._update_window(bytes_acked, packet.timestamp_diff)
+
+		self._detect_loss(packet)
+
+		if self.in_flight:
+			if acked:
+				self._set_timer()
+		elif self.timer:
+			self.timer.cancel()
+			self.timer = None
+
+		if self.state == 'fin_sent' and not self.in_flight: # our FIN got acked
+			self._close()
+
+	def _detect_loss(self, packet):
+		""" resend packets that 3 later packets overtook (per the SACK), or that got 3 duplicate acks """
+
+		lost = []
+		first = (packet.ack_nr + 1) & 0xFFFF
+
+		if packet.sack and self.in_flight:
+			sacked = 0
+			for i in range(len(packet.sack) * 8 - 1, -2, -1): # count back from the newest; -1 is ack_nr + 1
+				if i >= 0 and packet.sack[i >> 3] & (1 << (i & 7)):
+					sacked += 1
+				elif sacked >= DUP_ACK_THRESHOLD:
+					seq_nr = (packet.ack_nr + 2 + i) & 0xFFFF
+					if seq_nr in self.in_flight and self.in_flight[seq_nr][3] == 1: # each hole is only resent once
+						lost.append(seq_nr)
+
+		if self.dup_acks >= DUP_ACK_THRESHOLD:
+			self.dup_acks = 0
+			if first in self.in_flight and first not in lost:
+				lost.append(first)
+
+		if not lost:
+			return
+
+		if self.loss_seq is None or seq_before(self.loss_seq, min(lost, key=lambda seq_nr: (seq_nr - first) & 0xFFFF)):
+			self.ssthresh = max(MIN_WINDOW, self.cwnd // 2)
+			self.cwnd = self.ssthresh
+			self.loss_seq = (self.seq_nr - 1) & 0xFFFF # no further cuts for packets sent before now
+
+		for seq_nr in reversed(lost): # oldest first
+			self._resend(seq_nr)
+
+	def _update_rtt(self, rtt):
+
+		if self.srtt is None:
+			self.srtt = rtt
+			self.rttvar = rtt / 2
+		else:
+			self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - rtt)
+			self.srtt = 0.875*self.srtt + 0.125*rtt
+
+		self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4*self.rttvar))
+
+	def _update_window(self, bytes_acked, delay_micros):
+		""" LEDBAT """
+
+		if delay_micros: # 0 until the remote has seen one of our packets
+			now = self.mux.clock.now()
+			if not self.base_delays or now - self.base_delays[-1][0] >= BASE_DELAY_INTERVAL:
+				self.base_delays.append([now, delay_micros])
+			elif delay_micros < self.base_delays[-1][1]:
+				self.base_delays[-1][1] = delay_micros
+
+			base_delay = min(d for (_, d) in self.base_delays)
+			self.queuing_delay = (delay_micros - base_delay) / 1e6
+
+		off_target = (TARGET_DELAY - self.queuing_delay) / TARGET_DELAY
+
+		if self.cwnd < self.ssthresh and off_target > 0.5:
+			self.cwnd += bytes_acked
+		else:
+			if self.cwnd < self.ssthresh: # delay is building, slow start is over - and overshot by up to a round trip
+				self.cwnd //= 2
+				self.ssthresh = self.cwnd
+			self.cwnd += int(GAIN * off_target * bytes_acked * MSS / self.cwnd)
+
+		self.cwnd = min(MAX_WINDOW, max(MIN_WINDOW, self.cwnd))
+
+	def get_stats(self):
+
+		return {
+			'cwnd': self.cwnd,
+			'rtt': self.srtt,
+			'queuing_delay': self.queuing_delay,
+			'resent': self.num_resent
+		}
+
+
+class UTPMultiplexer():
+
+	""" All uTP connections of the session, on one UDP socket """
+
+	def __init__(self, clock, send_datagram, accept_peer=None):
+		"""
+		Args:
+			clock - has call_later() and now(), e.g. a connection manager or the simulator's VirtualClock
+			send_datagram - send_datagram(data, addr)
+			accept_peer - accept_peer(conn) returns the handler for an incoming connection; None refuses them
+		"""
+
+		self.clock = clock
+		self.send_datagram = send_datagram
+		self.accept_peer = accept_peer
+		self.connections = {} # (addr, recv_id) -> UTPConnection
+
+	def connect(self, peer, addr, fallback=None):
+
+		recv_id = random.randrange(1 << 16)
+		while (addr, recv_id) in self.connections or (addr, (recv_id + 1) & 0xFFFF) in self.connections:
+			recv_id = random.randrange(1 << 16)
+
+		conn = UTPConnection(self, addr, recv_id, (recv_id + 1) & 0xFFFF, peer, fallback)
+		self.connections[(addr, recv_id)] = conn
+		conn.connect()
+
+		return conn
+
+	def remove(self, conn):
+		self.connections.pop((conn.addr, conn.recv_id), None)
+
+	def handle_datagram(self, data, addr):
+
+		try:
+			packet = decode_packet(data)
+		except UTPPacketError as e:
+			log.debug('uTP: bad packet from %s:%s: %s' % (addr[0], addr[1], e))
+			return
+
+		conn = self.connections.get((addr, packet.conn_id))
+		if conn:
+			conn.handle_packet(packet)
+			return
+
+		if packet.type == ST_RESET: # may carry either of the connection's ids
+			for conn in list(self.connections.values()):
+				if conn.addr == addr and conn.send_id == packet.conn_id:
+					conn.handle_packet(packet)
+			return
+
+		if packet.type != ST_SYN:
+			if packet.type != ST_STATE: # data for a connection we don't know (any more)
+				self.send_reset(packet, addr)
+			return
+
+		recv_id = (packet.conn_id + 1) & 0xFFFF
+		if (addr, recv_id) in self.connections: # a resent SYN
+			self.connections[(addr, recv_id)].handle_packet(packet)
+			return
+
+		conn = UTPConnection(self, addr, recv_id, packet.conn_id)
+		conn.peer = self.accept_peer(conn) if self.accept_peer else None
+		if conn.peer is None:
+			self.send_reset(packet, addr)
+			return
+
+		self.connections[(addr, recv_id)] = conn
+		conn.accept(packet)
+
+	def send_reset(self, packet, addr):
+		self.send_datagram(encode_packet(ST_RESET, packet.conn_id, 0, 0, 0, 0, packet.seq_nr), addr)
+
+
+class UTPProtocol(protocol.DatagramProtocol):
+
+	""" Twisted end of a UTPMultiplexer - the UDP socket """
+
+	def __init__(self, clock, accept_peer=None):
+		self.mux = UTPMultiplexer(clock, self.send_datagram, accept_peer)
+
+	def datagramReceived(self, data, addr):
+		self.mux.handle_datagram(data, addr)
+
+	def send_datagram(self, data, addr):
+		try:
+			self.transport.write(data, addr)
+		except OSError as e: # e.g. no route - the retransmit timer deals with it
+			log.debug('uTP: send to %s:%s failed: %s' % (addr[0], addr[1], e))
+
+
+class UTPPacketError(Exception):
+	pass
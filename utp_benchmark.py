@@ -0,0 +1,259 @@
+"""
+uTP vs TCP on loopback, through an emulated bottleneck link
+
+Both transports push the same amount of data through a relay that behaves like a slow link with a buffer:
+packets queue, drain at --bandwidth, then take --delay to arrive. The relay records how long each packet sat
+in the queue - the delay a transfer adds to everything else sharing the link. TCP fills whatever buffer it
+is given; LEDBAT should hold the queue near its 100ms target for about the same throughput.
+
+	python utp_benchmark.py --size 16 --bandwidth 2 --delay 25 --buffer 512
+
+"""
+
+import argparse
+import logging
+
+from twisted.internet import protocol, reactor
+
+from conn_manager import ConnectionManagerTwisted, PeerConnectionFactory
+from utp import UTPProtocol
+
+
+class EmulatedLink():
+
+	""" FIFO queue drained at a fixed rate, followed by a fixed propagation delay """
+
+	def __init__(self, bandwidth, delay, buffer, on_drain=None):
+
+		self.bandwidth = bandwidth
+		self.delay = delay
+		self.buffer = buffer
+		self.on_drain = on_drain # called when the queue drops to half the buffer
+		self.busy_until = 0.0
+		self.queued = 0
+		self.dropped = 0
+		self.samples = [] # (time, queueing delay) per packet
+
+	def send(self, data, deliver, can_drop=True):
+		""" False if the buffer is full and the packet was dropped """
+
+		if can_drop and self.queued + len(data) > self.buffer:
+			self.dropped += 1
+			return False
+
+		now = reactor.seconds()
+		start = max(now, self.busy_until)
+		self.busy_until = start + len(data) / self.bandwidth
+		self.queued += len(data)
+		self.samples.append((now, start - now))
+
+		reactor.callLater(self.busy_until - now, self._departed, len(data))
+		reactor.callLater(self.busy_until - now + self.delay, deliver, data)
+
+		return True
+
+	def _departed(self, size):
+
+		self.queued -= size
+		if self.on_drain and self.queued <= self.buffer // 2:
+			self.on_drain()
+
+	def is_full(self):
+		return self.queued >= self.buffer
+
+	def get_queueing_delay(self, since):
+		""" median and 90th percentile of the queueing delay of packets sent after `since` """
+
+		delays = sorted(d for (t, d) in self.samples if t >= since) or [0.0]
+		return (delays[len(delays) // 2], delays[int(len(delays) * 0.9)])
+
+
+class UDPRelay(protocol.DatagramProtocol):
+
+	""" client -> server through the link; the way back only gets the propagation delay """
+
+	def __init__(self, link, server_addr):
+		self.link = link
+		self.server_addr = server_addr
+		self.client_addr = None
+
+	def datagramReceived(self, data, addr):
+
+		if addr == self.server_addr:
+			reactor.callLater(self.link.delay, self.transport.write, data, self.client_addr)
+		else:
+			self.client_addr = addr
+			self.link.send(data, lambda d: self.transport.write(d, self.server_addr))
+
+
+class TCPRelayProtocol(protocol.Protocol):
+
+	""" TCP can't be dropped from, so the relay stops reading from the client while the link's buffer is full """
+
+	def connectionMade(self):
+
+		self.server = None
+		self.pending = []
+		self.factory.link.on_drain = self.transport.resumeProducing
+
+		relay = self
+		class ServerSide(protocol.Protocol):
+			def connectionMade(self):
+				relay.server = self
+				for data in relay.pending:
+					self.transport.write(data)
+			def dataReceived(self, data):
+				reactor.callLater(relay.factory.link.delay, relay.transport.write, data)
+
+		protocol.ClientCreator(reactor, ServerSide).connectTCP('127.0.0.1', self.factory.server_port)
+
+	def dataReceived(self, data):
+
+		self.factory.link.send(data, self._deliver, can_drop=False)
+		if self.factory.link.is_full():
+			self.transport.pauseProducing()
+
+	def _deliver(self, data):
+
+		if self.server:
+			self.server.transport.write(data)
+		else:
+			self.pending.append(data)
+
+	def connectionLost(self, reason):
+		if self.server:
+			reactor.callLater(self.factory.link.delay + 1, self.server.transport.loseConnection)
+
+
+class Endpoint():
+
+	""" stands in for a TorrentPeer on either end of the connection """
+
+	download_limiter = None
+	upload_limiter = None
+
+	def __init__(self, payload=b'', on_received=None, expected=0):
+
+		self.payload = payload
+		self.on_received = on_received
+		self.expected = expected
+		self.received = 0
+		self.conn = None
+
+	def handle_connection_made(self, conn):
+
+		self.conn = conn
+		if self.payload:
+			conn.write(self.payload)
+
+	def handle_data_received(self, data):
+
+		self.received += len(data)
+		if self.on_received and self.received >= self.expected:
+			on_received = self.on_received
+			self.on_received = None
+			on_received()
+
+	def handle_connection_lost(self):
+		pass
+
+	def handle_connection_failed(self):
+		print('connection failed')
+		reactor.stop()
+
+
+class SinkProtocol(protocol.Protocol):
+
+	def dataReceived(self, data):
+		self.factory.endpoint.handle_data_received(data)
+
+
+def run_tcp(args, payload, done):
+
+	link = EmulatedLink(args.bandwidth, args.delay, args.buffer)
+	sink = Endpoint(on_received=lambda: finish(), expected=len(payload))
+
+	factory = protocol.Factory()
+	factory.protocol = SinkProtocol
+	factory.endpoint = sink
+	server = reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+	relay_factory = protocol.Factory()
+	relay_factory.protocol = TCPRelayProtocol
+	relay_factory.link = link
+	relay_factory.server_port = server.getHost().port
+	relay = reactor.listenTCP(0, relay_factory, interface='127.0.0.1')
+
+	sender = Endpoint(payload)
+	started = reactor.seconds()
+	reactor.connectTCP('127.0.0.1', relay.getHost().port, PeerConnectionFactory(sender))
+
+	def finish():
+		elapsed = reactor.seconds() - started
+		sender.conn.disconnect()
+		done('tcp', link, elapsed, started + elapsed / 2, {})
+
+def run_utp(args, payload, done):
+
+	link = EmulatedLink(args.bandwidth, args.delay, args.buffer)
+	sink = Endpoint(on_received=lambda: finish(), expected=len(payload))
+
+	server = UTPProtocol(ConnectionManagerTwisted, accept_peer=lambda conn: sink)
+	server_port = reactor.listenUDP(0, server, interface='127.0.0.1')
+
+	relay = UDPRelay(link, ('127.0.0.1', server_port.getHost().port))
+	relay_port = reactor.listenUDP(0, relay, interface='127.0.0.1')
+
+	client = UTPProtocol(ConnectionManagerTwisted)
+	reactor.listenUDP(0, client, interface='127.0.0.1')
+
+	sender = Endpoint(payload)
+	started = reactor.seconds()
+	conn = client.mux.connect(sender, ('127.0.0.1', relay_port.getHost().port))
+
+	def finish():
+		elapsed = reactor.seconds() - started
+		stats = conn.get_stats()
+		conn.disconnect()
+		done('utp', link, elapsed, started + elapsed / 2, stats)
+
+
+def main(argv=None):
+
+	parser = argparse.ArgumentParser(description='compare uTP and TCP through an emulated bottleneck')
+	parser.add_argument('--size', type=float, default=16, help='MiB to transfer')
+	parser.add_argument('--bandwidth', type=float, default=2, help='bottleneck MB/s')
+	parser.add_argument('--delay', type=float, default=25, help='one way ms')
+	parser.add_argument('--buffer', type=int, default=512, help='bottleneck buffer KiB')
+
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.WARNING)
+
+	args.bandwidth *= 1e6
+	args.delay /= 1000.0
+	args.buffer *= 1024
+	payload = b'\0' * int(args.size * 2**20)
+
+	runs = [run_tcp, run_utp]
+
+	def done(name, link, elapsed, steady_since, stats):
+
+		(median, p90) = link.get_queueing_delay(steady_since)
+		print('%-4s %6.2f MB/s  queueing delay median %4.0fms p90 %4.0fms  dropped %d %s' % (name,
+			len(payload) / elapsed / 1e6, median * 1000, p90 * 1000, link.dropped, stats or ''))
+
+		reactor.callLater(1.0, next_run)
+
+	def next_run():
+
+		if runs:
+			runs.pop(0)(args, payload, done)
+		else:
+			reactor.stop()
+
+	reactor.callWhenRunning(next_run)
+	reactor.run()
+
+
+if __name__=='__main__':
+	main()
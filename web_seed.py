@@ -0,0 +1,312 @@
+"""
+Web seeds (BEP 19) - plain HTTP servers that host the torrent's files, listed in the metainfo's url-list
+
+A server has every piece, so it is treated as a peer that never chokes: each WebSeed keeps a few
+WebSeedConnections, and each of those takes pieces from the torrent's picker like a TorrentPeer does,
+fetches the missing part of the piece with HTTP Range requests (one per file the piece overlaps) and hands
+the data to Torrent.handle_block one block at a time - so completion, hash checks and banning all work as
+they do for peers. The connections share a requests.Session, i.e. a pool of keep-alive HTTP connections,
+and run their requests in parallel on the connection manager's thread pool.
+
+Servers prefer pieces that no connected peer has, so they fill the gaps in a sparse swarm.
+
+"""
+
+import bisect
+import functools
+import logging
+import os
+import urllib.parse
+
+import requests
+
+from config import CONFIG
+from rate_limiter import TokenBucket
+
+log = logging.getLogger(__name__)
+
+
+class WebSeed():
+
+	def __init__(self, torrent, url):
+
+		self.torrent = torrent
+		self.url = url
+		self.session = None
+		self.connections = []
+		self.is_stopped = True
+		self.failures = 0 # consecutive failed requests
+		self.bytes_received = 0
+		self.download_limiter = TokenBucket(CONFIG['peer_download_rate_limit'], parent=torrent.download_limiter)
+
+		# (url, length) of every file, and where each file starts in the torrent's byte space
+		self.files = []
+		self.file_offsets = []
+
+		metainfo = torrent.metainfo
+		offset = 0
+		if metainfo.info['format'] == 'SINGLE_FILE':
+			file_url = url + urllib.parse.quote(metainfo.name) if url.endswith('/') else url
+			self.files.append((file_url, metainfo.info['length']))
+			self.file_offsets.append(0)
+		else:
+			base = url if url.endswith('/') else url + '/'
+			for f in metainfo.info['files']:
+				path = '/'.join(urllib.parse.quote(s) for s in [metainfo.name] + f['path'].split(os.sep))
+				self.files.append((None if f.get('padding') else base + path, f['length'])) # padding isn't on the server
+				self.file_offsets.append(offset)
+				offset += f['length']
+
+	def __repr__(self):
+		return 'WebSeed(%s)' % self.url
+
+	def start(self):
+
+		if not self.is_stopped:
+			return
+
+		self.is_stopped = False
+		self.failures = 0
+
+		if not self.connections:
+			num = CONFIG['web_seed_connections']
+			self.session = requests.Session()
+			adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=num)
+			self.session.mount('http://', adapter)
+			self.session.mount('https://', adapter)
+			self.connections = [WebSeedConnection(self) for _ in range(num)]
+
+		for conn in self.connections:
+			conn.run_download()
+
+	def stop(self):
+		""" requests already in flight are left to finish, their data is dropped """
+
+		self.is_stopped = True
+
+		for conn in self.connections:
+			conn.cancel_timer()
+			self.torrent.release_piece(conn)
+			conn.cancel_request()
+
+	def get_ranges(self, start, end):
+		""" (url, first byte, last byte) of the file ranges that make up torrent bytes [start, end) """
+
+		ranges = []
+		i = bisect.bisect_right(self.file_offsets, start) - 1
+
+		while start < end:
+			(url, length) = self.files[i]
+			file_end = self.file_offsets[i] + length
+			if start < file_end:
+				stop = min(end, file_end)
+				ranges.append((url, start - self.file_offsets[i], stop - self.file_offsets[i] - 1))
+				start = stop
+			i += 1
+
+		return ranges
+
+	def fetch(self, start, end):
+		""" torrent bytes [start, end) - runs in a worker thread """
+
+		data = []
+		for (url, first, last) in self.get_ranges(start, end):
+			if url is None:
+				data.append(bytes(last - first + 1))
+				continue
+
+			resp = self.session.get(url, headers={'Range': 'bytes=%d-%d' % (first, last)},
+				timeout=CONFIG['web_seed_timeout'])
+
+			if resp.status_code == 206:
+				content = resp.content
+			elif resp.status_code == 200: # server ignored the range
+				content = resp.content[first:last + 1]
+			else:
+				raise WebSeedError('HTTP %d for %s' % (resp.status_code, url))
+
+			if len(content) != last - first + 1:
+				raise WebSeedError('short response for %s: %d of %d bytes' % (url, len(content), last - first + 1))
+
+			data.append(content)
+
+		return b''.join(data)
+
+	def handle_fetch_failed(self, conn, error):
+
+		self.failures += 1
+		log.warning('%s: request failed (%d in a row): %s' % (self, self.failures, error))
+
+		if self.failures >= CONFIG['web_seed_max_failures']:
+			log.warning('%s: giving up on this server' % self)
+			self.stop()
+			return
+
+		conn.retry_later(CONFIG['web_seed_retry_delay'] * 2**(self.failures - 1))
+
+	def choose_next_piece(self):
+		""" a piece that nobody has requested, preferably one that no connected peer has; None if there isn't one """
+
+		torrent = self.torrent
+		wanted = ~torrent.have_pieces
+		unrequested = wanted & ~torrent.requested_pieces
+
+		if unrequested.any():
+			available = None
+			for p in torrent.peers:
+				if p.state == 'active':
+					available = p.peer_pieces.copy() if available is None else available | p.peer_pieces
+
+			if available is not None:
+				i = (unrequested & ~available).find(1)
+				if i >= 0:
+					return i
+
+			return unrequested.find(1)
+
+		# endgame - race the peers for a piece, but not one of ours
+		for conn in self.connections:
+			if conn.requested_piece is not None:
+				wanted[conn.requested_piece] = 0
+
+		if not wanted.any():
+			return None
+
+		return self.torrent.rng.choice(list(wanted.search(1)))
+
+	def get_stats(self):
+
+		return {
+			'url': self.url,
+			'bytes': self.bytes_received,
+			'is_stopped': self.is_stopped,
+			'failures': self.failures
+		}
+
+
+class WebSeedConnection():
+
+	"""
+	One request slot of a WebSeed - to the torrent it looks like a peer with a single piece in flight
+	"""
+
+	__slots__ = ('seed', 'torrent', 'ip', 'port', 'requested_piece', 'is_fetching', 'is_cancelled', 'is_delivering',
+				'timer')
+
+	def __init__(self, seed):
+
+		self.seed = seed
+		self.torrent = seed.torrent
+		self.ip = seed.url # banning a web seed bans the URL
+		self.port = None
+		self.requested_piece = None
+		self.is_fetching = False
+		self.is_cancelled = False # the piece was completed or given up while the request was out
+		self.is_delivering = False
+		self.timer = None
+
+	def __repr__(self):
+		return 'WebSeedConnection(%s)' % self.seed.url
+
+	def run_download(self):
+
+		if self.seed.is_stopped or self.torrent.is_paused or self.torrent.is_complete:
+			return
+
+		if self.is_fetching or self.timer:
+			return
+
+		if self.requested_piece is not None:
+			self.request_next_block(self.requested_piece)
+			return
+
+		piece = self.seed.choose_next_piece()
+		if piece is None:
+			return
+
+		self.requested_piece = piece
+		self.torrent.handle_piece_requested(self, piece)
+		self.request_next_block(piece)
+
+	def request_next_block(self, piece_index):
+		""" fetch everything from the first missing block to the end of the piece, in one go """
+
+		if self.is_fetching or self.is_delivering or self.timer:
+			return
+
+		begin = self.torrent.get_next_block(piece_index)
+		if begin is None:
+			return
+
+		piece_start = self.torrent.metainfo.get_piece_offset(piece_index)
+		piece_end = piece_start + self.torrent.metainfo.get_piece_length(piece_index)
+
+		self.is_fetching = True
+		self.is_cancelled = False
+		self.torrent.conn_man.run_in_thread(functools.partial(self.seed.fetch, piece_start + begin, piece_end),
+			functools.partial(self.handle_fetch_done, piece_index, begin),
+			self.handle_fetch_failed)
+
+	def handle_fetch_done(self, piece_index, begin, data):
+
+		self.is_fetching = False
+		self.seed.failures = 0
+		self.seed.bytes_received += len(data)
+		delay = self.seed.download_limiter.consume(len(data))
+
+		if self.is_cancelled or self.seed.is_stopped or self.torrent.is_complete:
+			self.run_download()
+			return
+
+		# deliver the data the way a peer would, block by block; the torrent may complete the piece,
+		# fail it, or reassign us while we do, so stop as soon as the piece stops being ours
+		self.is_delivering = True
+		block_length = CONFIG['block_length']
+		for offset in range(0, len(data), block_length):
+			if self.requested_piece != piece_index:
+				break
+			self.torrent.handle_block(self, piece_index, begin + offset, data[offset:offset + block_length])
+		self.is_delivering = False
+
+		if delay:
+			self.retry_later(delay)
+		else:
+			self.run_download()
+
+	def handle_fetch_failed(self, error):
+
+		self.is_fetching = False
+
+		if self.is_cancelled or self.seed.is_stopped:
+			self.run_download()
+			return
+
+		self.torrent.release_piece(self)
+		self.seed.handle_fetch_failed(self, error)
+
+	def retry_later(self, delay):
+
+		self.cancel_timer()
+		self.timer = self.torrent.conn_man.call_later(delay, self.handle_timer)
+
+	def handle_timer(self):
+
+		self.timer = None
+		self.run_download()
+
+	def cancel_timer(self):
+
+		if self.timer:
+			self.timer.cancel()
+			self.timer = None
+
+	def cancel_request(self):
+		""" another source completed the piece - whatever our request returns is not needed """
+
+		if self.is_fetching:
+			self.is_cancelled = True
+		self.requested_piece = None
+
+
+class WebSeedError(Exception):
+	pass